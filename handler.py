@@ -1,27 +1,150 @@
 import os
+import glob
+import collections
+import atexit
 import shutil
 import time
+import asyncio
+import aiohttp
+import contextvars
+import functools
+import threading
 import requests
 import traceback
 import json
 import base64
+import io
+import struct
+import hashlib
+import mimetypes
 import uuid
 import logging
 import logging.handlers
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, features
+import boto3
+import botocore.exceptions
+from boto3.s3.transfer import TransferConfig
 import runpod
 from runpod.serverless.utils.rp_validator import validate
 from runpod.serverless.modules.rp_logger import RunPodLogger
-from requests.adapters import HTTPAdapter, Retry
-from schemas.input import INPUT_SCHEMA
+from schemas.input import INPUT_SCHEMA, WORKFLOWS
 
 
 APP_NAME = 'runpod-worker-comfyui'
 BASE_URI = 'http://127.0.0.1:3000'
+WS_URI = 'ws://127.0.0.1:3000/ws'
+WS_CONNECT_TIMEOUT = 10
+HTTP_POOL_SIZE = 32
+HTTP_KEEPALIVE_TIMEOUT = 60
+HTTP_MAX_RETRIES = 10
+HTTP_BACKOFF_FACTOR = 0.1
+HTTP_RETRY_STATUS_CODES = (502, 503, 504)
 VOLUME_MOUNT_PATH = '/runpod-volume'
+VOLUME_OUTPUT_PATH = f'{VOLUME_MOUNT_PATH}/ComfyUI/output'
+INPUT_PATH = f'{VOLUME_MOUNT_PATH}/ComfyUI/input'
+WORKFLOWS_PATH = os.getenv('WORKFLOWS_PATH', '/workflows')
+CUSTOM_NODES_PATH = f'{VOLUME_MOUNT_PATH}/ComfyUI/custom_nodes'
+OUTPUT_PATH = os.getenv('OUTPUT_PATH', '/tmp/output')
+INPUT_CACHE_PATH = os.getenv('INPUT_CACHE_PATH', '/tmp/input-cache')
+INPUT_CACHE_SIZE = int(os.getenv('INPUT_CACHE_SIZE', 1024 * 1024 * 1024))  # 1GB in bytes
+INPUT_MAX_SIZE = int(os.getenv('INPUT_MAX_SIZE', 50 * 1024 * 1024))  # 50MB in bytes
+INPUT_FETCH_TIMEOUT = 60
+INPUT_STORE_SUBFOLDER = 'store'
+INPUT_STORE_SIZE = int(os.getenv('INPUT_STORE_SIZE', 10 * 1024 * 1024 * 1024))  # 10GB in bytes
 LOG_FILE = 'comfyui-worker.log'
 TIMEOUT = 600
+JOB_TIMEOUT = float(os.getenv('JOB_TIMEOUT', TIMEOUT))
+FREE_TIMEOUT = 30
+POLL_INTERVAL_MIN = 0.2
+POLL_INTERVAL_MAX = 5.0
+POLL_BACKOFF_FACTOR = 1.5
+RUNTIME_SMOOTHING = 0.3
 LOG_LEVEL = 'INFO'
 DISK_MIN_FREE_BYTES = 500 * 1024 * 1024  # 500MB in bytes
+MAX_CONCURRENCY = int(os.getenv('MAX_CONCURRENCY', 1))
+CONCURRENCY_MIN_FREE_VRAM = float(os.getenv('CONCURRENCY_MIN_FREE_VRAM', 0.25))
+CONCURRENCY_MAX_QUEUED = int(os.getenv('CONCURRENCY_MAX_QUEUED', 1))
+STATS_TIMEOUT = 5
+OBJECT_INFO_TIMEOUT = 30
+CANCEL_TIMEOUT = 10
+QUEUE_ADMISSION = os.getenv('QUEUE_ADMISSION', 'report').lower()
+PROGRESS_UPDATES = os.getenv('PROGRESS_UPDATES', 'true').lower() == 'true'
+PROGRESS_UPDATE_INTERVAL = float(os.getenv('PROGRESS_UPDATE_INTERVAL', 2.0))
+SAVE_NODE_TYPES = (
+    'SaveImage',
+    'SaveAnimatedWEBP',
+    'SaveAnimatedPNG',
+    'SaveAudio',
+    'SaveVideo',
+    'VHS_VideoCombine'
+)
+OUTPUT_NODE_TYPES = SAVE_NODE_TYPES + ('PreviewImage', 'PreviewAudio', 'SaveImageWebsocket')
+OUTPUT_NODE_PREFIXES = ('Save', 'Preview')
+STREAM_OUTPUTS = os.getenv('STREAM_OUTPUTS', 'false').lower() == 'true'
+OUTPUT_STORAGE = os.getenv('OUTPUT_STORAGE', 'base64').lower()
+BUCKET_ENDPOINT_URL = os.getenv('BUCKET_ENDPOINT_URL')
+BUCKET_NAME = os.getenv('BUCKET_NAME')
+BUCKET_REGION = os.getenv('BUCKET_REGION')
+BUCKET_ACCESS_KEY_ID = os.getenv('BUCKET_ACCESS_KEY_ID')
+BUCKET_SECRET_ACCESS_KEY = os.getenv('BUCKET_SECRET_ACCESS_KEY')
+BUCKET_KEY_PREFIX = os.getenv('BUCKET_KEY_PREFIX', 'outputs')
+BUCKET_URL_EXPIRY = int(os.getenv('BUCKET_URL_EXPIRY', 3600))
+MAX_RESPONSE_SIZE = int(os.getenv('MAX_RESPONSE_SIZE', 20 * 1024 * 1024))  # 20MB in bytes
+BUCKET_MULTIPART_THRESHOLD = 8 * 1024 * 1024  # 8MB in bytes
+BUCKET_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024  # 8MB in bytes
+BUCKET_MULTIPART_CONCURRENCY = 4
+HASH_CHUNK_SIZE = 1024 * 1024  # 1MB in bytes
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_TEXT_CHUNK_TYPES = (b'tEXt', b'iTXt', b'zTXt')
+PNG_METADATA_KEYWORDS = (b'prompt', b'workflow')
+WEBSOCKET_IMAGE_NODE = 'SaveImageWebsocket'
+WEBSOCKET_BINARY_PREVIEW_IMAGE = 1
+WEBSOCKET_IMAGE_FORMATS = {1: '.jpg', 2: '.png'}
+ENCODE_CHUNK_SIZE = 3 * 256 * 1024  # 768KB in bytes, a multiple of 3 so chunks encode without padding
+OUTPUT_QUALITY = 90
+OUTPUT_WORKERS = int(os.getenv('OUTPUT_WORKERS', min(4, os.cpu_count() or 1)))
+OUTPUT_FORMATS = {
+    'png': {'format': 'PNG', 'extension': '.png', 'feature': 'zlib'},
+    'webp': {'format': 'WEBP', 'extension': '.webp', 'feature': 'webp'},
+    'jpeg': {'format': 'JPEG', 'extension': '.jpg', 'feature': 'jpg'},
+    'avif': {'format': 'AVIF', 'extension': '.avif', 'feature': 'avif'}
+}
+
+# The id of the job being handled by the current asyncio task, so that
+# concurrent jobs do not overwrite each other's id in the process environment
+current_job_id = contextvars.ContextVar('current_job_id', default=None)
+
+# The encoder memory usage of the job being handled by the current asyncio task
+current_encoder_memory = contextvars.ContextVar('current_encoder_memory', default=None)
+
+
+# ---------------------------------------------------------------------------- #
+#                                 HTTP Session                                 #
+# ---------------------------------------------------------------------------- #
+http_session = None
+http_session_loop = None
+
+
+def get_http_session():
+    """
+    Get the pooled keep-alive HTTP session shared by the ComfyUI client and the
+    log shipping. The session is bound to the event loop it was created in, so
+    it is recreated if the handler is run from a new event loop.
+    """
+    global http_session, http_session_loop
+    loop = asyncio.get_running_loop()
+
+    if http_session is None or http_session.closed or http_session_loop is not loop:
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=HTTP_POOL_SIZE,
+                keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT
+            )
+        )
+        http_session_loop = loop
+
+    return http_session
 
 
 # ---------------------------------------------------------------------------- #
@@ -48,9 +171,45 @@ class SnapLogHandler(logging.Handler):
         self.log_api_timeout = os.getenv('LOG_API_TIMEOUT', 5)
         self.log_api_timeout = int(self.log_api_timeout)
         self.log_token = os.getenv('LOG_API_TOKEN')
+        self.pending_logs = set()
+
+    def send_log(self, log_payload):
+        try:
+            headers = {'Authorization': f'Bearer {self.log_token}'}
+
+            response = requests.post(
+                self.log_api_endpoint,
+                json=log_payload,
+                headers=headers,
+                timeout=self.log_api_timeout
+            )
+
+            if response.status_code != 200:
+                self.rp_logger.error(f'Failed to send log to API. Status code: {response.status_code}')
+        except requests.Timeout:
+            self.rp_logger.error(f'Timeout error sending log to API (timeout={self.log_api_timeout}s)')
+        except Exception as e:
+            self.rp_logger.error(f'Error sending log to API: {str(e)}')
+
+    async def send_log_async(self, log_payload):
+        try:
+            headers = {'Authorization': f'Bearer {self.log_token}'}
+
+            async with get_http_session().post(
+                self.log_api_endpoint,
+                json=log_payload,
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=self.log_api_timeout)
+            ) as response:
+                if response.status != 200:
+                    self.rp_logger.error(f'Failed to send log to API. Status code: {response.status}')
+        except asyncio.TimeoutError:
+            self.rp_logger.error(f'Timeout error sending log to API (timeout={self.log_api_timeout}s)')
+        except Exception as e:
+            self.rp_logger.error(f'Error sending log to API: {str(e)}')
 
     def emit(self, record):
-        runpod_job_id = os.getenv('RUNPOD_JOB_ID')
+        runpod_job_id = current_job_id.get() or os.getenv('RUNPOD_JOB_ID')
 
         try:
             # Handle string formatting and extra arguments
@@ -89,41 +248,37 @@ class SnapLogHandler(logging.Handler):
                     rp_logger(message)
 
             if self.log_api_endpoint:
+                log_payload = {
+                    'app_name': self.app_name,
+                    'log_asctime': self.formatter.formatTime(record),
+                    'log_levelname': record.levelname,
+                    'log_message': message,
+                    'runpod_endpoint_id': self.runpod_endpoint_id,
+                    'runpod_cpu_count': self.runpod_cpu_count,
+                    'runpod_pod_id': self.runpod_pod_id,
+                    'runpod_gpu_size': self.runpod_gpu_size,
+                    'runpod_mem_gb': self.runpod_mem_gb,
+                    'runpod_gpu_count': self.runpod_gpu_count,
+                    'runpod_volume_id': self.runpod_volume_id,
+                    'runpod_pod_hostname': self.runpod_pod_hostname,
+                    'runpod_debug_level': self.runpod_debug_level,
+                    'runpod_dc_id': self.runpod_dc_id,
+                    'runpod_gpu_name': self.runpod_gpu_name,
+                    'runpod_job_id': runpod_job_id
+                }
+
                 try:
-                    headers = {'Authorization': f'Bearer {self.log_token}'}
-
-                    log_payload = {
-                        'app_name': self.app_name,
-                        'log_asctime': self.formatter.formatTime(record),
-                        'log_levelname': record.levelname,
-                        'log_message': message,
-                        'runpod_endpoint_id': self.runpod_endpoint_id,
-                        'runpod_cpu_count': self.runpod_cpu_count,
-                        'runpod_pod_id': self.runpod_pod_id,
-                        'runpod_gpu_size': self.runpod_gpu_size,
-                        'runpod_mem_gb': self.runpod_mem_gb,
-                        'runpod_gpu_count': self.runpod_gpu_count,
-                        'runpod_volume_id': self.runpod_volume_id,
-                        'runpod_pod_hostname': self.runpod_pod_hostname,
-                        'runpod_debug_level': self.runpod_debug_level,
-                        'runpod_dc_id': self.runpod_dc_id,
-                        'runpod_gpu_name': self.runpod_gpu_name,
-                        'runpod_job_id': runpod_job_id
-                    }
-
-                    response = requests.post(
-                        self.log_api_endpoint,
-                        json=log_payload,
-                        headers=headers,
-                        timeout=self.log_api_timeout
-                    )
-
-                    if response.status_code != 200:
-                        self.rp_logger.error(f'Failed to send log to API. Status code: {response.status_code}')
-                except requests.Timeout:
-                    self.rp_logger.error(f'Timeout error sending log to API (timeout={self.log_api_timeout}s)')
-                except Exception as e:
-                    self.rp_logger.error(f'Error sending log to API: {str(e)}')
+                    loop = asyncio.get_running_loop()
+                except RuntimeError:
+                    loop = None
+
+                if loop is None:
+                    self.send_log(log_payload)
+                else:
+                    # Ship the log in the background so that the handler is not blocked
+                    task = loop.create_task(self.send_log_async(log_payload))
+                    self.pending_logs.add(task)
+                    task.add_done_callback(self.pending_logs.discard)
             else:
                 self.rp_logger.warn('LOG_API_ENDPOINT environment variable is not set, not logging to API')
         except Exception as e:
@@ -131,6 +286,79 @@ class SnapLogHandler(logging.Handler):
             self.rp_logger.error(f'Error in log formatting: {str(e)}')
 
 
+# ---------------------------------------------------------------------------- #
+#                                Job Deadlines                                 #
+# ---------------------------------------------------------------------------- #
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    """
+    Time budget for a single job that is shared by every request made to
+    ComfyUI on behalf of the job, so that a hung or crashed ComfyUI fails
+    the job instead of holding the worker until the Runpod execution timeout.
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + seconds
+
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self, action):
+        if self.expired():
+            raise DeadlineExceeded(f'Job exceeded its time budget of {self.seconds:g}s while {action}')
+
+    def timeout(self, limit=TIMEOUT):
+        """
+        Get the timeout for the next request, which is capped at the
+        remaining time budget of the job.
+        """
+        self.check('sending a request to ComfyUI')
+        return min(limit, self.remaining())
+
+
+# Smoothed runtime of each workflow, used to pace the history polling
+workflow_runtimes = {}
+
+
+def get_expected_runtime(workflow_name):
+    return workflow_runtimes.get(workflow_name)
+
+
+def record_runtime(workflow_name, runtime):
+    expected_runtime = workflow_runtimes.get(workflow_name)
+
+    if expected_runtime is None:
+        workflow_runtimes[workflow_name] = runtime
+    else:
+        workflow_runtimes[workflow_name] = (
+            RUNTIME_SMOOTHING * runtime + (1 - RUNTIME_SMOOTHING) * expected_runtime
+        )
+
+
+def get_poll_interval(retries, elapsed, expected_runtime=None):
+    """
+    Back off exponentially between polls of the history endpoint. While the
+    prompt is not yet expected to have finished, sleep for up to half of the
+    expected time remaining so that the poll lands close to completion.
+    """
+    interval = min(POLL_INTERVAL_MIN * (POLL_BACKOFF_FACTOR ** retries), POLL_INTERVAL_MAX)
+
+    if expected_runtime is not None and elapsed < expected_runtime:
+        interval = max(interval, min((expected_runtime - elapsed) / 2, POLL_INTERVAL_MAX))
+
+    return interval
+
+
 # ---------------------------------------------------------------------------- #
 #                               ComfyUI Functions                              #
 # ---------------------------------------------------------------------------- #
@@ -144,100 +372,1945 @@ def wait_for_service(url):
         except requests.exceptions.RequestException:
             retries += 1
 
-            # Only log every 15 retries so the logs don't get spammed
-            if retries % 15 == 0:
-                logging.info('Service not ready yet. Retrying...')
-        except Exception as err:
-            logging.error(f'Error: {err}')
+            # Only log every 15 retries so the logs don't get spammed
+            if retries % 15 == 0:
+                logging.info('Service not ready yet. Retrying...')
+        except Exception as err:
+            logging.error(f'Error: {err}')
+
+        time.sleep(0.2)
+
+
+class ComfyUIResponse:
+    """
+    Fully read response from the ComfyUI API, so that the connection is
+    returned to the pool as soon as the request completes.
+    """
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def build_form_data(form):
+    """
+    Build multipart form data from a dict of field values, where file fields
+    are (filename, data, content_type) tuples
+    """
+    form_data = aiohttp.FormData()
+
+    for name, value in form.items():
+        if isinstance(value, tuple):
+            filename, data, content_type = value
+            form_data.add_field(name, data, filename=filename, content_type=content_type)
+        else:
+            form_data.add_field(name, value)
+
+    return form_data
+
+
+class ComfyUIClient:
+    """
+    Async client for the ComfyUI API backed by the pooled keep-alive HTTP session.
+    Requests are retried on connection errors and gateway errors.
+    """
+    def __init__(self, base_uri, ws_uri):
+        self.base_uri = base_uri
+        self.ws_uri = ws_uri
+
+    async def request(self, method, endpoint, timeout=TIMEOUT, deadline=None, form=None, **kwargs):
+        """
+        Send a request to ComfyUI. When a deadline is given, the timeout of each
+        attempt and the backoff between attempts are capped at the remaining
+        time budget of the job, and DeadlineExceeded is raised once it is spent.
+        """
+        retries = 0
+
+        while True:
+            attempt_timeout = timeout if deadline is None else deadline.timeout(timeout)
+
+            # Form data can only be sent once, so it is built again for each attempt
+            if form is not None:
+                kwargs['data'] = build_form_data(form)
+
+            try:
+                async with get_http_session().request(
+                    method,
+                    f'{self.base_uri}/{endpoint}',
+                    timeout=aiohttp.ClientTimeout(total=attempt_timeout),
+                    **kwargs
+                ) as response:
+                    content = await response.read()
+
+                    if response.status not in HTTP_RETRY_STATUS_CODES or retries >= HTTP_MAX_RETRIES:
+                        return ComfyUIResponse(response.status, content)
+            except asyncio.TimeoutError as e:
+                if deadline is not None:
+                    deadline.check(f'waiting for ComfyUI to respond to {endpoint}')
+
+                raise asyncio.TimeoutError(f'ComfyUI did not respond to {endpoint} within {attempt_timeout:g}s') from e
+            except aiohttp.ClientConnectionError:
+                if retries >= HTTP_MAX_RETRIES:
+                    raise
+
+            backoff = HTTP_BACKOFF_FACTOR * (2 ** retries)
+
+            if deadline is not None:
+                backoff = min(backoff, deadline.remaining())
+
+            await asyncio.sleep(backoff)
+            retries += 1
+
+    async def get(self, endpoint, timeout=TIMEOUT, deadline=None):
+        return await self.request('GET', endpoint, timeout, deadline)
+
+    async def post(self, endpoint, payload, timeout=TIMEOUT, deadline=None):
+        return await self.request('POST', endpoint, timeout, deadline, json=payload)
+
+    async def post_form(self, endpoint, form, timeout=TIMEOUT, deadline=None):
+        return await self.request('POST', endpoint, timeout, deadline, form=form)
+
+    async def ws_connect(self, client_id, timeout=WS_CONNECT_TIMEOUT):
+        return await asyncio.wait_for(
+            get_http_session().ws_connect(
+                f'{self.ws_uri}?clientId={client_id}',
+                max_msg_size=0
+            ),
+            timeout
+        )
+
+
+comfyui = ComfyUIClient(BASE_URI, WS_URI)
+
+
+async def send_get_request(endpoint, deadline=None, timeout=TIMEOUT):
+    return await comfyui.get(endpoint, timeout, deadline)
+
+
+async def send_post_request(endpoint, payload, deadline=None, timeout=TIMEOUT):
+    return await comfyui.post(endpoint, payload, timeout, deadline)
+
+
+async def send_form_request(endpoint, form, deadline=None, timeout=TIMEOUT):
+    return await comfyui.post_form(endpoint, form, timeout, deadline)
+
+
+class ComfyUIEventListener:
+    """
+    Listen on the ComfyUI websocket for the execution events of the prompts
+    queued with this listener's client_id, so that the handler can be woken
+    up as soon as a prompt finishes instead of polling the history endpoint.
+    """
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.ws = None
+        self.task = None
+        self.connected = False
+        self.closing = False
+        self.finished = set()
+        self.changed = asyncio.Event()
+        self.subscribers = []
+        self.dropped = False
+        self.executing_node = None
+        # Ids of the websocket image nodes whose images are collected
+        self.image_nodes = set()
+        self.images = []
+
+    def subscribe(self, callback):
+        """
+        Register a callback that is called with the type and data of every
+        event received on the websocket.
+        """
+        self.subscribers.append(callback)
+
+    async def connect(self):
+        try:
+            self.ws = await comfyui.ws_connect(self.client_id)
+        except Exception as e:
+            logging.warning(f'Unable to connect to ComfyUI websocket, falling back to polling: {e}')
+            self.ws = None
+            return False
+
+        self.connected = True
+        self.task = asyncio.create_task(self._listen())
+        return True
+
+    async def _listen(self):
+        try:
+            async for message in self.ws:
+                if message.type == aiohttp.WSMsgType.TEXT:
+                    self.handle_message(json.loads(message.data))
+                elif message.type == aiohttp.WSMsgType.BINARY:
+                    self.handle_binary_message(message.data)
+                elif message.type == aiohttp.WSMsgType.ERROR:
+                    break
+
+            if not self.closing:
+                self.dropped = True
+                logging.warning('ComfyUI websocket dropped, falling back to polling')
+        except Exception as e:
+            if not self.closing:
+                self.dropped = True
+                logging.warning(f'ComfyUI websocket dropped, falling back to polling: {e}')
+        finally:
+            self.connected = False
+            self.changed.set()
+
+    def handle_message(self, message):
+        event_type = message.get('type')
+        data = message.get('data') or {}
+        prompt_id = data.get('prompt_id')
+
+        if event_type == 'executing':
+            self.executing_node = data.get('node')
+
+        for callback in self.subscribers:
+            try:
+                callback(event_type, data)
+            except Exception as e:
+                logging.warning(f'Error handling ComfyUI {event_type} event: {e}')
+
+        if event_type == 'executing' and data.get('node') is None:
+            finished = True
+        elif event_type in ('execution_success', 'execution_error', 'execution_interrupted'):
+            finished = True
+        else:
+            finished = False
+
+        if finished and prompt_id:
+            self.finished.add(prompt_id)
+            self.changed.set()
+
+    def handle_binary_message(self, data):
+        """
+        Collect the images sent by websocket image nodes. Binary messages do
+        not say which node sent them, so they are tagged with the node that
+        is executing. Preview images sent by sampler nodes are ignored.
+        """
+        if len(data) < 8 or self.executing_node not in self.image_nodes:
+            return
+
+        event_type, image_type = struct.unpack('>II', data[:8])
+
+        if event_type != WEBSOCKET_BINARY_PREVIEW_IMAGE:
+            return
+
+        node_id = self.executing_node
+        batch_index = len([image for image in self.images if image['node_id'] == node_id])
+
+        self.images.append({
+            'filename': f'{node_id}_{batch_index:05}{WEBSOCKET_IMAGE_FORMATS.get(image_type, ".png")}',
+            'type': 'websocket',
+            'node_id': node_id,
+            'batch_index': batch_index,
+            'kind': 'images',
+            'data': data[8:]
+        })
+
+    def pop_images(self):
+        images = self.images
+        self.images = []
+        return images
+
+    async def _wait_finished(self, prompt_id):
+        while prompt_id not in self.finished and self.connected:
+            self.changed.clear()
+            await self.changed.wait()
+
+    async def wait(self, prompt_id, timeout=None):
+        """
+        Wait until the prompt has finished executing or the websocket drops.
+        Returns True if the prompt finished, False if the caller needs to
+        fall back to polling the history endpoint.
+        """
+        try:
+            await asyncio.wait_for(self._wait_finished(prompt_id), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        return prompt_id in self.finished
+
+    async def close(self):
+        self.closing = True
+
+        if self.ws is not None:
+            try:
+                await self.ws.close()
+            except Exception:
+                pass
+
+        if self.task is not None:
+            await asyncio.gather(self.task, return_exceptions=True)
+
+
+class ProgressReporter:
+    """
+    Turn the ComfyUI executing and progress events of a job into throttled
+    Runpod progress updates with the current node, step and estimated time
+    remaining for the node.
+    """
+    def __init__(self, job, workflow, interval=PROGRESS_UPDATE_INTERVAL):
+        self.job = job
+        self.workflow = workflow
+        self.interval = interval
+        self.started_at = time.monotonic()
+        self.last_sent_at = None
+        self.node = None
+        self.step = None
+        self.steps = None
+        self.first_step = None
+        self.first_step_at = None
+
+    def handle_event(self, event_type, data):
+        if event_type == 'executing':
+            if data.get('node') is None or data.get('node') == self.node:
+                return
+
+            self.node = data['node']
+            self.step = None
+            self.steps = None
+            self.first_step = None
+            self.first_step_at = None
+            self.send()
+        elif event_type == 'progress':
+            self.node = data.get('node') or self.node
+            self.step = data.get('value')
+            self.steps = data.get('max')
+
+            if self.first_step is None:
+                self.first_step = self.step
+                self.first_step_at = time.monotonic()
+
+            self.send(force=self.step == self.steps)
+
+    def get_eta(self):
+        if self.first_step is None or self.step is None or self.step <= self.first_step:
+            return None
+
+        seconds_per_step = (time.monotonic() - self.first_step_at) / (self.step - self.first_step)
+        return round(seconds_per_step * (self.steps - self.step), 1)
+
+    def send(self, force=False):
+        now = time.monotonic()
+
+        if not force and self.last_sent_at is not None and now - self.last_sent_at < self.interval:
+            return
+
+        self.last_sent_at = now
+        node = self.workflow.get(self.node) or {}
+
+        runpod.serverless.progress_update(
+            self.job,
+            {
+                'node': self.node,
+                'class_type': node.get('class_type'),
+                'step': self.step,
+                'steps': self.steps,
+                'eta': self.get_eta(),
+                'elapsed': round(now - self.started_at, 1)
+            }
+        )
+
+
+# ---------------------------------------------------------------------------- #
+#                              Workflow Templates                              #
+# ---------------------------------------------------------------------------- #
+def copy_workflow(workflow):
+    """
+    Copy the dicts and lists of a parsed workflow, which is much faster than
+    copy.deepcopy() because the leaves are immutable JSON values
+    """
+    if isinstance(workflow, dict):
+        return {key: copy_workflow(value) for key, value in workflow.items()}
+
+    if isinstance(workflow, list):
+        return [copy_workflow(value) for value in workflow]
+
+    return workflow
+
+
+# The types of the payload inputs of a template parameter map
+PARAMETER_TYPES = {
+    'int': int,
+    'float': float,
+    'str': str,
+    'bool': bool
+}
+
+
+class PayloadError(ValueError):
+    """
+    Raised when the payload of a job does not fit its workflow, which is
+    returned to the client like an invalid input instead of refreshing the
+    worker
+    """
+    pass
+
+
+def get_parameter_value(name, value_type, value):
+    if value_type is float and isinstance(value, int) and not isinstance(value, bool):
+        return float(value)
+
+    if not isinstance(value, value_type) or (value_type is int and isinstance(value, bool)):
+        raise PayloadError(f'Payload input {name} should be {value_type.__name__}, not {type(value).__name__}')
+
+    return value
+
+
+class ParameterMap:
+    """
+    Payload inputs of a workflow template, compiled from the sidecar
+    {name}.params.json of the template. The sidecar maps the name of each input
+    to its type, its optional default and the [node id, field] targets that it
+    sets in the template. Inputs without a default are required. The targets
+    are validated against the template when it is loaded.
+    """
+    def __init__(self, params, workflow):
+        self.setters = []
+
+        for name, param in params.items():
+            if param.get('type') not in PARAMETER_TYPES:
+                raise ValueError(f'Parameter {name} has an unknown type: {param.get("type")}')
+
+            value_type = PARAMETER_TYPES[param['type']]
+            targets = [tuple(target) for target in param.get('targets', [])]
+
+            if not targets:
+                raise ValueError(f'Parameter {name} has no targets')
+
+            for node_id, field in targets:
+                inputs = workflow.get(node_id, {}).get('inputs', {})
+
+                if field not in inputs:
+                    raise ValueError(f'Parameter {name} targets a missing node input: {node_id}.{field}')
+
+                if isinstance(inputs[field], list):
+                    raise ValueError(f'Parameter {name} targets a linked node input: {node_id}.{field}')
+
+            if 'default' in param:
+                default = get_parameter_value(name, value_type, param['default'])
+            else:
+                default = None
+
+            self.setters.append((name, value_type, 'default' in param, default, targets))
+
+    def apply(self, workflow, payload):
+        for name, value_type, has_default, default, targets in self.setters:
+            if name in payload:
+                value = get_parameter_value(name, value_type, payload[name])
+            elif has_default:
+                value = default
+            else:
+                raise PayloadError(f'Payload is missing the required input: {name}')
+
+            for node_id, field in targets:
+                workflow[node_id]['inputs'][field] = value
+
+        return workflow
+
+
+class WorkflowTemplates:
+    """
+    Cache of the parsed workflow templates in a directory, which are copied
+    for each job instead of being parsed again. A template is parsed again when
+    its file or the sidecar of its parameter map is modified, and the directory
+    is scanned again for templates that were added or removed when the
+    directory is modified. The names of the templates are kept in the given
+    set, which the input schema validates the workflow against.
+    """
+    def __init__(self, path, names):
+        self.path = path
+        self.names = names
+        self.templates = {}
+        self.mtime = None
+
+    def refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+
+        if mtime is not None and mtime == self.mtime:
+            return
+
+        self.mtime = mtime
+        names = {
+            os.path.basename(path)[:-len('.json')] for path in glob.glob(f'{self.path}/*.json')
+            if not path.endswith('.params.json')
+        }
+        self.templates = {name: template for name, template in self.templates.items() if name in names}
+
+        for name in sorted(names - set(self.templates)):
+            try:
+                self.load(name)
+            except (OSError, ValueError) as e:
+                logging.error(f'Unable to load workflow template {name}: {e}')
+                names.discard(name)
+
+        self.names.clear()
+        self.names.update(names)
+
+    def get_mtimes(self, name):
+        try:
+            params_mtime = os.stat(f'{self.path}/{name}.params.json').st_mtime_ns
+        except FileNotFoundError:
+            params_mtime = None
+
+        return os.stat(f'{self.path}/{name}.json').st_mtime_ns, params_mtime
+
+    def load(self, name):
+        mtimes = self.get_mtimes(name)
+
+        with open(f'{self.path}/{name}.json', 'r') as json_file:
+            workflow = json.load(json_file)
+
+        if mtimes[1] is not None:
+            with open(f'{self.path}/{name}.params.json', 'r') as json_file:
+                parameters = ParameterMap(json.load(json_file), workflow)
+        else:
+            parameters = None
+
+        self.templates[name] = (mtimes, workflow, parameters)
+        logging.info(f'Loaded workflow template: {name}')
+        return workflow, parameters
+
+    def get(self, name):
+        """
+        Get a copy of a workflow template and its parameter map, which are
+        parsed again if their files have been modified since they were loaded
+        """
+        template = self.templates.get(name)
+
+        if template is None or self.get_mtimes(name) != template[0]:
+            workflow, parameters = self.load(name)
+        else:
+            workflow, parameters = template[1:]
+
+        return copy_workflow(workflow), parameters
+
+
+workflow_templates = WorkflowTemplates(WORKFLOWS_PATH, WORKFLOWS)
+
+
+def get_workflow_payload(workflow_name, payload):
+    workflow, parameters = workflow_templates.get(workflow_name)
+
+    if parameters is not None:
+        workflow = parameters.apply(workflow, payload)
+
+    return workflow
+
+
+# Collectors for each kind of output in the history of a prompt, keyed by
+# the output key that the nodes of that kind report, such as 'images'
+OUTPUT_COLLECTORS = {}
+
+
+def output_collector(*kinds):
+    def register(collector):
+        for kind in kinds:
+            OUTPUT_COLLECTORS[kind] = collector
+
+        return collector
+
+    return register
+
+
+@output_collector('images', 'gifs', 'videos', 'audio')
+def collect_output_files(node_id, kind, value):
+    """
+    Collect the files saved by image, animated image, video and audio nodes
+    """
+    return [
+        {**output_file, 'node_id': node_id, 'batch_index': batch_index, 'kind': kind}
+        for batch_index, output_file in enumerate(value)
+        if isinstance(output_file, dict) and 'filename' in output_file
+    ]
+
+
+@output_collector('text')
+def collect_output_text(node_id, kind, value):
+    """
+    Collect the text reported by text nodes, which is not saved to a file
+    """
+    return [
+        {'node_id': node_id, 'batch_index': batch_index, 'kind': kind, 'text': text}
+        for batch_index, text in enumerate(value)
+        if isinstance(text, str)
+    ]
+
+
+def get_outputs(output):
+    """
+    Get every output of every output node, of each kind that has a collector
+    """
+    outputs = []
+
+    for node_id, value in output.items():
+        for kind, kind_value in value.items():
+            if kind in OUTPUT_COLLECTORS and isinstance(kind_value, list):
+                outputs.extend(OUTPUT_COLLECTORS[kind](node_id, kind, kind_value))
+
+    return outputs
+
+
+def get_output_images(output):
+    """
+    Get every output file of every output node, tagged with the id of the
+    node, the index of the file within the batch and the kind of output
+    """
+    return [output_file for output_file in get_outputs(output) if 'filename' in output_file]
+
+
+def get_output_text(output):
+    return [
+        {'node_id': output_text['node_id'], 'text': output_text['text']}
+        for output_text in get_outputs(output) if 'text' in output_text
+    ]
+
+
+def transcode_image(src, dst, output_options):
+    """
+    Convert an image to the requested format and quality, scaling it down to
+    fit within max_dimension. src and dst are paths or file objects. Returns
+    False without writing dst for animated images, since only the first frame
+    would be kept.
+    """
+    output_format = OUTPUT_FORMATS[output_options['format']]
+    max_dimension = output_options['max_dimension']
+
+    with Image.open(src) as image:
+        if getattr(image, 'is_animated', False):
+            return False
+
+        image.load()
+
+        if max_dimension and max(image.size) > max_dimension:
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+        # JPEG has no alpha channel
+        if output_format['format'] == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        image.save(dst, format=output_format['format'], quality=output_options['quality'])
+
+    return True
+
+
+def transcode_output_file(image_path, output_options):
+    """
+    Transcode an output image. The original file is replaced by the
+    transcoded file, and the path of the transcoded file is returned.
+    Animated images are left as they are.
+    """
+    transcoded_path = os.path.splitext(image_path)[0] + OUTPUT_FORMATS[output_options['format']]['extension']
+
+    if not transcode_image(image_path, transcoded_path, output_options):
+        return image_path
+
+    if transcoded_path != image_path:
+        os.remove(image_path)
+
+    return transcoded_path
+
+
+def strip_png_metadata(file_path):
+    """
+    Remove the text chunks with the prompt and workflow that ComfyUI embeds
+    in saved PNGs, by copying the other chunks as they are, so the pixels are
+    not re-encoded. Returns the number of bytes that were removed.
+    """
+    stripped_path = f'{file_path}.stripped'
+    removed = 0
+
+    with open(file_path, 'rb') as src:
+        if src.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+            return 0
+
+        with open(stripped_path, 'wb') as dst:
+            dst.write(PNG_SIGNATURE)
+
+            while True:
+                header = src.read(8)
+
+                if len(header) < 8:
+                    break
+
+                length, chunk_type = struct.unpack('>I4s', header)
+                # The chunk data is followed by a 4 byte CRC
+                chunk = src.read(length + 4)
+
+                if chunk_type in PNG_TEXT_CHUNK_TYPES and chunk.split(b'\0', 1)[0] in PNG_METADATA_KEYWORDS:
+                    removed += len(header) + len(chunk)
+                    continue
+
+                dst.write(header)
+                dst.write(chunk)
+
+                if chunk_type == b'IEND':
+                    break
+
+    if removed:
+        os.replace(stripped_path, file_path)
+    else:
+        os.remove(stripped_path)
+
+    return removed
+
+
+class EncoderMemory:
+    """
+    Memory held by the output encoder for a job, including the encoded images
+    that have not yet been handed to Runpod, and the peak of that memory
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+
+    def allocate(self, size):
+        with self.lock:
+            self.current += size
+            self.peak = max(self.peak, self.current)
+
+    def release(self, size):
+        with self.lock:
+            self.current -= size
+
+
+def track_encoder_memory():
+    encoder_memory = EncoderMemory()
+    current_encoder_memory.set(encoder_memory)
+    return encoder_memory
+
+
+def encode_file(file_path):
+    """
+    Base64 encode a file in chunks into a buffer that is allocated once at
+    the size of the encoded file, so that the whole raw file is never held in
+    memory. The encoded buffer and the returned string briefly coexist while
+    the buffer is decoded, so the peak is twice the encoded size plus one
+    chunk of the raw file, about 2.67 times the size of the file.
+    """
+    encoder_memory = current_encoder_memory.get() or EncoderMemory()
+    encoded_size = (os.path.getsize(file_path) + 2) // 3 * 4
+    encoded = bytearray(encoded_size)
+    encoder_memory.allocate(encoded_size + ENCODE_CHUNK_SIZE)
+    offset = 0
+
+    try:
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(ENCODE_CHUNK_SIZE), b''):
+                encoded_chunk = base64.b64encode(chunk)
+                encoded[offset:offset + len(encoded_chunk)] = encoded_chunk
+                offset += len(encoded_chunk)
+
+        # The file may have been truncated since its size was read
+        del encoded[offset:]
+        encoder_memory.allocate(offset)
+        return encoded.decode('ascii')
+    finally:
+        del encoded
+        encoder_memory.release(encoded_size + ENCODE_CHUNK_SIZE)
+
+
+def get_output_file_path(output_image):
+    return os.path.join(OUTPUT_PATH, output_image.get('subfolder') or '', output_image.get('filename'))
+
+
+def get_prepared_file_path(output_image):
+    return output_image.get('path') or get_output_file_path(output_image)
+
+
+def persist_output_file(file_path, output_image, job_id):
+    """
+    Copy an output file from the local output directory to the network volume
+    """
+    persisted_path = os.path.join(
+        VOLUME_OUTPUT_PATH,
+        output_image.get('subfolder') or '',
+        os.path.basename(file_path)
+    )
+
+    os.makedirs(os.path.dirname(persisted_path), exist_ok=True)
+    shutil.copyfile(file_path, persisted_path)
+    logging.info(f'Persisted output file: {persisted_path}', job_id)
+    return persisted_path
+
+
+def persist_output_data(data, filename, job_id):
+    """
+    Write an output that was received in memory to the network volume
+    """
+    persisted_path = os.path.join(VOLUME_OUTPUT_PATH, filename)
+    os.makedirs(VOLUME_OUTPUT_PATH, exist_ok=True)
+
+    with open(persisted_path, 'wb') as f:
+        f.write(data)
+
+    logging.info(f'Persisted output file: {persisted_path}', job_id)
+    return persisted_path
+
+
+def prepare_output_image(output_image, job_id, output_options=None, strip_metadata=False):
+    """
+    Transcode an output image when output_options are given, and remove its
+    embedded workflow when strip_metadata is True, before the size of the
+    response is estimated. Returns the output image with the path of the
+    prepared file, or with the prepared data of an image that was received over
+    the websocket, which has no metadata to strip.
+    """
+    if output_image['type'] == 'websocket':
+        data = output_image['data']
+        filename = output_image['filename']
+
+        if output_options is not None:
+            transcoded = io.BytesIO()
+
+            if transcode_image(io.BytesIO(data), transcoded, output_options):
+                data = transcoded.getvalue()
+                filename = os.path.splitext(filename)[0] + OUTPUT_FORMATS[output_options['format']]['extension']
+
+        return {**output_image, 'data': data, 'filename': filename, 'prepared': True, 'metadata_bytes_removed': 0}
+
+    image_path = get_output_file_path(output_image)
+
+    if output_image['type'] != 'output' or not os.path.exists(image_path):
+        return output_image
+
+    if output_options is not None and output_image.get('kind', 'images') == 'images':
+        image_path = transcode_output_file(image_path, output_options)
+        logging.info(f'Transcoded output file: {image_path}', job_id)
+
+    metadata_removed = strip_png_metadata(image_path) if strip_metadata else 0
+
+    if metadata_removed:
+        logging.info(f'Removed {metadata_removed} bytes of metadata from output file: {image_path}', job_id)
+
+    return {**output_image, 'path': image_path, 'prepared': True, 'metadata_bytes_removed': metadata_removed}
+
+
+def process_output_image(
+    output_image, job_id, encode=True, storage='base64', output_options=None, persist=False, strip_metadata=False
+):
+    """
+    Base64 encode an output image, upload it to the bucket when storage is
+    's3', or copy it to the network volume when storage is 'volume', and
+    delete the output and temp images from disk. The image is first prepared
+    with prepare_output_image(), unless that was already done, and it is
+    copied to the network volume when persist is True. Returns the fields of
+    the image in the response, or None for temp images and for output images
+    that are only deleted because encode is False.
+    """
+    filename = output_image.get('filename')
+
+    if output_image['type'] == 'output':
+        if encode and not output_image.get('prepared'):
+            output_image = prepare_output_image(output_image, job_id, output_options, strip_metadata)
+
+        image_path = get_prepared_file_path(output_image)
+
+        if not os.path.exists(image_path):
+            return None
+
+        if not encode:
+            if persist:
+                persist_output_file(image_path, output_image, job_id)
+
+            logging.info(f'Deleting output file: {image_path}', job_id)
+            os.remove(image_path)
+            return None
+
+        if storage == 's3':
+            image_fields = upload_output_file(image_path, job_id)
+        elif storage == 'volume':
+            persisted_path = persist_output_file(image_path, output_image, job_id)
+            image_fields = {'image': persisted_path, 'path': persisted_path}
+        else:
+            image_fields = {'image': encode_file(image_path)}
+
+        if persist and storage != 'volume':
+            image_fields['path'] = persist_output_file(image_path, output_image, job_id)
+
+        if strip_metadata:
+            image_fields['metadata_bytes_removed'] = output_image['metadata_bytes_removed']
+
+        logging.info(f'Deleting output file: {image_path}', job_id)
+        os.remove(image_path)
+        return image_fields
+    elif output_image['type'] == 'temp':
+        # First check if the temp image exists in the mounted volume
+        image_path = f'{VOLUME_MOUNT_PATH}/ComfyUI/temp/{filename}'
+
+        if os.path.exists(image_path):
+            logging.info(f'Deleting temp file: {image_path}', job_id)
+
+            try:
+                os.remove(image_path)
+            except Exception as e:
+                logging.error(f'Error deleting temp file {image_path}: {e}')
+        else:
+            # Then check if the temp image exists in the /tmp directory
+            # This should be where they are located as a result of the
+            # --temp-directory /tmp command line argument in the start.sh script
+            image_path = f'/tmp/temp/{filename}'
+
+            if os.path.exists(image_path):
+                logging.info(f'Deleting temp file: {image_path}', job_id)
+
+                try:
+                    os.remove(image_path)
+                except Exception as e:
+                    logging.error(f'Error deleting temp file {image_path}: {e}')
+
+    return None
+
+
+def process_websocket_image(
+    websocket_image, job_id, encode=True, storage='base64', output_options=None, persist=False, strip_metadata=False
+):
+    """
+    Base64 encode, upload or persist an image that was received over the
+    websocket, without writing it to the local output directory. Websocket
+    image nodes do not embed the workflow, so there is no metadata to strip.
+    Returns the fields of the image in the response, or None if encode is
+    False.
+    """
+    if not encode:
+        return None
+
+    if not websocket_image.get('prepared'):
+        websocket_image = prepare_output_image(websocket_image, job_id, output_options, strip_metadata)
+
+    data = websocket_image['data']
+    filename = websocket_image['filename']
+
+    if storage == 's3':
+        image_fields = upload_output_fileobj(io.BytesIO(data), filename, job_id)
+    elif storage == 'volume':
+        persisted_path = persist_output_data(data, filename, job_id)
+        image_fields = {'image': persisted_path, 'path': persisted_path}
+    else:
+        image_data = base64.b64encode(data).decode('utf-8')
+        (current_encoder_memory.get() or EncoderMemory()).allocate(len(image_data))
+        image_fields = {'image': image_data}
+
+    if persist and storage != 'volume':
+        image_fields['path'] = persist_output_data(data, filename, job_id)
+
+    if strip_metadata:
+        image_fields['metadata_bytes_removed'] = 0
+
+    return image_fields
+
+
+def create_unique_filename_prefix(payload):
+    """
+    Create a unique filename prefix for each request to avoid a race condition where
+    more than one request completes at the same time, which can either result in the
+    incorrect output being returned, or the output image not being found.
+    Returns the prefixes that were created.
+    """
+    filename_prefixes = []
+
+    for key, value in payload.items():
+        class_type = value.get('class_type')
+
+        if class_type in SAVE_NODE_TYPES and 'filename_prefix' in value.get('inputs', {}):
+            filename_prefix = str(uuid.uuid4())
+            payload[key]['inputs']['filename_prefix'] = filename_prefix
+            filename_prefixes.append(filename_prefix)
+
+    return filename_prefixes
+
+
+def use_websocket_outputs(payload):
+    """
+    Replace the SaveImage nodes with websocket image nodes, which send the
+    images over the websocket instead of writing them to the output
+    directory. Returns the ids of the nodes that were replaced.
+    """
+    image_nodes = set()
+
+    for key, value in payload.items():
+        if value.get('class_type') == 'SaveImage' and 'images' in value.get('inputs', {}):
+            payload[key] = {
+                'class_type': WEBSOCKET_IMAGE_NODE,
+                'inputs': {'images': value['inputs']['images']}
+            }
+            image_nodes.add(key)
+
+    return image_nodes
+
+
+# ---------------------------------------------------------------------------- #
+#                              Workflow Validation                             #
+# ---------------------------------------------------------------------------- #
+def is_output_node(class_type, output_node_types=None):
+    if output_node_types is not None:
+        return class_type in output_node_types
+
+    return class_type in OUTPUT_NODE_TYPES or class_type.startswith(OUTPUT_NODE_PREFIXES)
+
+
+def validate_workflow_graph(workflow, output_node_types=None):
+    """
+    Check the graph of a custom workflow before it is queued, so that a broken
+    graph fails the job without ComfyUI loading any models for it. Every node
+    must have a class_type, every [node_id, slot] link must reference a node
+    of the workflow, the links must not form a cycle, and at least one node
+    must be an output node. Output nodes are recognised by the given node types
+    when the node definitions of ComfyUI are known, or by their class_type
+    otherwise. Runs in time linear in the number of nodes and links, and
+    returns a list of errors, which is empty if the graph is valid.
+    """
+    if not isinstance(workflow, dict):
+        return [{'type': 'invalid_workflow', 'message': 'Workflow must be an object of nodes keyed by node id'}]
+
+    errors = []
+    dependents = {node_id: [] for node_id in workflow}
+    indegrees = dict.fromkeys(workflow, 0)
+    has_output_node = False
+
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict) or not isinstance(node.get('class_type'), str) or not node['class_type']:
+            errors.append({
+                'type': 'missing_class_type',
+                'node_id': node_id,
+                'message': f'Node {node_id} has no class_type'
+            })
+            continue
+
+        has_output_node = has_output_node or is_output_node(node['class_type'], output_node_types)
+        inputs = node.get('inputs', {})
+
+        if not isinstance(inputs, dict):
+            errors.append({
+                'type': 'invalid_inputs',
+                'node_id': node_id,
+                'message': f'Inputs of node {node_id} must be an object'
+            })
+            continue
+
+        for name, value in inputs.items():
+            # ComfyUI treats every list input as a link to the output of another node
+            if not isinstance(value, list):
+                continue
+
+            if len(value) != 2 or not isinstance(value[0], str) or type(value[1]) is not int or value[1] < 0:
+                errors.append({
+                    'type': 'invalid_link',
+                    'node_id': node_id,
+                    'input': name,
+                    'message': f'Input {name} of node {node_id} must be a [node_id, slot] link'
+                })
+            elif value[0] not in workflow:
+                errors.append({
+                    'type': 'dangling_link',
+                    'node_id': node_id,
+                    'input': name,
+                    'message': f'Input {name} of node {node_id} links to missing node {value[0]}'
+                })
+            else:
+                dependents[value[0]].append(node_id)
+                indegrees[node_id] += 1
+
+    # Kahn's algorithm, the nodes that are never ready are in or after a cycle
+    ready = [node_id for node_id, indegree in indegrees.items() if indegree == 0]
+
+    while ready:
+        for dependent in dependents[ready.pop()]:
+            indegrees[dependent] -= 1
+
+            if indegrees[dependent] == 0:
+                ready.append(dependent)
+
+    cycle = [node_id for node_id, indegree in indegrees.items() if indegree > 0]
+
+    if cycle:
+        errors.append({
+            'type': 'cycle',
+            'node_ids': cycle,
+            'message': f'Nodes {", ".join(cycle)} are in or depend on a cycle of links'
+        })
+
+    if not has_output_node:
+        errors.append({
+            'type': 'no_output_node',
+            'message': 'Workflow has no output node, such as SaveImage'
+        })
+
+    return errors
+
+
+def get_graph_error(graph_errors, job_id):
+    for graph_error in graph_errors:
+        logging.error(graph_error['message'], job_id)
+
+    return {
+        'error': f'Invalid workflow: {graph_errors[0]["message"]}',
+        'output': graph_errors
+    }
+
+
+def get_payload_error(payload_error, job_id):
+    logging.error(f'Invalid payload: {payload_error}', job_id)
+
+    return {
+        'error': str(payload_error)
+    }
+
+
+# ---------------------------------------------------------------------------- #
+#                               Node Definitions                               #
+# ---------------------------------------------------------------------------- #
+class NodeSchemas:
+    """
+    Index of the node definitions from the /object_info of ComfyUI, used to
+    check a workflow before it is queued. Each input of a node type is indexed
+    with whether it is required, its choices, and its minimum and maximum.
+    The choices of inputs that accept uploads, such as the image of LoadImage,
+    are not indexed, because ComfyUI validates those itself.
+    """
+    def __init__(self, object_info, signature=None):
+        self.signature = signature
+        self.nodes = {}
+        self.output_node_types = set()
+
+        for class_type, node in object_info.items():
+            node_inputs = node.get('input', {})
+            self.nodes[class_type] = [
+                (name, section == 'required', *self.index_input(spec))
+                for section in ('required', 'optional')
+                for name, spec in (node_inputs.get(section) or {}).items()
+            ]
+
+            if node.get('output_node'):
+                self.output_node_types.add(class_type)
+
+    @staticmethod
+    def index_input(spec):
+        if not isinstance(spec, (list, tuple)) or not spec:
+            return None, None, None
+
+        input_type = spec[0]
+        options = spec[1] if len(spec) > 1 and isinstance(spec[1], dict) else {}
+        choices = None
+
+        if isinstance(input_type, list):
+            choices = input_type
+        elif input_type == 'COMBO':
+            choices = options.get('options')
+
+        if choices is not None and not any(key.endswith('upload') for key in options):
+            choices = frozenset(choice for choice in choices if isinstance(choice, (str, int, float)))
+        else:
+            choices = None
+
+        if input_type in ('INT', 'FLOAT'):
+            return choices, options.get('min'), options.get('max')
+
+        return choices, None, None
+
+    def get_executed_nodes(self, workflow):
+        """
+        Get the ids of the output nodes of a workflow and of the nodes that they
+        depend on through links, which are the nodes that ComfyUI executes
+        """
+        pending = [node_id for node_id, node in workflow.items() if node['class_type'] in self.output_node_types]
+        executed = set(pending)
+
+        while pending:
+            for value in workflow[pending.pop()].get('inputs', {}).values():
+                if isinstance(value, list) and value and isinstance(value[0], str) and value[0] in workflow:
+                    if value[0] not in executed:
+                        executed.add(value[0])
+                        pending.append(value[0])
+
+        return executed
+
+    def check(self, workflow):
+        """
+        Check the class_type of every node of a workflow, and the input values
+        of the nodes that ComfyUI executes, since it ignores the others, and
+        return a list of errors, which is empty if the workflow is valid
+        """
+        errors = []
+        executed = self.get_executed_nodes(workflow)
+
+        for node_id, node in workflow.items():
+            class_type = node['class_type']
+            inputs = node.get('inputs', {})
+
+            if class_type not in self.nodes:
+                errors.append({
+                    'type': 'unknown_class_type',
+                    'node_id': node_id,
+                    'message': f'Node {node_id} has an unknown class_type: {class_type}'
+                })
+                continue
+
+            if node_id not in executed:
+                continue
+
+            for name, required, choices, minimum, maximum in self.nodes[class_type]:
+                if name not in inputs:
+                    if required:
+                        errors.append({
+                            'type': 'missing_input',
+                            'node_id': node_id,
+                            'input': name,
+                            'message': f'Node {node_id} is missing the required input: {name}'
+                        })
+
+                    continue
+
+                value = inputs[name]
+
+                if choices is not None and isinstance(value, (str, int, float)) and value not in choices:
+                    errors.append({
+                        'type': 'value_not_in_choices',
+                        'node_id': node_id,
+                        'input': name,
+                        'message': f'Input {name} of node {node_id} is not one of the available choices: {value}'
+                    })
+                elif isinstance(value, (int, float)) and not isinstance(value, bool) and (
+                    (minimum is not None and value < minimum) or (maximum is not None and value > maximum)
+                ):
+                    errors.append({
+                        'type': 'value_out_of_range',
+                        'node_id': node_id,
+                        'input': name,
+                        'message': f'Input {name} of node {node_id} must be between {minimum} and {maximum}: {value}'
+                    })
+
+        return errors
+
+
+node_schemas = None
+
+
+def get_custom_nodes_signature():
+    """
+    Get the names and modification times of the custom nodes, which change
+    when a custom node is installed, removed or updated
+    """
+    try:
+        return tuple(sorted((entry.name, entry.stat().st_mtime_ns) for entry in os.scandir(CUSTOM_NODES_PATH)))
+    except OSError:
+        return None
+
+
+async def load_node_schemas(signature=None, deadline=None):
+    response = await send_get_request('object_info', deadline, OBJECT_INFO_TIMEOUT)
+
+    if response.status_code != 200:
+        raise RuntimeError(f'HTTP status code: {response.status_code}')
+
+    return NodeSchemas(response.json(), signature)
+
+
+async def get_node_schemas(deadline=None, job_id=None, refresh=False):
+    """
+    Get the cached node definitions of ComfyUI, which are loaded again when the
+    custom nodes have changed or a refresh is requested. The definitions that
+    were loaded before are kept if ComfyUI does not return them, but
+    DeadlineExceeded is raised when the job runs out of time while loading them.
+    """
+    global node_schemas
+    signature = get_custom_nodes_signature()
+
+    if refresh or node_schemas is None or node_schemas.signature != signature:
+        try:
+            node_schemas = await load_node_schemas(signature, deadline)
+            logging.info(f'Loaded {len(node_schemas.nodes)} node definitions from ComfyUI', job_id)
+        except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError, ValueError) as e:
+            logging.warning(f'Unable to load the node definitions from ComfyUI: {e}', job_id)
+
+    return node_schemas
+
+
+async def preload_node_schemas():
+    """
+    Load the node definitions when the worker starts, from an event loop of
+    its own, so the HTTP session is closed before the handler creates its own
+    """
+    try:
+        await get_node_schemas()
+    finally:
+        await get_http_session().close()
+
+
+def get_output_node_types():
+    return node_schemas.output_node_types if node_schemas is not None else None
+
+
+async def preflight_workflow(workflow, deadline, job_id):
+    """
+    Check a workflow against the node definitions of ComfyUI before it is
+    queued, so that an unknown class_type, a missing required input, an out
+    of range value or a model that is not installed fails the job with a clear
+    error instead of an execution error. The workflow is not checked when the
+    node definitions are not available.
+    """
+    schemas = await get_node_schemas(deadline, job_id)
+
+    if schemas is None:
+        return []
+
+    errors = schemas.check(workflow)
+
+    # Models and custom nodes may have been added since the definitions were
+    # loaded, so they are loaded again before the workflow is rejected
+    if any(error['type'] in ('unknown_class_type', 'value_not_in_choices') for error in errors):
+        errors = (await get_node_schemas(deadline, job_id, refresh=True)).check(workflow)
+
+    return errors
+
+
+# ---------------------------------------------------------------------------- #
+#                                 Input Images                                 #
+# ---------------------------------------------------------------------------- #
+# The jobs that added input images to the input store, which is cleaned
+# when they finish
+input_store_jobs = set()
+input_store_tasks = set()
+
+
+class InputCache:
+    """
+    Content-addressed disk cache of the input images fetched from URLs, so that
+    an input that is reused by later jobs on a warm worker is not downloaded
+    again. The least recently used files are evicted once the cache is larger
+    than its budget in bytes.
+    """
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.digests = {}
+        self.files = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def file_path(self, digest):
+        return os.path.join(self.path, digest)
+
+    def get(self, url):
+        with self.lock:
+            digest = self.digests.get(url)
+
+            if digest not in self.files:
+                return None
+
+            self.files.move_to_end(digest)
+
+        try:
+            with open(self.file_path(digest), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, url, data):
+        digest = hashlib.sha256(data).hexdigest()
+
+        with self.lock:
+            if digest not in self.files:
+                os.makedirs(self.path, exist_ok=True)
+                temp_path = f'{self.file_path(digest)}.{uuid.uuid4()}.tmp'
+
+                with open(temp_path, 'wb') as f:
+                    f.write(data)
+
+                os.replace(temp_path, self.file_path(digest))
+                self.files[digest] = len(data)
+                self.size += len(data)
+
+            self.files.move_to_end(digest)
+            self.digests[url] = digest
+            self.evict()
+
+        return digest
+
+    def evict(self):
+        while self.size > self.max_bytes and self.files:
+            digest, size = self.files.popitem(last=False)
+            self.size -= size
+            self.digests = {url: value for url, value in self.digests.items() if value != digest}
+
+            try:
+                os.remove(self.file_path(digest))
+            except OSError:
+                pass
+
+
+input_cache = InputCache(INPUT_CACHE_PATH, INPUT_CACHE_SIZE)
+
+
+def decode_input_image(input_image):
+    """
+    Decode the base64 data of an input image, with or without a data URI prefix
+    """
+    if not isinstance(input_image, dict) or not input_image.get('name') or not input_image.get('image'):
+        raise ValueError('Each input image must have a name and either a base64 encoded image or a url')
+
+    image = input_image['image']
+
+    if image.startswith('data:'):
+        image = image.split(',', 1)[-1]
+
+    try:
+        return base64.b64decode(image, validate=True)
+    except ValueError as e:
+        raise ValueError(f'Input image {input_image["name"]} is not valid base64: {e}')
+
+
+async def fetch_input_image(url, deadline, job_id):
+    """
+    Fetch an input image with the pooled HTTP session, or get it from the input
+    cache if the URL has been fetched before. Images that are larger than
+    INPUT_MAX_SIZE are rejected without being downloaded in full.
+    """
+    if not url.startswith(('http://', 'https://')):
+        raise ValueError(f'Input image url must be http or https: {url}')
+
+    data = input_cache.get(url)
+
+    if data is not None:
+        logging.info(f'Input image cache hit: {url}', job_id)
+        return data
+
+    timeout = INPUT_FETCH_TIMEOUT if deadline is None else deadline.timeout(INPUT_FETCH_TIMEOUT)
+
+    async with get_http_session().get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+        if response.status != 200:
+            raise RuntimeError(f'Failed to fetch input image {url}: HTTP status code {response.status}')
+
+        if (response.content_length or 0) > INPUT_MAX_SIZE:
+            raise ValueError(f'Input image {url} is larger than {INPUT_MAX_SIZE} bytes')
+
+        data = bytearray()
+
+        async for chunk in response.content.iter_chunked(HASH_CHUNK_SIZE):
+            data += chunk
+
+            if len(data) > INPUT_MAX_SIZE:
+                raise ValueError(f'Input image {url} is larger than {INPUT_MAX_SIZE} bytes')
+
+    data = bytes(data)
+    await asyncio.to_thread(input_cache.put, url, data)
+    logging.info(f'Fetched input image: {url} ({len(data)} bytes)', job_id)
+    return data
+
+
+async def load_input_images(input_images, deadline, job_id):
+    """
+    Get the data of the input images of a job, decoding the base64 images and
+    fetching the images given by url concurrently, with each url fetched once.
+    Returns a list of (input image, data) tuples.
+    """
+    urls = {}
+
+    for input_image in input_images:
+        if isinstance(input_image, dict) and input_image.get('name') and input_image.get('url'):
+            urls.setdefault(input_image['url'], None)
+
+    fetched = await asyncio.gather(*(fetch_input_image(url, deadline, job_id) for url in urls))
+    urls = dict(zip(urls, fetched))
+
+    return [
+        (input_image, urls[input_image['url']] if input_image.get('url') in urls else decode_input_image(input_image))
+        for input_image in input_images
+    ]
+
+
+def start_loading_input_images(job_input, deadline, job_id):
+    """
+    Start loading the input images of a job in the background, so that fetching
+    them overlaps with preparing the workflow and connecting to ComfyUI
+    """
+    if not job_input['images']:
+        return None
+
+    return asyncio.create_task(load_input_images(job_input['images'], deadline, job_id))
+
+
+def get_input_store_name(input_image, data, uploaded):
+    """
+    Get the name of an input image in the input store from the hash of its
+    content. A mask is stored applied to the image that it masks, so its name
+    also depends on the stored name of that image.
+    """
+    digest = hashlib.sha256()
+
+    if input_image.get('type') == 'mask':
+        digest.update(os.path.basename(uploaded[input_image['original']]).encode('utf-8'))
+        extension = '.png'
+    else:
+        extension = os.path.splitext(input_image['name'])[1].lower() or '.png'
+
+    digest.update(data)
+    return f'{digest.hexdigest()}{extension}'
+
+
+def use_stored_input(filename):
+    """
+    Mark a file in the input store as used, returning False if it is not stored
+    """
+    try:
+        os.utime(f'{INPUT_PATH}/{INPUT_STORE_SUBFOLDER}/{filename}')
+        return True
+    except OSError:
+        return False
+
+
+async def upload_input_image(input_image, data, uploaded, deadline, job_id):
+    """
+    Upload an input image to the input store, or a mask to /upload/mask, which
+    applies it to the alpha channel of the image that it masks. The upload is
+    skipped when the same content is already stored. Returns the stored path
+    of the image relative to the input directory, and whether it was stored.
+    """
+    if input_image.get('type') == 'mask' and input_image.get('original') not in uploaded:
+        raise ValueError(f'Mask {input_image["name"]} must reference an uploaded input image')
+
+    filename = get_input_store_name(input_image, data, uploaded)
+
+    if use_stored_input(filename):
+        logging.info(f'Input image already stored: {input_image["name"]}', job_id)
+        return f'{INPUT_STORE_SUBFOLDER}/{filename}', True
+
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    form = {
+        'image': (filename, data, content_type),
+        'type': 'input',
+        'subfolder': INPUT_STORE_SUBFOLDER,
+        'overwrite': 'true'
+    }
+
+    if input_image.get('type') == 'mask':
+        endpoint = 'upload/mask'
+        form['original_ref'] = json.dumps({
+            'filename': os.path.basename(uploaded[input_image['original']]),
+            'subfolder': INPUT_STORE_SUBFOLDER,
+            'type': 'input'
+        })
+    else:
+        endpoint = 'upload/image'
+
+    response = await send_form_request(endpoint, form, deadline)
+
+    if response.status_code != 200:
+        raise RuntimeError(f'Failed to upload input image {input_image["name"]}: {response.content}')
+
+    logging.info(f'Uploaded input image: {input_image["name"]}', job_id)
+    return f'{INPUT_STORE_SUBFOLDER}/{response.json()["name"]}', False
+
+
+async def upload_input_images(images, payload, deadline, job_id):
+    """
+    Upload the loaded input images of a job concurrently into the input store,
+    and rewrite the node inputs that reference an input image by name, such as
+    the image of a LoadImage node, to the stored file. Masks are uploaded after
+    the images that they mask. Returns the stored path of each input image and
+    the number of input images that were already stored.
+    """
+    uploaded = {}
+    hits = 0
+
+    masks = [image for image in images if image[0].get('type') == 'mask']
+    images = [image for image in images if image[0].get('type') != 'mask']
+
+    for batch in (images, masks):
+        results = await asyncio.gather(*(
+            upload_input_image(input_image, data, uploaded, deadline, job_id)
+            for input_image, data in batch
+        ))
+
+        for (input_image, data), (name, stored) in zip(batch, results):
+            uploaded[input_image['name']] = name
+            hits += stored
+
+    if hits < len(uploaded):
+        input_store_jobs.add(job_id)
+
+    for node in payload.values():
+        inputs = node.get('inputs', {})
+
+        for key, value in inputs.items():
+            if isinstance(value, str) and value in uploaded:
+                inputs[key] = uploaded[value]
+
+    return uploaded, hits
+
+
+def get_input_metrics(images, hits):
+    return {
+        'input_images': len(images),
+        'input_store_hits': hits,
+        'input_store_hit_ratio': hits / len(images)
+    }
+
+
+def clean_input_store(job_id=None):
+    """
+    Delete the least recently used files of the input store until it fits in
+    INPUT_STORE_SIZE bytes. Files used within the last JOB_TIMEOUT seconds are
+    kept, because a job on this or another worker sharing the Network Volume
+    may still be using them. Returns the number of files deleted.
+    """
+    store_path = f'{INPUT_PATH}/{INPUT_STORE_SUBFOLDER}'
+
+    try:
+        entries = []
+
+        for entry in os.scandir(store_path):
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    except OSError:
+        return 0
+
+    size = sum(entry[1] for entry in entries)
+    used_after = time.time() - JOB_TIMEOUT
+    removed = 0
+
+    for mtime, file_size, path in sorted(entries):
+        if size <= INPUT_STORE_SIZE or mtime > used_after:
+            break
+
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+
+        size -= file_size
+        removed += 1
+
+    if removed:
+        logging.info(f'Deleted {removed} least recently used input images, input store size: {size} bytes', job_id)
+
+    return removed
+
+
+# ---------------------------------------------------------------------------- #
+#                                Output Storage                                #
+# ---------------------------------------------------------------------------- #
+s3_client = None
+
+
+def is_bucket_configured():
+    return bool(BUCKET_NAME and BUCKET_ACCESS_KEY_ID and BUCKET_SECRET_ACCESS_KEY)
+
+
+def get_s3_client():
+    """
+    Get the client for the S3-compatible bucket that outputs are uploaded to.
+    BUCKET_ENDPOINT_URL is only needed for storage other than AWS, such as
+    Cloudflare R2, Backblaze B2 or MinIO.
+    """
+    global s3_client
+
+    if s3_client is None:
+        s3_client = boto3.client(
+            's3',
+            endpoint_url=BUCKET_ENDPOINT_URL,
+            region_name=BUCKET_REGION,
+            aws_access_key_id=BUCKET_ACCESS_KEY_ID,
+            aws_secret_access_key=BUCKET_SECRET_ACCESS_KEY
+        )
+
+    return s3_client
+
+
+def get_content_key(fileobj, filename):
+    """
+    Get a content-addressed key for a file, so that identical outputs are
+    stored only once
+    """
+    digest = hashlib.sha256()
+
+    for chunk in iter(lambda: fileobj.read(HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+
+    fileobj.seek(0)
+    extension = os.path.splitext(filename)[1].lower()
+    return f'{BUCKET_KEY_PREFIX}/{digest.hexdigest()}{extension}'
+
+
+def bucket_has_key(client, key):
+    try:
+        client.head_object(Bucket=BUCKET_NAME, Key=key)
+        return True
+    except botocore.exceptions.ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+
+        raise
+
+
+def upload_output_file(file_path, job_id):
+    with open(file_path, 'rb') as f:
+        return upload_output_fileobj(f, os.path.basename(file_path), job_id)
+
+
+def upload_output_fileobj(fileobj, filename, job_id):
+    """
+    Upload an output file to the bucket, unless a file with the same content
+    was already uploaded. Files larger than BUCKET_MULTIPART_THRESHOLD are
+    uploaded in parts in parallel. Returns a presigned URL and the key.
+    """
+    client = get_s3_client()
+    key = get_content_key(fileobj, filename)
+
+    if bucket_has_key(client, key):
+        logging.info(f'Output file already uploaded: {key}', job_id)
+    else:
+        content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+        client.upload_fileobj(
+            fileobj,
+            BUCKET_NAME,
+            key,
+            ExtraArgs={'ContentType': content_type},
+            Config=TransferConfig(
+                multipart_threshold=BUCKET_MULTIPART_THRESHOLD,
+                multipart_chunksize=BUCKET_MULTIPART_CHUNKSIZE,
+                max_concurrency=BUCKET_MULTIPART_CONCURRENCY
+            )
+        )
+        logging.info(f'Output file uploaded: {key}', job_id)
+
+    url = client.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': BUCKET_NAME, 'Key': key},
+        ExpiresIn=BUCKET_URL_EXPIRY
+    )
+
+    return {'image': url, 'key': key}
+
+
+# ---------------------------------------------------------------------------- #
+#                                 Cancellation                                 #
+# ---------------------------------------------------------------------------- #
+# Prompts queued by jobs that are still in progress, with the job id and the
+# filename prefixes of the outputs that the prompt saves
+active_prompts = {}
+
+
+def delete_partial_outputs(filename_prefixes, job_id=None):
+    for filename_prefix in filename_prefixes:
+        for output_path in glob.glob(f'{OUTPUT_PATH}/{filename_prefix}_*'):
+            logging.info(f'Deleting partial output file: {output_path}', job_id)
+
+            try:
+                os.remove(output_path)
+            except Exception as e:
+                logging.error(f'Error deleting partial output file {output_path}: {e}', job_id)
+
+
+async def cancel_prompt(prompt_id, job_id=None):
+    """
+    Stop a prompt whose job was cancelled or ran out of time, so that it does
+    not keep the GPU busy for the next job. A running prompt is interrupted,
+    a pending prompt is deleted from the queue, and any outputs it already
+    saved are deleted.
+    """
+    try:
+        queue = (await send_get_request('queue', timeout=CANCEL_TIMEOUT)).json()
+
+        if any(item[1] == prompt_id for item in queue.get('queue_running', [])):
+            logging.info(f'Interrupting running prompt: {prompt_id}', job_id)
+            await send_post_request('interrupt', {'prompt_id': prompt_id}, timeout=CANCEL_TIMEOUT)
+        elif any(item[1] == prompt_id for item in queue.get('queue_pending', [])):
+            logging.info(f'Deleting pending prompt from queue: {prompt_id}', job_id)
+            await send_post_request('queue', {'delete': [prompt_id]}, timeout=CANCEL_TIMEOUT)
+    except Exception as e:
+        logging.warning(f'Failed to cancel prompt {prompt_id}: {e}', job_id)
+
+    active_prompt = active_prompts.pop(prompt_id, None)
+
+    if active_prompt is not None:
+        await asyncio.to_thread(delete_partial_outputs, active_prompt['filename_prefixes'], job_id)
+
+
+def cancel_active_prompts():
+    """
+    Cancel the prompts of jobs that were still in progress when the worker
+    shut down. Registered to run at exit.
+    """
+    if not active_prompts:
+        return
+
+    async def cancel_all():
+        for prompt_id, active_prompt in list(active_prompts.items()):
+            await cancel_prompt(prompt_id, active_prompt['job_id'])
+
+        await get_http_session().close()
+
+    asyncio.run(cancel_all())
+
+
+# ---------------------------------------------------------------------------- #
+#                                Queue Admission                               #
+# ---------------------------------------------------------------------------- #
+# Websocket client ids of the jobs in progress, used to recognise prompts
+# that were queued by this worker before their prompt id is known
+active_client_ids = set()
+
+
+def is_owned_prompt(queue_item):
+    prompt_id = queue_item[1]
+    extra_data = queue_item[3] if len(queue_item) > 3 else {}
+
+    return prompt_id in active_prompts or extra_data.get('client_id') in active_client_ids
+
+
+async def check_queue_admission(deadline, job_id):
+    """
+    Check the ComfyUI queue before submitting a prompt. Prompts that were not
+    queued by this worker, for example orphans left behind by a crash and
+    retry, are purged when QUEUE_ADMISSION is 'purge' and only reported
+    otherwise. Returns the number of prompts ahead of the new prompt.
+    """
+    try:
+        queue = (await send_get_request('queue', deadline, STATS_TIMEOUT)).json()
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        logging.warning(f'Failed to check ComfyUI queue: {e}', job_id)
+        return None
+
+    running = queue.get('queue_running', [])
+    pending = queue.get('queue_pending', [])
+    stale_running = [item[1] for item in running if not is_owned_prompt(item)]
+    stale_pending = [item[1] for item in pending if not is_owned_prompt(item)]
+    queue_depth = len(running) + len(pending)
+
+    if not stale_running and not stale_pending:
+        return queue_depth
 
-        time.sleep(0.2)
+    if QUEUE_ADMISSION != 'purge':
+        logging.warning(f'ComfyUI queue contains {len(stale_running) + len(stale_pending)} prompts not owned by this worker', job_id)
+        return queue_depth
+
+    try:
+        if stale_pending:
+            logging.warning(f'Purging stale pending prompts: {", ".join(stale_pending)}', job_id)
+            await send_post_request('queue', {'delete': stale_pending}, deadline, CANCEL_TIMEOUT)
+
+        for prompt_id in stale_running:
+            logging.warning(f'Interrupting stale running prompt: {prompt_id}', job_id)
+            await send_post_request('interrupt', {'prompt_id': prompt_id}, deadline, CANCEL_TIMEOUT)
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        logging.warning(f'Failed to purge stale prompts: {e}', job_id)
+        return queue_depth
 
+    return queue_depth - len(stale_running) - len(stale_pending)
 
-def send_get_request(endpoint):
-    return session.get(
-        url=f'{BASE_URI}/{endpoint}',
-        timeout=TIMEOUT
-    )
 
+def get_prompt_timings(history, queued_at):
+    """
+    Split the time taken by a prompt into the time it waited in the ComfyUI
+    queue and the time it took to execute, using the timestamps of the
+    execution messages in its history.
+    """
+    timestamps = {}
+
+    for key, value in history['status'].get('messages', []):
+        if isinstance(value, dict) and 'timestamp' in value:
+            timestamps[key] = value['timestamp'] / 1000
 
-def send_post_request(endpoint, payload):
-    return session.post(
-        url=f'{BASE_URI}/{endpoint}',
-        json=payload,
-        timeout=TIMEOUT
+    started_at = timestamps.get('execution_start')
+    finished_at = (
+        timestamps.get('execution_success') or
+        timestamps.get('execution_error') or
+        timestamps.get('execution_interrupted')
     )
+    timings = {}
 
+    if started_at is not None:
+        timings['queue_wait'] = round(max(0.0, started_at - queued_at), 3)
 
-def get_txt2img_payload(workflow, payload):
-    workflow["3"]["inputs"]["seed"] = payload["seed"]
-    workflow["3"]["inputs"]["steps"] = payload["steps"]
-    workflow["3"]["inputs"]["cfg"] = payload["cfg_scale"]
-    workflow["3"]["inputs"]["sampler_name"] = payload["sampler_name"]
-    workflow["4"]["inputs"]["ckpt_name"] = payload["ckpt_name"]
-    workflow["5"]["inputs"]["batch_size"] = payload["batch_size"]
-    workflow["5"]["inputs"]["width"] = payload["width"]
-    workflow["5"]["inputs"]["height"] = payload["height"]
-    workflow["6"]["inputs"]["text"] = payload["prompt"]
-    workflow["7"]["inputs"]["text"] = payload["negative_prompt"]
-    return workflow
+        if finished_at is not None:
+            timings['execution_time'] = round(finished_at - started_at, 3)
 
+    return timings
 
-def get_img2img_payload(workflow, payload):
-    workflow["13"]["inputs"]["seed"] = payload["seed"]
-    workflow["13"]["inputs"]["steps"] = payload["steps"]
-    workflow["13"]["inputs"]["cfg"] = payload["cfg_scale"]
-    workflow["13"]["inputs"]["sampler_name"] = payload["sampler_name"]
-    workflow["13"]["inputs"]["scheduler"] = payload["scheduler"]
-    workflow["13"]["inputs"]["denoise"] = payload["denoise"]
-    workflow["1"]["inputs"]["ckpt_name"] = payload["ckpt_name"]
-    workflow["2"]["inputs"]["width"] = payload["width"]
-    workflow["2"]["inputs"]["height"] = payload["height"]
-    workflow["2"]["inputs"]["target_width"] = payload["width"]
-    workflow["2"]["inputs"]["target_height"] = payload["height"]
-    workflow["4"]["inputs"]["width"] = payload["width"]
-    workflow["4"]["inputs"]["height"] = payload["height"]
-    workflow["4"]["inputs"]["target_width"] = payload["width"]
-    workflow["4"]["inputs"]["target_height"] = payload["height"]
-    workflow["6"]["inputs"]["text"] = payload["prompt"]
-    workflow["7"]["inputs"]["text"] = payload["negative_prompt"]
-    return workflow
 
+# ---------------------------------------------------------------------------- #
+#                                  Concurrency                                 #
+# ---------------------------------------------------------------------------- #
+# Ids of the jobs currently being handled by this worker
+active_jobs = set()
 
-def get_workflow_payload(workflow_name, payload):
-    with open(f'/workflows/{workflow_name}.json', 'r') as json_file:
-        workflow = json.load(json_file)
+# Most recent VRAM and queue statistics reported by ComfyUI
+comfyui_stats = {}
+stats_refresh_tasks = set()
 
-    if workflow_name == 'txt2img':
-        workflow = get_txt2img_payload(workflow, payload)
 
-    return workflow
+async def refresh_comfyui_stats(deadline=None):
+    """
+    Refresh the cached VRAM and queue statistics that the concurrency
+    modifier uses, since the modifier itself has to be synchronous and cheap.
+    """
+    try:
+        system_stats = (await send_get_request('system_stats', deadline, STATS_TIMEOUT)).json()
+        queue = (await send_get_request('queue', deadline, STATS_TIMEOUT)).json()
+        devices = system_stats.get('devices') or [{}]
+
+        comfyui_stats.update({
+            'vram_total': devices[0].get('vram_total'),
+            'vram_free': devices[0].get('vram_free'),
+            'queue_running': len(queue.get('queue_running', [])),
+            'queue_pending': len(queue.get('queue_pending', [])),
+            'queue_foreign': len([
+                item for item in queue.get('queue_running', []) + queue.get('queue_pending', [])
+                if not is_owned_prompt(item)
+            ])
+        })
+    except Exception as e:
+        logging.warning(f'Failed to refresh ComfyUI stats: {e}')
 
 
-def get_output_images(output):
+def get_concurrency_target():
     """
-    Get the output images
+    Get the concurrency level that the cached stats call for: MAX_CONCURRENCY
+    while ComfyUI has VRAM headroom and no backlog of prompts from elsewhere,
+    otherwise 1. The target only depends on the stats, so it stays stable
+    between stats refreshes.
     """
-    images = []
+    vram_total = comfyui_stats.get('vram_total')
+    vram_free = comfyui_stats.get('vram_free')
 
-    for key, value in output.items():
-        if 'images' in value and isinstance(value['images'], list):
-            images.append(value['images'][0])
+    if vram_total and vram_free is not None and vram_free / vram_total < CONCURRENCY_MIN_FREE_VRAM:
+        return 1
 
-    return images
+    if comfyui_stats.get('queue_foreign', 0) >= CONCURRENCY_MAX_QUEUED:
+        return 1
 
+    return MAX_CONCURRENCY
 
 
-def create_unique_filename_prefix(payload):
+def concurrency_modifier(current_concurrency):
     """
-    Create a unique filename prefix for each request to avoid a race condition where
-    more than one request completes at the same time, which can either result in the
-    incorrect output being returned, or the output image not being found.
+    Decide how many jobs this worker takes at once. Concurrency is opt-in via
+    MAX_CONCURRENCY. Runpod waits for all jobs in progress to finish whenever
+    the returned value changes, so the current concurrency is kept until the
+    target level itself changes.
     """
-    for key, value in payload.items():
-        class_type = value.get('class_type')
+    if MAX_CONCURRENCY <= 1:
+        return 1
 
-        if class_type == 'SaveImage':
-            payload[key]['inputs']['filename_prefix'] = str(uuid.uuid4())
+    target = get_concurrency_target()
+
+    if target != current_concurrency:
+        logging.info(f'Changing concurrency from {current_concurrency} to {target}')
+
+    return target
 
 
 # ---------------------------------------------------------------------------- #
@@ -531,25 +2604,441 @@ def get_container_disk_info(job_id=None):
 # ---------------------------------------------------------------------------- #
 #                                Runpod Handler                                #
 # ---------------------------------------------------------------------------- #
-def handler(event):
-    job_id = event['id']
-    os.environ['RUNPOD_JOB_ID'] = job_id
+def check_container_resources(job_id):
+    memory_info = get_container_memory_info(job_id)
+    cpu_info = get_container_cpu_info(job_id)
+    disk_info = get_container_disk_info(job_id)
+
+    memory_available_gb = memory_info.get('available')
+    disk_free_bytes = disk_info.get('free_bytes')
+
+    if memory_available_gb is not None and memory_available_gb < 0.5:
+        raise Exception(f'Insufficient available container memory: {memory_available_gb:.2f} GB available (minimum 0.5 GB required)')
+
+    if disk_free_bytes is not None and disk_free_bytes < DISK_MIN_FREE_BYTES:
+        free_gb = disk_free_bytes / (1024**3)
+        raise Exception(f'Insufficient free container disk space: {free_gb:.2f} GB available (minimum 0.5 GB required)')
+
+
+def prepare_workflow(workflow_name, payload, job_id):
+    if workflow_name == 'default':
+        workflow_name = 'txt2img'
+
+    logging.info(f'Workflow: {workflow_name}', job_id)
+
+    # The input validation skips the constraints of values with the type of the default
+    if workflow_name != 'custom' and workflow_name not in WORKFLOWS:
+        raise PayloadError(f'Unknown workflow: {workflow_name}')
+
+    if workflow_name != 'custom':
+        try:
+            payload = get_workflow_payload(workflow_name, payload)
+        except Exception as e:
+            logging.error(f'Unable to load workflow payload for: {workflow_name}', job_id)
+            raise
+
+    filename_prefixes = create_unique_filename_prefix(payload)
+    return workflow_name, payload, filename_prefixes
+
+
+async def queue_prompt(payload, client_id, deadline, job_id):
+    logging.debug('Queuing prompt', job_id)
+
+    return await send_post_request(
+        'prompt',
+        {
+            'prompt': payload,
+            'client_id': client_id
+        },
+        deadline
+    )
+
+
+def get_queue_error(queue_response, job_id):
+    try:
+        queue_response_content = queue_response.json()
+    except Exception as e:
+        queue_response_content = str(queue_response.content)
+
+    logging.error(f'HTTP Status code: {queue_response.status_code}', job_id)
+    logging.error(queue_response_content, job_id)
+
+    return {
+        'error': f'HTTP status code: {queue_response.status_code}',
+        'output': queue_response_content
+    }
+
+
+async def wait_for_prompt(prompt_id, listener, workflow_name, deadline, job_id):
+    """
+    Wait for the prompt to finish and return its history entry.
+    """
+    # Wait for the websocket to report completion, the history endpoint
+    # is then only polled if the websocket is not available or drops
+    finished = await listener.wait(prompt_id, timeout=deadline.remaining())
+
+    if finished:
+        logging.info(f'Prompt finished executing: {prompt_id}', job_id)
+
+    expected_runtime = get_expected_runtime(workflow_name)
+    retries = 0
+
+    while True:
+        # Only log every 15 retries so the logs don't get spammed
+        if retries == 0 or retries % 15 == 0:
+            logging.info(f'Getting status of prompt: {prompt_id}', job_id)
+
+        r = await send_get_request(f'history/{prompt_id}', deadline)
+        resp_json = r.json()
+
+        if r.status_code == 200 and len(resp_json):
+            return resp_json[prompt_id]
+
+        deadline.check(f'waiting for prompt {prompt_id} to complete')
+
+        # ComfyUI reports completion on the websocket slightly before the history
+        # is written, so a finished prompt is retried quickly instead of backing off
+        if finished:
+            poll_interval = POLL_INTERVAL_MIN
+        else:
+            poll_interval = get_poll_interval(retries, deadline.elapsed(), expected_runtime)
+
+        await asyncio.sleep(min(poll_interval, deadline.remaining()))
+        retries += 1
+
+
+def check_prompt_status(prompt_id, history, job_id):
+    """
+    Raise an error if the prompt did not process successfully.
+    """
+    status = history['status']
+
+    if status['status_str'] == 'success' and status['completed']:
+        return
+
+    error_msg = f'Job did not process successfully for prompt_id: {prompt_id}'
+
+    for message in status['messages']:
+        key, value = message
+
+        if key == 'execution_error':
+            if 'node_type' in value and 'exception_message' in value:
+                node_type = value['node_type']
+                exception_message = value['exception_message']
+                raise RuntimeError(f'{node_type}: {exception_message}')
+            else:
+                break
+
+    # Log to file instead of Runpod because the output tends to be too verbose
+    # and gets dropped by Runpod logging
+    logging.error(error_msg, job_id)
+    logging.info(f'{job_id}: Response JSON: {history}', job_id)
+    raise RuntimeError(error_msg)
+
+
+output_pool = None
+
+
+def get_output_pool():
+    """
+    Get the thread pool that output files are read, transcoded, encoded and
+    uploaded in. The pool is shared by all jobs, so that the number of output
+    files that are processed at once is bounded by OUTPUT_WORKERS.
+    """
+    global output_pool
+
+    if output_pool is None:
+        output_pool = ThreadPoolExecutor(max_workers=OUTPUT_WORKERS, thread_name_prefix='output')
+
+    return output_pool
+
+
+def run_in_pool(pool, func, *args):
+    # Run in the pool with the context of the current task, like asyncio.to_thread()
+    context = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(pool, functools.partial(context.run, func, *args))
+
+
+def get_encode_flags(output_images, max_images):
+    """
+    Get whether each output image is encoded, which is every output and
+    websocket image up to max_images
+    """
+    encode_count = 0
+    encode_flags = []
+
+    for output_image in output_images:
+        encode = output_image['type'] in ('output', 'websocket') and (
+            max_images is None or encode_count < max_images
+        )
+        encode_count += encode
+        encode_flags.append(encode)
+
+    return encode_flags
+
+
+async def prepare_output_images(
+    output_images, job_id, max_images=None, output_options=None, persist=False, strip_metadata=False
+):
+    """
+    Prepare the output images that will be encoded concurrently in the output
+    pool, so that the size of the response is estimated from the transcoded
+    images rather than the PNGs saved by ComfyUI
+    """
+    if output_options is None and not strip_metadata:
+        return output_images
+
+    async def prepare(output_image, encode):
+        if not encode:
+            return output_image
+
+        return await run_in_pool(
+            get_output_pool(), prepare_output_image, output_image, job_id, output_options, strip_metadata
+        )
+
+    return list(await asyncio.gather(*(
+        prepare(output_image, encode)
+        for output_image, encode in zip(output_images, get_encode_flags(output_images, max_images))
+    )))
+
+
+async def encode_output_images(
+    output_images, job_id, max_images=None, storage='base64', output_options=None, persist=False,
+    strip_metadata=False
+):
+    """
+    Encode or upload the output images, tagged with their node id and batch
+    index. Output images beyond max_images are deleted from disk without being
+    encoded. The images are processed concurrently in the output pool, and
+    returned in the order of output_images.
+    """
+    jobs = []
+
+    for output_image, encode in zip(output_images, get_encode_flags(output_images, max_images)):
+        process = process_websocket_image if output_image['type'] == 'websocket' else process_output_image
+        jobs.append((
+            process, output_image, job_id, encode, storage, output_options, persist, strip_metadata
+        ))
+
+    results = await asyncio.gather(*(run_in_pool(get_output_pool(), *job) for job in jobs))
+    images = []
+
+    for output_image, image_fields in zip(output_images, results):
+        if image_fields is not None:
+            images.append({
+                'node_id': output_image.get('node_id'),
+                'batch_index': output_image.get('batch_index'),
+                'kind': output_image.get('kind', 'images'),
+                **image_fields
+            })
+
+    return images
+
+
+def release_streamed_image(image, storage, encoder_memory):
+    # Streamed images are handed to Runpod as soon as they are yielded
+    if storage == 'base64':
+        encoder_memory.release(len(image['image']))
+
+
+def get_remaining_images(max_images, encoded):
+    if max_images is None:
+        return None
+
+    return max(max_images - encoded, 0)
+
+
+async def free_memory(job_id, deadline):
+    # Unload models and free memory after each request to prevent
+    # "Allocation on device" errors from lazy model loading, unless
+    # other jobs are still using the models
+    if active_jobs != {job_id}:
+        logging.info('Other jobs are in progress, not unloading models', job_id)
+        return
 
     try:
-        memory_info = get_container_memory_info(job_id)
-        cpu_info = get_container_cpu_info(job_id)
-        disk_info = get_container_disk_info(job_id)
+        await send_post_request(
+            'free',
+            {'unload_models': True, 'free_memory': True},
+            deadline,
+            FREE_TIMEOUT
+        )
+        logging.info('Models unloaded and memory freed', job_id)
+    except Exception as e:
+        logging.warning(f'Failed to free memory: {e}', job_id)
+
+
+def is_memory_low(job_id):
+    memory_info = get_container_memory_info(job_id)
+    memory_available_gb = memory_info.get('available')
 
-        memory_available_gb = memory_info.get('available')
-        disk_free_bytes = disk_info.get('free_bytes')
+    if memory_available_gb is not None and memory_available_gb < 1.0:
+        logging.info(f'Low memory detected: {memory_available_gb:.2f} GB available, refreshing worker', job_id)
+        return True
 
-        if memory_available_gb is not None and memory_available_gb < 0.5:
-            raise Exception(f'Insufficient available container memory: {memory_available_gb:.2f} GB available (minimum 0.5 GB required)')
+    return False
 
-        if disk_free_bytes is not None and disk_free_bytes < DISK_MIN_FREE_BYTES:
-            free_gb = disk_free_bytes / (1024**3)
-            raise Exception(f'Insufficient free container disk space: {free_gb:.2f} GB available (minimum 0.5 GB required)')
 
+def get_output_options(job_input):
+    """
+    Get the transcoding options of the request, or None when the images are
+    returned as the lossless PNGs saved by ComfyUI
+    """
+    output_format = job_input['output_format'] or 'png'
+
+    if output_format == 'png' and not job_input['max_dimension']:
+        return None
+
+    if not features.check(OUTPUT_FORMATS[output_format]['feature']):
+        raise ValueError(f'Output format {output_format} is not supported by this worker')
+
+    return {
+        'format': output_format,
+        'quality': job_input['output_quality'] or OUTPUT_QUALITY,
+        'max_dimension': job_input['max_dimension']
+    }
+
+
+def enable_websocket_outputs(listener, payload, job_id):
+    # The images would be lost without a websocket, so they are saved to disk instead
+    if not listener.connected:
+        logging.warning('ComfyUI websocket is not connected, saving outputs to disk instead', job_id)
+        return
+
+    listener.image_nodes = use_websocket_outputs(payload)
+    logging.info(f'Receiving images over the websocket from nodes: {sorted(listener.image_nodes)}', job_id)
+
+
+def get_websocket_images(listener, prompt_id):
+    if listener.image_nodes and listener.dropped:
+        raise RuntimeError(f'ComfyUI websocket dropped before the images of prompt {prompt_id} were received')
+
+    return listener.pop_images()
+
+
+def get_encode_options(job_input):
+    return {
+        'output_options': get_output_options(job_input),
+        'persist': job_input['persist_outputs'],
+        'strip_metadata': job_input['strip_metadata']
+    }
+
+
+def get_output_storage(job_input):
+    storage = job_input['output_storage'] or OUTPUT_STORAGE
+
+    if storage == 's3' and not is_bucket_configured():
+        raise ValueError(
+            'Output storage s3 requires BUCKET_NAME, BUCKET_ACCESS_KEY_ID and BUCKET_SECRET_ACCESS_KEY to be set'
+        )
+
+    return storage
+
+
+def estimate_response_size(output_images, max_images):
+    """
+    Estimate the size of the base64 encoded output images from the size of
+    the prepared files on disk, or of the images received over the websocket,
+    before they are encoded
+    """
+    response_size = 0
+    encode_count = 0
+
+    for output_image in output_images:
+        if output_image['type'] == 'websocket':
+            image_size = len(output_image['data'])
+        elif output_image['type'] == 'output' and os.path.exists(get_prepared_file_path(output_image)):
+            image_size = os.path.getsize(get_prepared_file_path(output_image))
+        else:
+            continue
+
+        if max_images is not None and encode_count >= max_images:
+            break
+
+        response_size += (image_size + 2) // 3 * 4
+        encode_count += 1
+
+    return response_size
+
+
+def get_response_storage(output_images, max_images, storage, job_id):
+    """
+    Switch from base64 to the bucket when the encoded output images would
+    make the response larger than Runpod accepts, or to the network volume
+    when no bucket is configured, so that the outputs of a prompt that has
+    already run are never lost to a response size error
+    """
+    if storage != 'base64':
+        return storage
+
+    response_size = estimate_response_size(output_images, max_images)
+
+    if response_size <= MAX_RESPONSE_SIZE:
+        return storage
+
+    storage = 's3' if is_bucket_configured() else 'volume'
+
+    logging.warning(
+        f'Estimated response size of {response_size} bytes exceeds {MAX_RESPONSE_SIZE} bytes, '
+        f'returning the outputs from {storage} storage instead',
+        job_id
+    )
+
+    return storage
+
+
+def start_job(event):
+    job_id = event['id']
+    current_job_id.set(job_id)
+    active_jobs.add(job_id)
+    return job_id
+
+
+async def finish_job(job_id, listener):
+    active_jobs.discard(job_id)
+
+    for prompt_id, active_prompt in list(active_prompts.items()):
+        if active_prompt['job_id'] == job_id:
+            del active_prompts[prompt_id]
+
+    if listener is not None:
+        active_client_ids.discard(listener.client_id)
+        await listener.close()
+
+    # Clean the input store in the background so that the result is not delayed
+    if job_id in input_store_jobs:
+        input_store_jobs.discard(job_id)
+        task = asyncio.create_task(asyncio.to_thread(clean_input_store, job_id))
+        input_store_tasks.add(task)
+        task.add_done_callback(input_store_tasks.discard)
+
+    # Refresh the stats in the background so that the result is not delayed
+    if MAX_CONCURRENCY > 1:
+        task = asyncio.create_task(refresh_comfyui_stats())
+        stats_refresh_tasks.add(task)
+        task.add_done_callback(stats_refresh_tasks.discard)
+
+
+def create_listener(event, payload):
+    # Connect to the websocket before queuing the prompt so that no events are missed
+    listener = ComfyUIEventListener(str(uuid.uuid4()))
+    active_client_ids.add(listener.client_id)
+
+    if PROGRESS_UPDATES:
+        listener.subscribe(ProgressReporter(event, payload).handle_event)
+
+    return listener
+
+
+async def handler(event):
+    job_id = start_job(event)
+    encoder_memory = track_encoder_memory()
+    listener = None
+    input_loading = None
+
+    try:
+        check_container_resources(job_id)
+        workflow_templates.refresh()
         validated_input = validate(event['input'], INPUT_SCHEMA)
 
         if 'errors' in validated_input:
@@ -557,158 +3046,113 @@ def handler(event):
                 'error': '\n'.join(validated_input['errors'])
             }
 
-        payload = validated_input['validated_input']
-        workflow_name = payload['workflow']
-        payload = payload['payload']
+        job_input = validated_input['validated_input']
 
-        if workflow_name == 'default':
-            workflow_name = 'txt2img'
+        if job_input['workflow'] == 'custom':
+            graph_errors = validate_workflow_graph(job_input['payload'], get_output_node_types())
 
-        logging.info(f'Workflow: {workflow_name}', job_id)
+            if graph_errors:
+                return get_graph_error(graph_errors, job_id)
 
-        if workflow_name != 'custom':
-            try:
-                payload = get_workflow_payload(workflow_name, payload)
-            except Exception as e:
-                logging.error(f'Unable to load workflow payload for: {workflow_name}', job_id)
-                raise
+        deadline = Deadline(job_input['timeout'] or JOB_TIMEOUT)
+        input_loading = start_loading_input_images(job_input, deadline, job_id)
+        input_metrics = {}
+        storage = get_output_storage(job_input)
+        encode_options = get_encode_options(job_input)
 
-        create_unique_filename_prefix(payload)
-        logging.debug('Queuing prompt', job_id)
+        try:
+            workflow_name, payload, filename_prefixes = prepare_workflow(
+                job_input['workflow'], job_input['payload'], job_id
+            )
+        except PayloadError as e:
+            return get_payload_error(e, job_id)
 
-        queue_response = send_post_request(
-            'prompt',
-            {
-                'prompt': payload
-            }
-        )
+        preflight_errors = await preflight_workflow(payload, deadline, job_id)
 
-        if queue_response.status_code == 200:
-            resp_json = queue_response.json()
-            prompt_id = resp_json['prompt_id']
-            logging.info(f'Prompt queued successfully: {prompt_id}', job_id)
-            retries = 0
+        if preflight_errors:
+            return get_graph_error(preflight_errors, job_id)
 
-            while True:
-                # Only log every 15 retries so the logs don't get spammed
-                if retries == 0 or retries % 15 == 0:
-                    logging.info(f'Getting status of prompt: {prompt_id}', job_id)
+        listener = create_listener(event, payload)
+        await listener.connect()
 
-                r = send_get_request(f'history/{prompt_id}')
-                resp_json = r.json()
+        if job_input['websocket_outputs']:
+            enable_websocket_outputs(listener, payload, job_id)
 
-                if r.status_code == 200 and len(resp_json):
-                    break
+        queue_depth = await check_queue_admission(deadline, job_id)
 
-                time.sleep(0.2)
-                retries += 1
-
-            status = resp_json[prompt_id]['status']
-
-            if status['status_str'] == 'success' and status['completed']:
-                # Job was processed successfully
-                outputs = resp_json[prompt_id]['outputs']
-
-                if len(outputs):
-                    logging.info(f'Images generated successfully for prompt: {prompt_id}', job_id)
-                    output_images = get_output_images(outputs)
-                    images = []
-
-                    for output_image in output_images:
-                        filename = output_image.get('filename')
-
-                        if output_image['type'] == 'output':
-                            image_path = f'{VOLUME_MOUNT_PATH}/ComfyUI/output/{filename}'
-
-                            if os.path.exists(image_path):
-                                with open(image_path, 'rb') as image_file:
-                                    image_data = base64.b64encode(image_file.read()).decode('utf-8')
-                                    images.append(image_data)
-                                    logging.info(f'Deleting output file: {image_path}', job_id)
-                                    os.remove(image_path)
-                        elif output_image['type'] == 'temp':
-                            # First check if the temp image exists in the mounted volume
-                            image_path = f'{VOLUME_MOUNT_PATH}/ComfyUI/temp/{filename}'
-
-                            if os.path.exists(image_path):
-                                logging.info(f'Deleting temp file: {image_path}', job_id)
-
-                                try:
-                                    os.remove(image_path)
-                                except Exception as e:
-                                    logging.error(f'Error deleting temp file {image_path}: {e}')
-                            else:
-                                # Then check if the temp image exists in the /tmp directory
-                                # This should be where they are located as a result of the
-                                # --temp-directory /tmp command line argument in the start.sh script
-                                image_path = f'/tmp/temp/{filename}'
-
-                                if os.path.exists(image_path):
-                                    logging.info(f'Deleting temp file: {image_path}', job_id)
-
-                                    try:
-                                        os.remove(image_path)
-                                    except Exception as e:
-                                        logging.error(f'Error deleting temp file {image_path}: {e}')
-
-                    response = {
-                        'images': images
-                    }
-
-                    # Unload models and free memory after each request to prevent
-                    # "Allocation on device" errors from lazy model loading
-                    try:
-                        requests.post(
-                            f'{BASE_URI}/free',
-                            json={'unload_models': True, 'free_memory': True},
-                            timeout=30
-                        )
-                        logging.info('Models unloaded and memory freed', job_id)
-                    except Exception as e:
-                        logging.warning(f'Failed to free memory: {e}', job_id)
-
-                    # Refresh worker if memory is low
-                    memory_info = get_container_memory_info(job_id)
-                    memory_available_gb = memory_info.get('available')
-
-                    if memory_available_gb is not None and memory_available_gb < 1.0:
-                        logging.info(f'Low memory detected: {memory_available_gb:.2f} GB available, refreshing worker', job_id)
-                        response['refresh_worker'] = True
-
-                    return response
-                else:
-                    raise RuntimeError(f'No output found for prompt id: {prompt_id}')
-            else:
-                # Job did not process successfully
-                for message in status['messages']:
-                    key, value = message
-
-                    if key == 'execution_error':
-                        if 'node_type' in value and 'exception_message' in value:
-                            node_type = value['node_type']
-                            exception_message = value['exception_message']
-                            raise RuntimeError(f'{node_type}: {exception_message}')
-                        else:
-                            # Log to file instead of Runpod because the output tends to be too verbose
-                            # and gets dropped by Runpod logging
-                            error_msg = f'Job did not process successfully for prompt_id: {prompt_id}'
-                            logging.error(error_msg, job_id)
-                            logging.info(f'{job_id}: Response JSON: {resp_json}', job_id)
-                            raise RuntimeError(error_msg)
+        if input_loading is not None:
+            input_images = await input_loading
+            uploaded, hits = await upload_input_images(input_images, payload, deadline, job_id)
+            input_metrics = get_input_metrics(input_images, hits)
 
-        else:
-            try:
-                queue_response_content = queue_response.json()
-            except Exception as e:
-                queue_response_content = str(queue_response.content)
+        queue_response = await queue_prompt(payload, listener.client_id, deadline, job_id)
+        queued_at = time.time()
 
-            logging.error(f'HTTP Status code: {queue_response.status_code}', job_id)
-            logging.error(queue_response_content, job_id)
+        if queue_response.status_code != 200:
+            return get_queue_error(queue_response, job_id)
 
-            return {
-                'error': f'HTTP status code: {queue_response.status_code}',
-                'output': queue_response_content
-            }
+        prompt_id = queue_response.json()['prompt_id']
+        logging.info(f'Prompt queued successfully: {prompt_id}', job_id)
+        active_prompts[prompt_id] = {'job_id': job_id, 'filename_prefixes': filename_prefixes}
+
+        if MAX_CONCURRENCY > 1:
+            await refresh_comfyui_stats(deadline)
+
+        try:
+            history = await wait_for_prompt(prompt_id, listener, workflow_name, deadline, job_id)
+        except (asyncio.CancelledError, DeadlineExceeded, asyncio.TimeoutError, aiohttp.ClientError):
+            await cancel_prompt(prompt_id, job_id)
+            raise
+
+        await listener.close()
+        check_prompt_status(prompt_id, history, job_id)
+
+        # Job was processed successfully
+        record_runtime(workflow_name, deadline.elapsed())
+        metrics = {'queue_depth': queue_depth, **get_prompt_timings(history, queued_at), **input_metrics}
+        logging.info(f'Prompt metrics: {metrics}', job_id)
+        outputs = history['outputs']
+        websocket_images = get_websocket_images(listener, prompt_id)
+
+        if not len(outputs) and not websocket_images:
+            raise RuntimeError(f'No output found for prompt id: {prompt_id}')
+
+        logging.info(f'Images generated successfully for prompt: {prompt_id}', job_id)
+        output_images = get_output_images(outputs) + websocket_images
+        output_images = await prepare_output_images(
+            output_images, job_id, job_input['max_images'], **encode_options
+        )
+        storage = get_response_storage(output_images, job_input['max_images'], storage, job_id)
+
+        images = await encode_output_images(
+            output_images, job_id, job_input['max_images'], storage, **encode_options
+        )
+        metrics['encoder_peak_bytes'] = encoder_memory.peak
+
+        if job_input['strip_metadata']:
+            metrics['metadata_bytes_removed'] = sum(image.get('metadata_bytes_removed', 0) for image in images)
+
+        response = {
+            'images': [image['image'] for image in images],
+            'image_info': [
+                {key: value for key, value in image.items() if key != 'image'} for image in images
+            ],
+            'output_storage': storage,
+            'metrics': metrics
+        }
+
+        output_text = get_output_text(outputs)
+
+        if output_text:
+            response['text'] = output_text
+
+        await free_memory(job_id, deadline)
+
+        # Refresh worker if memory is low
+        if is_memory_low(job_id):
+            response['refresh_worker'] = True
+
+        return response
     except Exception as e:
         logging.error(f'An exception was raised: {e}', job_id)
 
@@ -717,6 +3161,184 @@ def handler(event):
             'output': traceback.format_exc(),
             'refresh_worker': True
         }
+    finally:
+        if input_loading is not None:
+            input_loading.cancel()
+
+        await finish_job(job_id, listener)
+
+
+async def stream_handler(event):
+    """
+    Generator handler that yields each output image as soon as the node that
+    saved it has finished executing, instead of waiting for the whole prompt.
+    Used when STREAM_OUTPUTS is enabled, with the results aggregated for /runsync.
+    """
+    job_id = start_job(event)
+    encoder_memory = track_encoder_memory()
+    listener = None
+    input_loading = None
+    finished = None
+
+    try:
+        check_container_resources(job_id)
+        workflow_templates.refresh()
+        validated_input = validate(event['input'], INPUT_SCHEMA)
+
+        if 'errors' in validated_input:
+            yield {
+                'error': '\n'.join(validated_input['errors'])
+            }
+            return
+
+        job_input = validated_input['validated_input']
+
+        if job_input['workflow'] == 'custom':
+            graph_errors = validate_workflow_graph(job_input['payload'], get_output_node_types())
+
+            if graph_errors:
+                yield get_graph_error(graph_errors, job_id)
+                return
+
+        deadline = Deadline(job_input['timeout'] or JOB_TIMEOUT)
+        input_loading = start_loading_input_images(job_input, deadline, job_id)
+        input_metrics = {}
+        storage = get_output_storage(job_input)
+        encode_options = get_encode_options(job_input)
+
+        try:
+            workflow_name, payload, filename_prefixes = prepare_workflow(
+                job_input['workflow'], job_input['payload'], job_id
+            )
+        except PayloadError as e:
+            yield get_payload_error(e, job_id)
+            return
+
+        preflight_errors = await preflight_workflow(payload, deadline, job_id)
+
+        if preflight_errors:
+            yield get_graph_error(preflight_errors, job_id)
+            return
+
+        listener = create_listener(event, payload)
+        executed = asyncio.Queue()
+
+        listener.subscribe(
+            lambda event_type, data: executed.put_nowait(data) if event_type == 'executed' else None
+        )
+
+        await listener.connect()
+
+        if job_input['websocket_outputs']:
+            enable_websocket_outputs(listener, payload, job_id)
+
+        queue_depth = await check_queue_admission(deadline, job_id)
+
+        if input_loading is not None:
+            input_images = await input_loading
+            uploaded, hits = await upload_input_images(input_images, payload, deadline, job_id)
+            input_metrics = get_input_metrics(input_images, hits)
+
+        queue_response = await queue_prompt(payload, listener.client_id, deadline, job_id)
+        queued_at = time.time()
+
+        if queue_response.status_code != 200:
+            yield get_queue_error(queue_response, job_id)
+            return
+
+        prompt_id = queue_response.json()['prompt_id']
+        logging.info(f'Prompt queued successfully: {prompt_id}', job_id)
+        active_prompts[prompt_id] = {'job_id': job_id, 'filename_prefixes': filename_prefixes}
+        streamed = set()
+        streamed_text = set()
+        encoded = 0
+        finished = asyncio.create_task(listener.wait(prompt_id, timeout=deadline.remaining()))
+
+        try:
+            while not finished.done() or not executed.empty():
+                next_output = asyncio.create_task(executed.get())
+                await asyncio.wait({finished, next_output}, return_when=asyncio.FIRST_COMPLETED)
+
+                if not next_output.done():
+                    next_output.cancel()
+                    continue
+
+                data = next_output.result()
+                node_id = data.get('node')
+                output_images = get_output_images({node_id: data.get('output') or {}})
+
+                for output_text in get_output_text({node_id: data.get('output') or {}}):
+                    streamed_text.add(node_id)
+                    yield output_text
+
+                for output_image in output_images:
+                    streamed.add(output_image.get('filename'))
+
+                remaining = get_remaining_images(job_input['max_images'], encoded)
+                output_images = await prepare_output_images(output_images, job_id, remaining, **encode_options)
+                output_storage = get_response_storage(output_images, remaining, storage, job_id)
+
+                for image in await encode_output_images(
+                    output_images, job_id, remaining, output_storage, **encode_options
+                ):
+                    logging.info(f'Streaming image from node: {node_id}', job_id)
+                    encoded += 1
+                    yield image
+                    release_streamed_image(image, output_storage, encoder_memory)
+
+            # Collect anything that was not streamed, for example when the websocket dropped
+            history = await wait_for_prompt(prompt_id, listener, workflow_name, deadline, job_id)
+        except (asyncio.CancelledError, GeneratorExit, DeadlineExceeded, asyncio.TimeoutError, aiohttp.ClientError):
+            await cancel_prompt(prompt_id, job_id)
+            raise
+
+        await listener.close()
+        check_prompt_status(prompt_id, history, job_id)
+        record_runtime(workflow_name, deadline.elapsed())
+        metrics = {'queue_depth': queue_depth, **get_prompt_timings(history, queued_at), **input_metrics}
+        logging.info(f'Prompt metrics: {metrics}', job_id)
+
+        for output_text in get_output_text(history['outputs']):
+            if output_text['node_id'] not in streamed_text:
+                yield output_text
+
+        output_images = [
+            output_image for output_image in get_output_images(history['outputs'])
+            if output_image.get('filename') not in streamed
+        ] + get_websocket_images(listener, prompt_id)
+        remaining = get_remaining_images(job_input['max_images'], encoded)
+        output_images = await prepare_output_images(output_images, job_id, remaining, **encode_options)
+        output_storage = get_response_storage(output_images, remaining, storage, job_id)
+
+        for image in await encode_output_images(
+            output_images, job_id, remaining, output_storage, **encode_options
+        ):
+            yield image
+            release_streamed_image(image, output_storage, encoder_memory)
+
+        logging.info(f'Encoder peak memory: {encoder_memory.peak} bytes', job_id)
+
+        await free_memory(job_id, deadline)
+
+        # runpod only honours refresh_worker in the result of a non-generator
+        # handler, so a streaming worker cannot be refreshed when memory is low
+        if is_memory_low(job_id):
+            logging.warning('Memory is low, but the worker cannot be refreshed when streaming outputs', job_id)
+    except Exception as e:
+        logging.error(f'An exception was raised: {e}', job_id)
+
+        yield {
+            'error': str(e),
+            'output': traceback.format_exc()
+        }
+    finally:
+        if finished is not None:
+            finished.cancel()
+
+        if input_loading is not None:
+            input_loading.cancel()
+
+        await finish_job(job_id, listener)
 
 
 def setup_logging():
@@ -734,15 +3356,23 @@ def setup_logging():
 
 
 if __name__ == '__main__':
-    session = requests.Session()
-    retries = Retry(total=10, backoff_factor=0.1, status_forcelist=[502, 503, 504])
-    session.mount('http://', HTTPAdapter(max_retries=retries))
     setup_logging()
+    atexit.register(cancel_active_prompts)
+    workflow_templates.refresh()
+    logging.info(f'Workflow templates: {sorted(WORKFLOWS)}')
     wait_for_service(url=f'{BASE_URI}/system_stats')
     logging.info('ComfyUI API is ready')
+
+    asyncio.run(preload_node_schemas())
+
     logging.info('Starting Runpod Serverless...')
+    if STREAM_OUTPUTS:
+        logging.info('Streaming outputs as they are generated')
+
     runpod.serverless.start(
         {
-            'handler': handler
+            'handler': stream_handler if STREAM_OUTPUTS else handler,
+            'return_aggregate_stream': STREAM_OUTPUTS,
+            'concurrency_modifier': concurrency_modifier
         }
     )
@@ -1,3 +1,6 @@
+# The names of the workflow templates, which are discovered by the handler
+WORKFLOWS = set()
+
 INPUT_SCHEMA = {
     'workflow': {
         'type': str,
@@ -5,12 +8,79 @@ INPUT_SCHEMA = {
         'default': 'txt2img',
         'constraints': lambda workflow: workflow in [
             'default',
-            'txt2img',
             'custom'
-        ]
+        ] or workflow in WORKFLOWS
     },
     'payload': {
         'type': dict,
         'required': True
+    },
+    'timeout': {
+        'type': float,
+        'required': False,
+        'default': None,
+        'constraints': lambda timeout: timeout is None or timeout > 0
+    },
+    'max_images': {
+        'type': int,
+        'required': False,
+        'default': None,
+        'constraints': lambda max_images: max_images is None or max_images > 0
+    },
+    'output_storage': {
+        'type': str,
+        'required': False,
+        'default': None,
+        'constraints': lambda output_storage: output_storage in [
+            None,
+            'base64',
+            's3'
+        ]
+    },
+    'output_format': {
+        'type': str,
+        'required': False,
+        'default': None,
+        'constraints': lambda output_format: output_format in [
+            None,
+            'png',
+            'webp',
+            'jpeg',
+            'avif'
+        ]
+    },
+    'output_quality': {
+        'type': int,
+        'required': False,
+        # The default is applied by the handler, because the validator skips the
+        # constraints of values that have the same type as the default
+        'default': None,
+        'constraints': lambda output_quality: output_quality is None or 1 <= output_quality <= 100
+    },
+    'max_dimension': {
+        'type': int,
+        'required': False,
+        'default': None,
+        'constraints': lambda max_dimension: max_dimension is None or max_dimension > 0
+    },
+    'persist_outputs': {
+        'type': bool,
+        'required': False,
+        'default': False
+    },
+    'strip_metadata': {
+        'type': bool,
+        'required': False,
+        'default': False
+    },
+    'websocket_outputs': {
+        'type': bool,
+        'required': False,
+        'default': False
+    },
+    'images': {
+        'type': list,
+        'required': False,
+        'default': None
     }
 }
@@ -19,13 +19,18 @@ export TRANSPARENT_BACKGROUND_FILE_PATH=/root/.transparent-background
 
 cd /workspace/ComfyUI
 
+# Write outputs to local disk instead of the Network Volume, the handler
+# copies them to the Network Volume only when persist_outputs is requested
+export OUTPUT_PATH="${OUTPUT_PATH:-/tmp/output}"
+mkdir -p "${OUTPUT_PATH}"
+
 # Disable xformers for CUDA 12.8
 EXTRA_ARGS=""
 if [ "${CUDA_SHORT}" = "cu128" ]; then
     EXTRA_ARGS="--disable-xformers"
 fi
 
-python main.py --port 3000 --temp-directory /tmp ${EXTRA_ARGS} > /workspace/logs/comfyui-serverless.log 2>&1 &
+python main.py --port 3000 --temp-directory /tmp --output-directory "${OUTPUT_PATH}" ${EXTRA_ARGS} > /workspace/logs/comfyui-serverless.log 2>&1 &
 deactivate
 
 echo "Starting Runpod Handler"
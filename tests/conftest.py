@@ -7,6 +7,39 @@ from unittest.mock import MagicMock, patch
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 
+@pytest.fixture(autouse=True)
+def no_comfyui_websocket():
+    """Prevent tests from connecting to a real ComfyUI websocket."""
+    with patch('handler.ComfyUIClient.ws_connect') as mock_ws_connect:
+        mock_ws_connect.side_effect = ConnectionRefusedError()
+        yield mock_ws_connect
+
+
+@pytest.fixture(autouse=True)
+def no_comfyui_object_info():
+    """Prevent tests from loading the node definitions of a real ComfyUI."""
+    import aiohttp
+
+    with patch('handler.node_schemas', None), patch('handler.load_node_schemas') as mock_load_node_schemas:
+        mock_load_node_schemas.side_effect = aiohttp.ClientConnectionError()
+        yield mock_load_node_schemas
+
+
+@pytest.fixture(autouse=True)
+def workflow_templates():
+    """Discover the workflow templates of the repository instead of /workflows."""
+    import handler
+
+    templates = handler.WorkflowTemplates(
+        os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'workflows'),
+        handler.WORKFLOWS
+    )
+
+    with patch('handler.workflow_templates', templates):
+        templates.refresh()
+        yield templates
+
+
 @pytest.fixture
 def mock_runpod_logger():
     """Mock Runpod logger."""
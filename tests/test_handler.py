@@ -1,10 +1,13 @@
 import pytest
+import asyncio
 import json
 import base64
+import hashlib
 import os
 import logging
 import requests
-from unittest.mock import MagicMock, patch, mock_open, call
+import aiohttp
+from unittest.mock import MagicMock, AsyncMock, patch, mock_open, call
 
 
 class TestGetOutputImages:
@@ -42,6 +45,24 @@ class TestGetOutputImages:
         result = get_output_images(output)
         assert len(result) == 2
 
+    def test_every_image_of_a_batch(self):
+        from handler import get_output_images
+
+        output = {
+            '9': {
+                'images': [
+                    {'filename': f'test_0000{i}_.png', 'type': 'output'} for i in range(1, 5)
+                ]
+            }
+        }
+        result = get_output_images(output)
+
+        assert [image['filename'] for image in result] == [
+            'test_00001_.png', 'test_00002_.png', 'test_00003_.png', 'test_00004_.png'
+        ]
+        assert [image['batch_index'] for image in result] == [0, 1, 2, 3]
+        assert all(image['node_id'] == '9' for image in result)
+
     def test_empty_output(self):
         from handler import get_output_images
 
@@ -49,6 +70,41 @@ class TestGetOutputImages:
         result = get_output_images(output)
         assert len(result) == 0
 
+    def test_collects_video_audio_and_text_outputs(self):
+        from handler import get_output_images, get_output_text
+
+        output = {
+            '9': {
+                'gifs': [{'filename': 'clip.mp4', 'type': 'output', 'format': 'video/h264-mp4'}]
+            },
+            '10': {
+                'audio': [{'filename': 'track.flac', 'subfolder': 'audio', 'type': 'output'}]
+            },
+            '11': {
+                'text': ['a caption']
+            }
+        }
+
+        assert [(image['filename'], image['kind']) for image in get_output_images(output)] == [
+            ('clip.mp4', 'gifs'),
+            ('track.flac', 'audio')
+        ]
+        assert get_output_text(output) == [{'node_id': '11', 'text': 'a caption'}]
+
+    def test_registered_collector_is_used(self):
+        import handler
+
+        def collect_meshes(node_id, kind, value):
+            return [{**mesh, 'node_id': node_id, 'batch_index': 0, 'kind': kind} for mesh in value]
+
+        with patch.dict(handler.OUTPUT_COLLECTORS):
+            handler.output_collector('meshes')(collect_meshes)
+            outputs = handler.get_outputs({'9': {'meshes': [{'filename': 'mesh.glb', 'type': 'output'}]}})
+
+        assert outputs == [
+            {'filename': 'mesh.glb', 'type': 'output', 'node_id': '9', 'batch_index': 0, 'kind': 'meshes'}
+        ]
+
     def test_output_without_images_key(self):
         from handler import get_output_images
 
@@ -116,277 +172,2199 @@ class TestCreateUniqueFilenamePrefix:
         prefix_9 = payload['9']['inputs']['filename_prefix']
         prefix_10 = payload['10']['inputs']['filename_prefix']
 
-        assert len(prefix_9) == 36
-        assert len(prefix_10) == 36
-        assert prefix_9 != prefix_10
+        assert len(prefix_9) == 36
+        assert len(prefix_10) == 36
+        assert prefix_9 != prefix_10
+
+    def test_adds_uuid_to_video_and_audio_nodes(self):
+        from handler import create_unique_filename_prefix
+
+        payload = {
+            '9': {
+                'class_type': 'VHS_VideoCombine',
+                'inputs': {'filename_prefix': 'video'}
+            },
+            '10': {
+                'class_type': 'SaveAudio',
+                'inputs': {'filename_prefix': 'audio'}
+            }
+        }
+        filename_prefixes = create_unique_filename_prefix(payload)
+
+        assert filename_prefixes == [
+            payload['9']['inputs']['filename_prefix'],
+            payload['10']['inputs']['filename_prefix']
+        ]
+        assert all(len(filename_prefix) == 36 for filename_prefix in filename_prefixes)
+
+
+class TestGetTxt2ImgPayload:
+    """Tests for the parameter map of the txt2img workflow template."""
+
+    @patch('handler.logging')
+    def test_sets_all_expected_fields(self, mock_logging):
+        from handler import get_workflow_payload
+
+        payload = {
+            'seed': 12345,
+            'steps': 20,
+            'cfg_scale': 7.5,
+            'sampler_name': 'euler',
+            'ckpt_name': 'model.safetensors',
+            'batch_size': 1,
+            'width': 512,
+            'height': 512,
+            'prompt': 'test prompt',
+            'negative_prompt': 'ugly'
+        }
+
+        result = get_workflow_payload('txt2img', payload)
+
+        assert result['3']['inputs']['seed'] == 12345
+        assert result['3']['inputs']['steps'] == 20
+        assert result['3']['inputs']['cfg'] == 7.5
+        assert result['3']['inputs']['sampler_name'] == 'euler'
+        assert result['4']['inputs']['ckpt_name'] == 'model.safetensors'
+        assert result['5']['inputs']['batch_size'] == 1
+        assert result['5']['inputs']['width'] == 512
+        assert result['5']['inputs']['height'] == 512
+        assert result['6']['inputs']['text'] == 'test prompt'
+        assert result['7']['inputs']['text'] == 'ugly'
+
+    @patch('handler.logging')
+    def test_uses_defaults_for_missing_inputs(self, mock_logging):
+        from handler import get_workflow_payload
+
+        result = get_workflow_payload('txt2img', {'prompt': 'test prompt', 'cfg_scale': 7})
+
+        assert result['3']['inputs']['cfg'] == 7.0
+        assert result['3']['inputs']['steps'] == 20
+        assert result['7']['inputs']['text'] == 'text, watermark'
+
+    @patch('handler.logging')
+    def test_rejects_missing_and_mistyped_inputs(self, mock_logging):
+        from handler import get_workflow_payload
+
+        with pytest.raises(ValueError, match='missing the required input: prompt'):
+            get_workflow_payload('txt2img', {})
+
+        with pytest.raises(ValueError, match='steps should be int, not str'):
+            get_workflow_payload('txt2img', {'prompt': 'test prompt', 'steps': '20'})
+
+        with pytest.raises(ValueError, match='seed should be int, not bool'):
+            get_workflow_payload('txt2img', {'prompt': 'test prompt', 'seed': True})
+
+
+class TestGetImg2ImgPayload:
+    """Tests for the parameter map of the img2img workflow template."""
+
+    @patch('handler.logging')
+    def test_sets_all_expected_fields(self, mock_logging):
+        from handler import get_workflow_payload
+
+        payload = {
+            'seed': 12345,
+            'steps': 20,
+            'cfg_scale': 7.5,
+            'sampler_name': 'euler',
+            'scheduler': 'normal',
+            'denoise': 0.75,
+            'ckpt_name': 'model.safetensors',
+            'width': 512,
+            'height': 768,
+            'prompt': 'test prompt',
+            'negative_prompt': 'ugly',
+            'image': 'source.png'
+        }
+
+        result = get_workflow_payload('img2img', payload)
+
+        assert result['13']['inputs']['seed'] == 12345
+        assert result['13']['inputs']['steps'] == 20
+        assert result['13']['inputs']['cfg'] == 7.5
+        assert result['13']['inputs']['sampler_name'] == 'euler'
+        assert result['13']['inputs']['scheduler'] == 'normal'
+        assert result['13']['inputs']['denoise'] == 0.75
+        assert result['1']['inputs']['ckpt_name'] == 'model.safetensors'
+        assert result['10']['inputs']['image'] == 'source.png'
+
+        for node_id, text in (('2', 'test prompt'), ('4', 'ugly')):
+            inputs = result[node_id]['inputs']
+            assert (inputs['width'], inputs['target_width']) == (512, 512)
+            assert (inputs['height'], inputs['target_height']) == (768, 768)
+            assert (inputs['text_g'], inputs['text_l']) == (text, text)
+
+    @patch('handler.logging')
+    @patch('handler.get_container_memory_info')
+    @patch('handler.get_container_cpu_info')
+    @patch('handler.get_container_disk_info')
+    @patch('handler.send_post_request')
+    @patch('handler.send_get_request')
+    def test_handler_queues_img2img_workflow(
+        self, mock_get, mock_post, mock_disk, mock_cpu, mock_memory, mock_logging
+    ):
+        import handler
+
+        mock_memory.return_value = {'available': 10.0}
+        mock_cpu.return_value = {}
+        mock_disk.return_value = {'free_bytes': 10 * 1024 * 1024 * 1024}
+        mock_get.return_value = MagicMock(status_code=200, json=lambda: {'queue_running': [], 'queue_pending': []})
+        mock_post.return_value = MagicMock(
+            status_code=400, json=lambda: {'error': {'message': 'invalid prompt'}}, content=b'invalid prompt'
+        )
+
+        event = {'id': 'test-123', 'input': {'workflow': 'img2img', 'payload': {'prompt': 'test prompt'}}}
+        result = asyncio.run(handler.handler(event))
+
+        assert result['error'] == 'HTTP status code: 400'
+        prompt = mock_post.call_args[0][1]['prompt']
+        assert prompt['2']['inputs']['text_g'] == 'test prompt'
+        assert prompt['13']['inputs']['denoise'] == 0.45
+
+
+class TestParameterMap:
+    """Tests for compiling the parameter maps of workflow templates."""
+
+    workflow = {'3': {'inputs': {'seed': 1, 'model': ['4', 0]}}}
+
+    def test_rejects_maps_that_do_not_match_the_template(self):
+        from handler import ParameterMap
+
+        for params, error in (
+            ({'seed': {'type': 'int', 'targets': [['9', 'seed']]}}, 'missing node input: 9.seed'),
+            ({'seed': {'type': 'int', 'targets': [['3', 'steps']]}}, 'missing node input: 3.steps'),
+            ({'model': {'type': 'str', 'targets': [['3', 'model']]}}, 'linked node input: 3.model'),
+            ({'seed': {'type': 'long', 'targets': [['3', 'seed']]}}, 'unknown type: long'),
+            ({'seed': {'type': 'int', 'targets': []}}, 'no targets'),
+            ({'seed': {'type': 'int', 'default': 'one', 'targets': [['3', 'seed']]}}, 'should be int')
+        ):
+            with pytest.raises(ValueError, match=error):
+                ParameterMap(params, self.workflow)
+
+    @patch('handler.logging')
+    def test_templates_with_invalid_maps_are_not_discovered(self, mock_logging, tmp_path):
+        from handler import WorkflowTemplates
+
+        (tmp_path / 'valid.json').write_text(json.dumps(self.workflow))
+        (tmp_path / 'valid.params.json').write_text(json.dumps({'seed': {'type': 'int', 'targets': [['3', 'seed']]}}))
+        (tmp_path / 'invalid.json').write_text(json.dumps(self.workflow))
+        (tmp_path / 'invalid.params.json').write_text(json.dumps({'seed': {'type': 'int', 'targets': [['9', 'seed']]}}))
+        names = set()
+        WorkflowTemplates(str(tmp_path), names).refresh()
+
+        assert names == {'valid'}
+        mock_logging.error.assert_called_once()
+
+
+class TestGetWorkflowPayload:
+    """Tests for get_workflow_payload function."""
+
+    def write_template(self, path, name, workflow):
+        (path / f'{name}.json').write_text(json.dumps(workflow))
+
+    @patch('handler.logging')
+    def test_loads_workflow_with_parameter_map(self, mock_logging, tmp_path):
+        import handler
+
+        self.write_template(tmp_path, 'txt2img', {'3': {'inputs': {'seed': 1}}, '6': {'inputs': {'text': ''}}})
+        self.write_template(tmp_path, 'txt2img.params', {
+            'seed': {'type': 'int', 'default': 1, 'targets': [['3', 'seed']]},
+            'prompt': {'type': 'str', 'targets': [['6', 'text']]}
+        })
+        templates = handler.WorkflowTemplates(str(tmp_path), set())
+
+        with patch('handler.workflow_templates', templates):
+            result = handler.get_workflow_payload('txt2img', {'seed': 12345, 'prompt': 'test'})
+
+            assert result['3']['inputs']['seed'] == 12345
+            assert result['6']['inputs']['text'] == 'test'
+
+            # A modified parameter map is compiled again
+            self.write_template(tmp_path, 'txt2img.params', {'prompt': {'type': 'str', 'targets': [['6', 'text']]}})
+            os.utime(tmp_path / 'txt2img.params.json', ns=(0, 10 ** 18))
+            result = handler.get_workflow_payload('txt2img', {'seed': 12345, 'prompt': 'test'})
+
+        assert result['3']['inputs']['seed'] == 1
+
+    @patch('handler.logging')
+    def test_loads_custom_workflow_without_modification(self, mock_logging, tmp_path):
+        import handler
+
+        mock_workflow = {'custom': 'workflow'}
+        self.write_template(tmp_path, 'other', mock_workflow)
+
+        with patch('handler.workflow_templates', handler.WorkflowTemplates(str(tmp_path), set())):
+            result = handler.get_workflow_payload('other', {})
+
+        assert result == mock_workflow
+
+    @patch('handler.logging')
+    def test_parses_templates_once_and_copies_them(self, mock_logging, tmp_path):
+        from handler import WorkflowTemplates
+
+        self.write_template(tmp_path, 'txt2img', {'3': {'inputs': {'seed': 1, 'model': ['4', 0]}}})
+        names = set()
+        templates = WorkflowTemplates(str(tmp_path), names)
+        templates.refresh()
+
+        with patch('handler.json.load') as mock_load:
+            first, parameters = templates.get('txt2img')
+            first['3']['inputs']['seed'] = 2
+            first['3']['inputs']['model'][0] = '5'
+            second, parameters = templates.get('txt2img')
+
+        mock_load.assert_not_called()
+        assert names == {'txt2img'}
+        assert second == {'3': {'inputs': {'seed': 1, 'model': ['4', 0]}}}
+
+    @patch('handler.logging')
+    def test_reloads_modified_templates(self, mock_logging, tmp_path):
+        from handler import WorkflowTemplates
+
+        self.write_template(tmp_path, 'txt2img', {'3': {'inputs': {'steps': 20}}})
+        names = set()
+        templates = WorkflowTemplates(str(tmp_path), names)
+        templates.refresh()
+        assert templates.get('txt2img')[0]['3']['inputs']['steps'] == 20
+
+        self.write_template(tmp_path, 'txt2img', {'3': {'inputs': {'steps': 30}}})
+        os.utime(tmp_path / 'txt2img.json', ns=(0, 10 ** 18))
+        assert templates.get('txt2img')[0]['3']['inputs']['steps'] == 30
+
+        self.write_template(tmp_path, 'img2img', {})
+        (tmp_path / 'broken.json').write_text('{')
+        os.utime(tmp_path, ns=(0, 10 ** 18))
+        templates.refresh()
+
+        assert names == {'txt2img', 'img2img'}
+        mock_logging.error.assert_called_once()
+
+    @patch('handler.logging')
+    def test_accepts_discovered_workflows_only(self, mock_logging, workflow_templates):
+        from handler import prepare_workflow
+        from schemas.input import INPUT_SCHEMA
+
+        constraints = INPUT_SCHEMA['workflow']['constraints']
+        assert {'txt2img', 'img2img'} <= workflow_templates.names
+        assert constraints('img2img') and constraints('default') and constraints('custom')
+        assert not constraints('missing')
+
+        with pytest.raises(ValueError, match='Unknown workflow: missing'):
+            prepare_workflow('missing', {}, 'job-1')
+
+
+class TestInputValidation:
+    """Tests for input schema validation."""
+
+    def test_valid_custom_workflow_input(self, sample_event):
+        from runpod.serverless.utils.rp_validator import validate
+        from schemas.input import INPUT_SCHEMA
+
+        result = validate(sample_event['input'], INPUT_SCHEMA)
+        assert 'errors' not in result
+        assert result['validated_input']['workflow'] == 'custom'
+
+    def test_valid_txt2img_workflow_input(self):
+        from runpod.serverless.utils.rp_validator import validate
+        from schemas.input import INPUT_SCHEMA
+
+        input_data = {
+            'workflow': 'txt2img',
+            'payload': {'prompt': 'test'}
+        }
+        result = validate(input_data, INPUT_SCHEMA)
+        assert 'errors' not in result
+
+    def test_missing_payload(self):
+        from runpod.serverless.utils.rp_validator import validate
+        from schemas.input import INPUT_SCHEMA
+
+        input_data = {
+            'workflow': 'custom'
+        }
+        result = validate(input_data, INPUT_SCHEMA)
+        assert 'errors' in result
+
+    def test_default_workflow_is_txt2img(self):
+        from runpod.serverless.utils.rp_validator import validate
+        from schemas.input import INPUT_SCHEMA
+
+        input_data = {
+            'payload': {'prompt': 'test'}
+        }
+        result = validate(input_data, INPUT_SCHEMA)
+        assert 'errors' not in result
+        assert result['validated_input']['workflow'] == 'txt2img'
+
+    def test_max_images_must_be_positive(self):
+        from runpod.serverless.utils.rp_validator import validate
+        from schemas.input import INPUT_SCHEMA
+
+        input_data = {
+            'payload': {'prompt': 'test'},
+            'max_images': 0
+        }
+        result = validate(input_data, INPUT_SCHEMA)
+        assert 'errors' in result
+
+
+class FakeResponse:
+    """Minimal async context manager standing in for an aiohttp response."""
+
+    def __init__(self, status, content=b'{}'):
+        self.status = status
+        self.content = content
+
+    async def read(self):
+        return self.content
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+
+class TestSendRequests:
+    """Tests for HTTP request functions."""
+
+    @patch('handler.comfyui')
+    def test_send_get_request_uses_correct_endpoint(self, mock_comfyui):
+        import handler
+        from handler import TIMEOUT
+
+        mock_comfyui.get = AsyncMock(return_value=MagicMock(status_code=200))
+
+        asyncio.run(handler.send_get_request('test/endpoint'))
+
+        mock_comfyui.get.assert_called_once_with('test/endpoint', TIMEOUT, None)
+
+    @patch('handler.comfyui')
+    def test_send_post_request_uses_correct_endpoint_and_payload(self, mock_comfyui):
+        import handler
+        from handler import TIMEOUT
+
+        mock_comfyui.post = AsyncMock(return_value=MagicMock(status_code=200))
+        test_payload = {'key': 'value'}
+
+        asyncio.run(handler.send_post_request('test/endpoint', test_payload))
+
+        mock_comfyui.post.assert_called_once_with('test/endpoint', test_payload, TIMEOUT, None)
+
+    @patch('handler.get_http_session')
+    def test_client_uses_base_uri_and_reads_response(self, mock_get_session):
+        from handler import ComfyUIClient, BASE_URI, WS_URI
+
+        mock_session = MagicMock()
+        mock_session.request.return_value = FakeResponse(200, b'{"prompt_id": "123"}')
+        mock_get_session.return_value = mock_session
+
+        client = ComfyUIClient(BASE_URI, WS_URI)
+        response = asyncio.run(client.post('prompt', {'prompt': {}}))
+
+        assert response.status_code == 200
+        assert response.json() == {'prompt_id': '123'}
+        args, kwargs = mock_session.request.call_args
+        assert args == ('POST', f'{BASE_URI}/prompt')
+        assert kwargs['json'] == {'prompt': {}}
+
+    @patch('handler.asyncio.sleep')
+    @patch('handler.get_http_session')
+    def test_client_retries_gateway_errors(self, mock_get_session, mock_sleep):
+        from handler import ComfyUIClient, BASE_URI, WS_URI
+
+        mock_session = MagicMock()
+        mock_session.request.side_effect = [FakeResponse(503), FakeResponse(200)]
+        mock_get_session.return_value = mock_session
+
+        client = ComfyUIClient(BASE_URI, WS_URI)
+        response = asyncio.run(client.get('history/123'))
+
+        assert response.status_code == 200
+        assert mock_session.request.call_count == 2
+        mock_sleep.assert_called_once()
+
+    @patch('handler.asyncio.sleep')
+    @patch('handler.get_http_session')
+    def test_client_builds_form_data_for_each_attempt(self, mock_get_session, mock_sleep):
+        import aiohttp
+        from handler import ComfyUIClient, BASE_URI, WS_URI
+
+        mock_session = MagicMock()
+        mock_session.request.side_effect = [FakeResponse(503), FakeResponse(200, b'{"name": "source.png"}')]
+        mock_get_session.return_value = mock_session
+
+        client = ComfyUIClient(BASE_URI, WS_URI)
+        form = {'image': ('source.png', b'source', 'image/png'), 'type': 'input'}
+        response = asyncio.run(client.post_form('upload/image', form))
+
+        assert response.json() == {'name': 'source.png'}
+        forms = [c[1]['data'] for c in mock_session.request.call_args_list]
+        assert all(isinstance(form_data, aiohttp.FormData) for form_data in forms)
+        assert forms[0] is not forms[1]
+
+
+class TestDeadline:
+    """Tests for the per-job deadline and history poll pacing."""
+
+    @patch('handler.time.monotonic')
+    def test_timeout_is_capped_at_remaining_budget(self, mock_monotonic):
+        from handler import Deadline
+
+        mock_monotonic.return_value = 100.0
+        deadline = Deadline(60)
+        mock_monotonic.return_value = 130.0
+
+        assert deadline.elapsed() == 30.0
+        assert deadline.remaining() == 30.0
+        assert deadline.timeout() == 30.0
+        assert deadline.timeout(10) == 10
+
+    @patch('handler.time.monotonic')
+    def test_expired_deadline_raises(self, mock_monotonic):
+        from handler import Deadline, DeadlineExceeded
+
+        mock_monotonic.return_value = 100.0
+        deadline = Deadline(60)
+        mock_monotonic.return_value = 161.0
+
+        assert deadline.expired()
+
+        with pytest.raises(DeadlineExceeded, match='time budget of 60s'):
+            deadline.timeout()
+
+    @patch('handler.get_http_session')
+    def test_request_timeout_is_capped_at_remaining_budget(self, mock_get_session):
+        import handler
+
+        mock_session = MagicMock()
+        mock_session.request.return_value = FakeResponse(200)
+        mock_get_session.return_value = mock_session
+
+        asyncio.run(handler.send_get_request('history/123', handler.Deadline(5)))
+
+        assert mock_session.request.call_args[1]['timeout'].total <= 5
+
+    @patch('handler.get_http_session')
+    def test_retries_stop_when_budget_is_spent(self, mock_get_session):
+        import aiohttp
+        import time
+        import handler
+
+        mock_session = MagicMock()
+        mock_session.request.side_effect = aiohttp.ClientConnectionError('Connection refused')
+        mock_get_session.return_value = mock_session
+        started_at = time.monotonic()
+
+        with pytest.raises(handler.DeadlineExceeded, match='time budget of 0.5s'):
+            asyncio.run(handler.send_get_request('queue', handler.Deadline(0.5)))
+
+        assert time.monotonic() - started_at < 2
+
+    @patch('handler.get_http_session')
+    def test_hung_comfyui_exceeds_deadline(self, mock_get_session):
+        import time
+        import handler
+
+        def hang(*args, **kwargs):
+            time.sleep(0.1)
+            raise asyncio.TimeoutError()
+
+        mock_session = MagicMock()
+        mock_session.request.side_effect = hang
+        mock_get_session.return_value = mock_session
+
+        with pytest.raises(handler.DeadlineExceeded, match='waiting for ComfyUI to respond to history/123'):
+            asyncio.run(handler.send_get_request('history/123', handler.Deadline(0.05)))
+
+        with pytest.raises(asyncio.TimeoutError, match='did not respond to history/123 within 5s'):
+            asyncio.run(handler.send_get_request('history/123', timeout=5))
+
+    def test_poll_interval_backs_off_to_maximum(self):
+        from handler import get_poll_interval, POLL_INTERVAL_MIN, POLL_INTERVAL_MAX
+
+        assert get_poll_interval(0, 0) == POLL_INTERVAL_MIN
+        assert get_poll_interval(1, 0) > POLL_INTERVAL_MIN
+        assert get_poll_interval(100, 0) == POLL_INTERVAL_MAX
+
+    def test_poll_interval_waits_for_expected_runtime(self):
+        from handler import get_poll_interval, POLL_INTERVAL_MIN
+
+        assert get_poll_interval(0, 1.0, expected_runtime=5.0) == 2.0
+        assert get_poll_interval(0, 6.0, expected_runtime=5.0) == POLL_INTERVAL_MIN
+
+    def test_record_runtime_smooths_values(self):
+        import handler
+
+        with patch.dict(handler.workflow_runtimes, clear=True):
+            handler.record_runtime('txt2img', 10.0)
+            assert handler.get_expected_runtime('txt2img') == 10.0
+
+            handler.record_runtime('txt2img', 20.0)
+            assert handler.get_expected_runtime('txt2img') == pytest.approx(13.0)
+            assert handler.get_expected_runtime('custom') is None
+
+
+class TestWaitForPrompt:
+    """Tests for waiting on a prompt to finish."""
+
+    @patch('handler.logging')
+    @patch('handler.send_get_request')
+    @patch('handler.asyncio.sleep')
+    def test_finished_prompt_retries_history_at_minimum_interval(self, mock_sleep, mock_get, mock_logging):
+        import handler
+
+        history = {'test-prompt-123': {'status': {}, 'outputs': {}}}
+        mock_get.side_effect = [
+            MagicMock(status_code=200, json=lambda: {}),
+            MagicMock(status_code=200, json=lambda: history)
+        ]
+        listener = MagicMock()
+        listener.wait = AsyncMock(return_value=True)
+
+        with patch.dict(handler.workflow_runtimes, {'txt2img': 60.0}):
+            result = asyncio.run(handler.wait_for_prompt(
+                'test-prompt-123', listener, 'txt2img', handler.Deadline(600), 'test-123'
+            ))
+
+        assert result == history['test-prompt-123']
+        mock_sleep.assert_called_once_with(handler.POLL_INTERVAL_MIN)
+
+    @patch('handler.logging')
+    @patch('handler.send_get_request')
+    @patch('handler.asyncio.sleep')
+    def test_unfinished_prompt_waits_for_expected_runtime(self, mock_sleep, mock_get, mock_logging):
+        import handler
+
+        history = {'test-prompt-123': {'status': {}, 'outputs': {}}}
+        mock_get.side_effect = [
+            MagicMock(status_code=200, json=lambda: {}),
+            MagicMock(status_code=200, json=lambda: history)
+        ]
+        listener = MagicMock()
+        listener.wait = AsyncMock(return_value=False)
+
+        with patch.dict(handler.workflow_runtimes, {'txt2img': 60.0}):
+            asyncio.run(handler.wait_for_prompt(
+                'test-prompt-123', listener, 'txt2img', handler.Deadline(600), 'test-123'
+            ))
+
+        assert mock_sleep.call_args[0][0] == handler.POLL_INTERVAL_MAX
+
+
+class TestWaitForService:
+    """Tests for wait_for_service function."""
+
+    @patch('handler.time.sleep')
+    @patch('handler.requests.get')
+    def test_returns_immediately_on_success(self, mock_get, mock_sleep):
+        from handler import wait_for_service
+
+        mock_get.return_value = MagicMock(status_code=200)
+
+        wait_for_service('http://localhost:3000')
+
+        mock_get.assert_called_once_with('http://localhost:3000')
+        mock_sleep.assert_not_called()
+
+    @patch('handler.logging')
+    @patch('handler.time.sleep')
+    @patch('handler.requests.get')
+    def test_retries_on_request_exception(self, mock_get, mock_sleep, mock_logging):
+        from handler import wait_for_service
+
+        mock_get.side_effect = [
+            requests.exceptions.ConnectionError(),
+            MagicMock(status_code=200)
+        ]
+
+        wait_for_service('http://localhost:3000')
+
+        assert mock_get.call_count == 2
+        assert mock_sleep.call_count == 1
+
+    @patch('handler.logging')
+    @patch('handler.time.sleep')
+    @patch('handler.requests.get')
+    def test_logs_every_15_retries(self, mock_get, mock_sleep, mock_logging):
+        from handler import wait_for_service
+
+        # Fail 15 times then succeed
+        side_effects = [requests.exceptions.ConnectionError()] * 15 + [MagicMock(status_code=200)]
+        mock_get.side_effect = side_effects
+
+        wait_for_service('http://localhost:3000')
+
+        assert mock_get.call_count == 16
+        mock_logging.info.assert_called()
+
+    @patch('handler.logging')
+    @patch('handler.time.sleep')
+    @patch('handler.requests.get')
+    def test_logs_on_general_exception(self, mock_get, mock_sleep, mock_logging):
+        from handler import wait_for_service
+
+        mock_get.side_effect = [
+            Exception('Some error'),
+            MagicMock(status_code=200)
+        ]
+
+        wait_for_service('http://localhost:3000')
+
+        mock_logging.error.assert_called()
+
+
+class FakeWebSocket:
+    """Async iterable standing in for an aiohttp websocket connection."""
+
+    def __init__(self, messages, hold_open=False):
+        self.messages = messages
+        self.closed = False
+        self.hold_open = hold_open
+        self.closed_event = asyncio.Event()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.messages and self.hold_open:
+            await self.closed_event.wait()
+
+        if not self.messages:
+            raise StopAsyncIteration
+
+        message = self.messages.pop(0)
+
+        if isinstance(message, Exception):
+            raise message
+
+        return message
+
+    async def close(self):
+        self.closed = True
+        self.closed_event.set()
+
+
+class TestComfyUIEventListener:
+    """Tests for the ComfyUI websocket event listener."""
+
+    def test_connect_failure_falls_back_to_polling(self):
+        from handler import ComfyUIEventListener
+
+        async def run():
+            listener = ComfyUIEventListener('client-123')
+            connected = await listener.connect()
+            finished = await listener.wait('test-prompt-123')
+            return connected, finished
+
+        assert asyncio.run(run()) == (False, False)
+
+    def test_executing_none_marks_prompt_finished(self):
+        from handler import ComfyUIEventListener
+
+        listener = ComfyUIEventListener('client-123')
+        listener.connected = True
+        listener.handle_message({
+            'type': 'executing',
+            'data': {'node': None, 'prompt_id': 'test-prompt-123'}
+        })
+
+        assert asyncio.run(listener.wait('test-prompt-123', timeout=0)) is True
+
+    def test_executing_node_does_not_finish_prompt(self):
+        from handler import ComfyUIEventListener
+
+        listener = ComfyUIEventListener('client-123')
+        listener.connected = True
+        listener.handle_message({
+            'type': 'executing',
+            'data': {'node': '3', 'prompt_id': 'test-prompt-123'}
+        })
+
+        assert asyncio.run(listener.wait('test-prompt-123', timeout=0)) is False
+
+    def test_execution_error_marks_prompt_finished(self):
+        from handler import ComfyUIEventListener
+
+        listener = ComfyUIEventListener('client-123')
+        listener.connected = True
+        listener.handle_message({
+            'type': 'execution_error',
+            'data': {'prompt_id': 'test-prompt-123'}
+        })
+
+        assert asyncio.run(listener.wait('test-prompt-123', timeout=0)) is True
+
+    def test_listener_wakes_on_websocket_message(self, no_comfyui_websocket):
+        import aiohttp
+        from handler import ComfyUIEventListener
+
+        ws = FakeWebSocket([
+            MagicMock(type=aiohttp.WSMsgType.BINARY, data=b'preview image bytes'),
+            MagicMock(
+                type=aiohttp.WSMsgType.TEXT,
+                data=json.dumps({'type': 'execution_success', 'data': {'prompt_id': 'test-prompt-123'}})
+            )
+        ])
+        no_comfyui_websocket.side_effect = None
+        no_comfyui_websocket.return_value = ws
+
+        async def run():
+            listener = ComfyUIEventListener('client-123')
+            assert await listener.connect() is True
+            finished = await listener.wait('test-prompt-123', timeout=5)
+            await listener.close()
+            return finished
+
+        assert asyncio.run(run()) is True
+        assert ws.closed is True
+        no_comfyui_websocket.assert_called_once_with('client-123')
+
+    def test_wait_returns_when_websocket_drops(self, no_comfyui_websocket):
+        from handler import ComfyUIEventListener
+
+        no_comfyui_websocket.side_effect = None
+        no_comfyui_websocket.return_value = FakeWebSocket([ConnectionResetError()])
+
+        async def run():
+            listener = ComfyUIEventListener('client-123')
+            await listener.connect()
+            finished = await listener.wait('test-prompt-123', timeout=5)
+            return finished, listener.connected
+
+        assert asyncio.run(run()) == (False, False)
+
+
+class TestProgressReporter:
+    """Tests for Runpod progress updates from ComfyUI events."""
+
+    workflow = {
+        '3': {'class_type': 'KSampler', 'inputs': {}},
+        '8': {'class_type': 'VAEDecode', 'inputs': {}}
+    }
+
+    @patch('handler.runpod.serverless.progress_update')
+    def test_executing_sends_node_update(self, mock_progress):
+        from handler import ProgressReporter
+
+        job = {'id': 'test-123'}
+        reporter = ProgressReporter(job, self.workflow, interval=0)
+        reporter.handle_event('executing', {'node': '3', 'prompt_id': 'p'})
+
+        job_arg, progress = mock_progress.call_args[0]
+        assert job_arg is job
+        assert progress['node'] == '3'
+        assert progress['class_type'] == 'KSampler'
+        assert progress['step'] is None
+
+    @patch('handler.time.monotonic')
+    @patch('handler.runpod.serverless.progress_update')
+    def test_progress_reports_step_and_eta(self, mock_progress, mock_monotonic):
+        from handler import ProgressReporter
+
+        mock_monotonic.return_value = 100.0
+        reporter = ProgressReporter({'id': 'test-123'}, self.workflow, interval=0)
+        reporter.handle_event('progress', {'node': '3', 'value': 1, 'max': 21})
+        mock_monotonic.return_value = 104.0
+        reporter.handle_event('progress', {'node': '3', 'value': 5, 'max': 21})
+
+        progress = mock_progress.call_args[0][1]
+        assert progress['step'] == 5
+        assert progress['steps'] == 21
+        assert progress['eta'] == 16.0
+        assert progress['elapsed'] == 4.0
+
+    @patch('handler.runpod.serverless.progress_update')
+    def test_updates_are_throttled(self, mock_progress):
+        from handler import ProgressReporter
+
+        reporter = ProgressReporter({'id': 'test-123'}, self.workflow, interval=60)
+
+        for step in range(1, 20):
+            reporter.handle_event('progress', {'node': '3', 'value': step, 'max': 20})
+
+        assert mock_progress.call_count == 1
+
+        # The final step of a node is always reported
+        reporter.handle_event('progress', {'node': '3', 'value': 20, 'max': 20})
+        assert mock_progress.call_count == 2
+
+    @patch('handler.runpod.serverless.progress_update')
+    def test_listener_forwards_events_to_subscribers(self, mock_progress):
+        from handler import ComfyUIEventListener, ProgressReporter
+
+        listener = ComfyUIEventListener('client-123')
+        listener.subscribe(ProgressReporter({'id': 'test-123'}, self.workflow, interval=0).handle_event)
+        listener.handle_message({'type': 'executing', 'data': {'node': '8', 'prompt_id': 'p'}})
+
+        assert mock_progress.call_args[0][1]['class_type'] == 'VAEDecode'
+
+
+class TestOutputFiles:
+    """Tests for reading outputs from the local output directory."""
+
+    def test_output_file_path_includes_subfolder(self):
+        import handler
+
+        with patch('handler.OUTPUT_PATH', '/tmp/output'):
+            assert handler.get_output_file_path({'filename': 'a.png', 'subfolder': ''}) == '/tmp/output/a.png'
+            assert handler.get_output_file_path({'filename': 'a.png', 'subfolder': 'video'}) == '/tmp/output/video/a.png'
+
+    @patch('handler.logging')
+    def test_outputs_are_only_persisted_to_volume_on_request(self, mock_logging, tmp_path):
+        import handler
+
+        output_path = tmp_path / 'output'
+        volume_path = tmp_path / 'volume'
+        output_path.mkdir()
+
+        for i in range(2):
+            (output_path / f'image_{i}.png').write_bytes(f'image {i}'.encode())
+
+        output_image = {'filename': 'image_0.png', 'subfolder': '', 'type': 'output'}
+
+        with patch('handler.OUTPUT_PATH', str(output_path)), patch('handler.VOLUME_OUTPUT_PATH', str(volume_path)):
+            result = handler.process_output_image(output_image, 'job-1')
+
+            assert result == {'image': base64.b64encode(b'image 0').decode('utf-8')}
+            assert not volume_path.exists()
+
+            output_image['filename'] = 'image_1.png'
+            result = handler.process_output_image(output_image, 'job-1', persist=True)
+
+        assert result['path'] == str(volume_path / 'image_1.png')
+        assert (volume_path / 'image_1.png').read_bytes() == b'image 1'
+        assert list(output_path.iterdir()) == []
+
+
+class TestOutputEncoding:
+    """Tests for the bounded-memory output encoder."""
+
+    def test_encodes_file_in_chunks(self, tmp_path):
+        import handler
+
+        data = os.urandom(100_001)
+        file_path = tmp_path / 'image.png'
+        file_path.write_bytes(data)
+
+        with patch('handler.ENCODE_CHUNK_SIZE', 3 * 1024):
+            assert handler.encode_file(str(file_path)) == base64.b64encode(data).decode('utf-8')
+
+    def test_tracks_peak_encoder_memory(self, tmp_path):
+        import handler
+
+        file_path = tmp_path / 'image.png'
+        file_path.write_bytes(b'x' * 3000)
+
+        async def encode():
+            encoder_memory = handler.track_encoder_memory()
+            image = await asyncio.to_thread(handler.encode_file, str(file_path))
+            return image, encoder_memory
+
+        with patch('handler.ENCODE_CHUNK_SIZE', 300):
+            image, encoder_memory = asyncio.run(encode())
+
+        # The encoded buffer, one chunk and the encoded string at their peak,
+        # with only the encoded string still held afterwards
+        assert encoder_memory.peak == 4000 + 300 + 4000
+        assert encoder_memory.current == len(image) == 4000
+
+    def test_streamed_images_are_released(self):
+        import handler
+
+        encoder_memory = handler.EncoderMemory()
+        encoder_memory.allocate(8)
+
+        handler.release_streamed_image({'image': 'aGVsbG8='}, 'base64', encoder_memory)
+        handler.release_streamed_image({'image': 'https://bucket.example.com/key'}, 's3', encoder_memory)
+
+        assert encoder_memory.current == 0
+        assert encoder_memory.peak == 8
+
+
+class TestResponseOverflow:
+    """Tests for switching storage when the response would be too large."""
+
+    def write_outputs(self, tmp_path, sizes):
+        for i, size in enumerate(sizes):
+            (tmp_path / f'image_{i}.png').write_bytes(b'x' * size)
+
+        return [
+            {'filename': f'image_{i}.png', 'type': 'output', 'node_id': '9', 'batch_index': i}
+            for i in range(len(sizes))
+        ]
+
+    def test_estimates_encoded_size_up_to_max_images(self, tmp_path):
+        import handler
+
+        output_images = self.write_outputs(tmp_path, [3, 4, 300])
+
+        with patch('handler.OUTPUT_PATH', str(tmp_path)):
+            assert handler.estimate_response_size(output_images, None) == 4 + 8 + 400
+            assert handler.estimate_response_size(output_images, 2) == 4 + 8
+
+    @patch('handler.logging')
+    def test_keeps_base64_within_limit(self, mock_logging, tmp_path):
+        import handler
+
+        output_images = self.write_outputs(tmp_path, [300, 300])
+
+        with patch('handler.OUTPUT_PATH', str(tmp_path)), patch('handler.MAX_RESPONSE_SIZE', 800):
+            assert handler.get_response_storage(output_images, None, 'base64', 'job-1') == 'base64'
+
+    @patch('handler.logging')
+    def test_switches_to_bucket_when_configured(self, mock_logging, tmp_path):
+        import handler
+
+        output_images = self.write_outputs(tmp_path, [300, 300])
+
+        with patch('handler.OUTPUT_PATH', str(tmp_path)), \
+                patch('handler.MAX_RESPONSE_SIZE', 799), \
+                patch('handler.is_bucket_configured', return_value=True):
+            assert handler.get_response_storage(output_images, None, 'base64', 'job-1') == 's3'
+
+    @patch('handler.logging')
+    def test_persists_to_volume_without_bucket(self, mock_logging, tmp_path):
+        import handler
+
+        output_path = tmp_path / 'output'
+        volume_path = tmp_path / 'volume'
+        output_path.mkdir()
+        output_images = self.write_outputs(output_path, [300, 300])
+
+        with patch('handler.OUTPUT_PATH', str(output_path)), \
+                patch('handler.VOLUME_OUTPUT_PATH', str(volume_path)), \
+                patch('handler.MAX_RESPONSE_SIZE', 799), \
+                patch('handler.is_bucket_configured', return_value=False):
+            storage = handler.get_response_storage(output_images, None, 'base64', 'job-1')
+            images = asyncio.run(handler.encode_output_images(output_images, 'job-1', storage=storage))
+
+        assert storage == 'volume'
+        assert [image['image'] for image in images] == [
+            str(volume_path / 'image_0.png'), str(volume_path / 'image_1.png')
+        ]
+        assert (volume_path / 'image_1.png').read_bytes() == b'x' * 300
+        assert list(output_path.iterdir()) == []
+
+    @patch('handler.logging')
+    def test_estimates_transcoded_size(self, mock_logging, tmp_path):
+        from PIL import Image
+        import handler
+
+        Image.new('RGB', (512, 512), (255, 0, 0)).save(tmp_path / 'image_0.png', format='PNG', compress_level=0)
+        output_images = [{'filename': 'image_0.png', 'type': 'output', 'node_id': '9', 'batch_index': 0}]
+        output_options = {'format': 'webp', 'quality': 90, 'max_dimension': None}
+
+        with patch('handler.OUTPUT_PATH', str(tmp_path)), patch('handler.MAX_RESPONSE_SIZE', 100000):
+            assert handler.estimate_response_size(output_images, None) > 100000
+
+            output_images = asyncio.run(
+                handler.prepare_output_images(output_images, 'job-1', output_options=output_options)
+            )
+            storage = handler.get_response_storage(output_images, None, 'base64', 'job-1')
+            images = asyncio.run(
+                handler.encode_output_images(output_images, 'job-1', storage=storage, output_options=output_options)
+            )
+
+        assert storage == 'base64'
+        assert output_images[0]['path'] == str(tmp_path / 'image_0.webp')
+        assert base64.b64decode(images[0]['image'])[8:12] == b'WEBP'
+        assert list(tmp_path.iterdir()) == []
+
+
+class TestPngMetadata:
+    """Tests for stripping the embedded workflow from output PNGs."""
+
+    def write_png(self, path):
+        from PIL import Image, PngImagePlugin
+
+        pnginfo = PngImagePlugin.PngInfo()
+        pnginfo.add_text('prompt', json.dumps({'3': {'class_type': 'KSampler'}}))
+        pnginfo.add_text('workflow', json.dumps({'nodes': list(range(500))}), zip=True)
+        pnginfo.add_text('parameters', 'steps: 20')
+        Image.new('RGB', (16, 16), 'red').save(path, format='PNG', pnginfo=pnginfo)
+
+    def test_removes_prompt_and_workflow_chunks(self, tmp_path):
+        from PIL import Image
+        from handler import strip_png_metadata
+
+        image_path = tmp_path / 'image.png'
+        self.write_png(image_path)
+        original_size = image_path.stat().st_size
+
+        with Image.open(image_path) as image:
+            original_pixels = image.tobytes()
+
+        removed = strip_png_metadata(str(image_path))
+
+        assert removed > 0
+        assert image_path.stat().st_size == original_size - removed
+
+        with Image.open(image_path) as image:
+            assert set(image.text) == {'parameters'}
+            assert image.tobytes() == original_pixels
+
+        assert list(tmp_path.iterdir()) == [image_path]
+
+    def test_ignores_files_without_metadata(self, tmp_path):
+        from handler import strip_png_metadata
+
+        video_path = tmp_path / 'clip.mp4'
+        video_path.write_bytes(b'not a png')
+
+        assert strip_png_metadata(str(video_path)) == 0
+        assert video_path.read_bytes() == b'not a png'
+
+    @patch('handler.logging')
+    def test_reports_bytes_removed(self, mock_logging, tmp_path):
+        import handler
+
+        self.write_png(tmp_path / 'image.png')
+        output_image = {'filename': 'image.png', 'type': 'output'}
+
+        with patch('handler.OUTPUT_PATH', str(tmp_path)):
+            result = handler.process_output_image(output_image, 'job-1', strip_metadata=True)
+
+        assert result['metadata_bytes_removed'] > 0
+
+
+class TestOutputPool:
+    """Tests for processing output images concurrently."""
+
+    def test_images_are_processed_concurrently_up_to_pool_size(self):
+        import threading
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+        import handler
+
+        lock = threading.Lock()
+        running = []
+        max_running = []
+
+        def process_output_image(output_image, job_id, encode, storage, output_options, persist, strip_metadata):
+            with lock:
+                running.append(output_image['batch_index'])
+                max_running.append(len(running))
+
+            # Later images finish first, the results must still be in order
+            time.sleep(0.05 * (4 - output_image['batch_index']))
+
+            with lock:
+                running.remove(output_image['batch_index'])
+
+            return {'image': f"image {output_image['batch_index']}"}
+
+        output_images = [
+            {'filename': f'image_{i}.png', 'type': 'output', 'node_id': '9', 'batch_index': i} for i in range(4)
+        ]
+
+        with ThreadPoolExecutor(max_workers=2) as pool, \
+                patch('handler.output_pool', pool), \
+                patch('handler.process_output_image', side_effect=process_output_image):
+            images = asyncio.run(handler.encode_output_images(output_images, 'job-1'))
+
+        assert [image['image'] for image in images] == ['image 0', 'image 1', 'image 2', 'image 3']
+        assert max(max_running) == 2
+
+
+class TestOutputTranscoding:
+    """Tests for transcoding output images."""
+
+    def write_image(self, path, size=(256, 128), mode='RGBA'):
+        from PIL import Image
+
+        Image.new(mode, size, (255, 0, 0, 255) if mode == 'RGBA' else (255, 0, 0)).save(path, format='PNG')
+
+    def test_transcodes_to_webp_and_replaces_original(self, tmp_path):
+        from PIL import Image
+        from handler import transcode_output_file
+
+        image_path = tmp_path / 'image.png'
+        self.write_image(image_path)
+
+        result = transcode_output_file(str(image_path), {'format': 'webp', 'quality': 90, 'max_dimension': None})
+
+        assert result == str(tmp_path / 'image.webp')
+        assert not image_path.exists()
+
+        with Image.open(result) as image:
+            assert image.format == 'WEBP'
+            assert image.size == (256, 128)
+
+    def test_jpeg_drops_alpha_and_scales_down(self, tmp_path):
+        from PIL import Image
+        from handler import transcode_output_file
+
+        image_path = tmp_path / 'image.png'
+        self.write_image(image_path)
+
+        result = transcode_output_file(str(image_path), {'format': 'jpeg', 'quality': 80, 'max_dimension': 64})
+
+        with Image.open(result) as image:
+            assert image.format == 'JPEG'
+            assert image.mode == 'RGB'
+            assert image.size == (64, 32)
+
+    def test_animated_images_are_not_transcoded(self, tmp_path):
+        from PIL import Image
+        from handler import transcode_output_file
+
+        image_path = tmp_path / 'image.webp'
+        frames = [Image.new('RGB', (32, 32), color) for color in ('red', 'blue')]
+        frames[0].save(image_path, format='WEBP', save_all=True, append_images=frames[1:])
+
+        result = transcode_output_file(str(image_path), {'format': 'jpeg', 'quality': 90, 'max_dimension': None})
+
+        assert result == str(image_path)
+        assert image_path.exists()
+
+    def test_png_is_not_transcoded_by_default(self):
+        from handler import get_output_options
+
+        job_input = {'output_format': None, 'output_quality': 90, 'max_dimension': None}
+
+        assert get_output_options(job_input) is None
+        assert get_output_options({**job_input, 'max_dimension': 512}) == {
+            'format': 'png', 'quality': 90, 'max_dimension': 512
+        }
+
+    def test_output_quality_defaults_to_90_and_is_limited_to_1_to_100(self):
+        from runpod.serverless.utils.rp_validator import validate
+        from schemas.input import INPUT_SCHEMA
+        from handler import get_output_options
+
+        for output_quality in (0, 101, 500):
+            result = validate({'payload': {}, 'output_quality': output_quality}, INPUT_SCHEMA)
+            assert result['errors'] == ['output_quality does not meet the constraints.']
+
+        job_input = validate({'payload': {}, 'output_format': 'jpeg'}, INPUT_SCHEMA)['validated_input']
+        assert get_output_options(job_input)['quality'] == 90
+        assert get_output_options({**job_input, 'output_quality': 100})['quality'] == 100
+
+    def test_unsupported_format_is_rejected(self):
+        from handler import get_output_options
+
+        with patch('handler.features.check', return_value=False):
+            with pytest.raises(ValueError, match='avif'):
+                get_output_options({'output_format': 'avif', 'output_quality': 90, 'max_dimension': None})
+
+    @patch('handler.logging')
+    def test_encode_output_images_transcodes_in_order(self, mock_logging, tmp_path):
+        import handler
+
+        for i in range(3):
+            self.write_image(tmp_path / f'image_{i}.png', size=(32 * (i + 1), 32))
+
+        output_images = [
+            {'filename': f'image_{i}.png', 'type': 'output', 'node_id': '9', 'batch_index': i} for i in range(3)
+        ]
+        output_options = {'format': 'webp', 'quality': 90, 'max_dimension': None}
+
+        with patch('handler.OUTPUT_PATH', str(tmp_path)):
+            images = asyncio.run(handler.encode_output_images(output_images, 'job-1', output_options=output_options))
+
+        assert [image['batch_index'] for image in images] == [0, 1, 2]
+
+        for image in images:
+            assert base64.b64decode(image['image'])[8:12] == b'WEBP'
+
+        assert list(tmp_path.iterdir()) == []
+
+
+class TestWorkflowGraph:
+    """Tests for validating the graph of custom workflows."""
+
+    @patch('handler.logging')
+    def test_accepts_workflow_templates(self, mock_logging):
+        from handler import validate_workflow_graph, workflow_templates
+
+        for name in ('txt2img', 'img2img'):
+            assert validate_workflow_graph(workflow_templates.get(name)[0]) == []
+
+    def test_reports_broken_links_and_nodes(self):
+        from handler import validate_workflow_graph
+
+        workflow = {
+            '1': {'class_type': 'LoadImage', 'inputs': {'image': 'source.png'}},
+            '2': {'inputs': {}},
+            '3': {'class_type': 'ImageScale', 'inputs': {'image': ['7', 0], 'width': ['1']}},
+            '4': {'class_type': 'ImageInvert', 'inputs': {'image': [1, 0]}},
+            '5': {'class_type': 'ImageInvert', 'inputs': ['image']},
+            '9': {'class_type': 'SaveImage', 'inputs': {'images': ['1', 0]}}
+        }
+
+        assert validate_workflow_graph(workflow) == [
+            {'type': 'missing_class_type', 'node_id': '2', 'message': 'Node 2 has no class_type'},
+            {'type': 'dangling_link', 'node_id': '3', 'input': 'image',
+             'message': 'Input image of node 3 links to missing node 7'},
+            {'type': 'invalid_link', 'node_id': '3', 'input': 'width',
+             'message': 'Input width of node 3 must be a [node_id, slot] link'},
+            {'type': 'invalid_link', 'node_id': '4', 'input': 'image',
+             'message': 'Input image of node 4 must be a [node_id, slot] link'},
+            {'type': 'invalid_inputs', 'node_id': '5', 'message': 'Inputs of node 5 must be an object'}
+        ]
+
+    def test_reports_cycles_and_missing_output_node(self):
+        from handler import validate_workflow_graph
+
+        workflow = {
+            '1': {'class_type': 'ImageInvert', 'inputs': {'image': ['3', 0]}},
+            '2': {'class_type': 'ImageInvert', 'inputs': {'image': ['1', 0]}},
+            '3': {'class_type': 'ImageInvert', 'inputs': {'image': ['2', 0]}},
+            '4': {'class_type': 'ImageInvert', 'inputs': {'image': ['3', 0]}},
+            '5': {'class_type': 'LoadImage', 'inputs': {'image': 'source.png'}}
+        }
+
+        errors = validate_workflow_graph(workflow)
+
+        assert [error['type'] for error in errors] == ['cycle', 'no_output_node']
+        assert errors[0]['node_ids'] == ['1', '2', '3', '4']
+        assert validate_workflow_graph([]) == [
+            {'type': 'invalid_workflow', 'message': 'Workflow must be an object of nodes keyed by node id'}
+        ]
+
+    def test_recognises_output_nodes(self):
+        from handler import is_output_node
+
+        assert is_output_node('SaveImage')
+        assert is_output_node('PreviewImage')
+        assert is_output_node('VHS_VideoCombine')
+        assert is_output_node('SaveGLB')
+        assert not is_output_node('KSampler')
+
+    @patch('handler.logging')
+    @patch('handler.get_container_memory_info')
+    @patch('handler.get_container_cpu_info')
+    @patch('handler.get_container_disk_info')
+    @patch('handler.ComfyUIEventListener')
+    @patch('handler.send_post_request')
+    def test_handler_rejects_broken_graph_before_connecting(
+        self, mock_post, mock_listener, mock_disk, mock_cpu, mock_memory, mock_logging
+    ):
+        import handler
+
+        mock_memory.return_value = {'available': 10.0}
+        mock_cpu.return_value = {}
+        mock_disk.return_value = {'free_bytes': 10 * 1024 * 1024 * 1024}
+        event = {
+            'id': 'test-123',
+            'input': {
+                'workflow': 'custom',
+                'payload': {'9': {'class_type': 'SaveImage', 'inputs': {'images': ['8', 0]}}}
+            }
+        }
+
+        result = asyncio.run(handler.handler(event))
+
+        assert result == {
+            'error': 'Invalid workflow: Input images of node 9 links to missing node 8',
+            'output': [{
+                'type': 'dangling_link', 'node_id': '9', 'input': 'images',
+                'message': 'Input images of node 9 links to missing node 8'
+            }]
+        }
+        mock_listener.assert_not_called()
+        mock_post.assert_not_called()
+
+
+class TestPreflight:
+    """Tests for checking workflows against the node definitions of ComfyUI."""
+
+    object_info = {
+        'CheckpointLoaderSimple': {
+            'input': {'required': {'ckpt_name': [['sd_xl_base_1.0.safetensors', 'flux1-dev.safetensors'], {}]}},
+            'output_node': False
+        },
+        'KSampler': {
+            'input': {
+                'required': {
+                    'model': ['MODEL'],
+                    'seed': ['INT', {'default': 0, 'min': 0, 'max': 0xffffffffffffffff}],
+                    'steps': ['INT', {'default': 20, 'min': 1, 'max': 10000}],
+                    'cfg': ['FLOAT', {'default': 8.0, 'min': 0.0, 'max': 100.0}],
+                    'sampler_name': ['COMBO', {'options': ['euler', 'dpmpp_2m']}]
+                },
+                'optional': {'denoise': ['FLOAT', {'min': 0.0, 'max': 1.0}]}
+            },
+            'output_node': False
+        },
+        'LoadImage': {
+            'input': {'required': {'image': [['example.png'], {'image_upload': True}]}},
+            'output_node': False
+        },
+        'Image Save': {
+            'input': {'required': {'images': ['IMAGE']}},
+            'output_node': True
+        },
+        'Latent Save': {
+            'input': {'required': {'samples': ['LATENT']}},
+            'output_node': True
+        }
+    }
+
+    workflow = {
+        '1': {'class_type': 'CheckpointLoaderSimple', 'inputs': {'ckpt_name': 'sd_xl_base_1.0.safetensors'}},
+        '2': {'class_type': 'KSampler', 'inputs': {
+            'model': ['1', 0], 'seed': 5, 'steps': 20, 'cfg': 7.5, 'sampler_name': 'euler'
+        }},
+        '3': {'class_type': 'LoadImage', 'inputs': {'image': 'store/uploaded.png'}},
+        '4': {'class_type': 'Image Save', 'inputs': {'images': ['3', 0]}},
+        '5': {'class_type': 'Latent Save', 'inputs': {'samples': ['2', 0]}}
+    }
+
+    def test_accepts_valid_workflow(self):
+        from handler import NodeSchemas
+
+        assert NodeSchemas(self.object_info).check(self.workflow) == []
+
+    def test_reports_invalid_nodes_and_values(self):
+        from handler import NodeSchemas
+
+        workflow = json.loads(json.dumps(self.workflow))
+        workflow['1']['inputs']['ckpt_name'] = 'sd_xl_base.safetensors'
+        workflow['2']['inputs'].update({'steps': 0, 'denoise': 1.5, 'sampler_name': 'eluer'})
+        del workflow['2']['inputs']['cfg']
+        workflow['6'] = {'class_type': 'MissingNode', 'inputs': {}}
+
+        errors = NodeSchemas(self.object_info).check(workflow)
+
+        assert [(error['type'], error['node_id'], error.get('input')) for error in errors] == [
+            ('value_not_in_choices', '1', 'ckpt_name'),
+            ('value_out_of_range', '2', 'steps'),
+            ('missing_input', '2', 'cfg'),
+            ('value_not_in_choices', '2', 'sampler_name'),
+            ('value_out_of_range', '2', 'denoise'),
+            ('unknown_class_type', '6', None)
+        ]
+        assert errors[0]['message'] == (
+            'Input ckpt_name of node 1 is not one of the available choices: sd_xl_base.safetensors'
+        )
+
+    def test_ignores_nodes_that_are_not_executed(self):
+        from handler import NodeSchemas
+
+        workflow = json.loads(json.dumps(self.workflow))
+        workflow['6'] = {'class_type': 'CheckpointLoaderSimple', 'inputs': {'ckpt_name': 'removed.safetensors'}}
+        workflow['7'] = {'class_type': 'KSampler', 'inputs': {'model': ['6', 0], 'steps': 0}}
+
+        assert NodeSchemas(self.object_info).check(workflow) == []
+
+        workflow['5']['inputs']['samples'] = ['7', 0]
+
+        assert [(error['type'], error['node_id']) for error in NodeSchemas(self.object_info).check(workflow)] == [
+            ('value_not_in_choices', '6'),
+            ('missing_input', '7'),
+            ('value_out_of_range', '7'),
+            ('missing_input', '7'),
+            ('missing_input', '7')
+        ]
+
+    def test_output_nodes_come_from_node_definitions(self):
+        from handler import NodeSchemas, validate_workflow_graph
+
+        schemas = NodeSchemas(self.object_info)
+
+        assert schemas.output_node_types == {'Image Save', 'Latent Save'}
+        assert validate_workflow_graph(self.workflow, schemas.output_node_types) == []
+        assert [error['type'] for error in validate_workflow_graph(self.workflow)] == ['no_output_node']
+
+    @patch('handler.logging')
+    def test_loads_definitions_again_when_custom_nodes_change(self, mock_logging, no_comfyui_object_info, tmp_path):
+        import handler
+
+        no_comfyui_object_info.side_effect = lambda signature, deadline: handler.NodeSchemas(self.object_info, signature)
+
+        with patch('handler.CUSTOM_NODES_PATH', str(tmp_path)):
+            first = asyncio.run(handler.get_node_schemas())
+            assert asyncio.run(handler.get_node_schemas()) is first
+
+            (tmp_path / 'ComfyUI-Custom-Scripts').mkdir()
+            second = asyncio.run(handler.get_node_schemas())
+
+        assert second is not first
+        assert no_comfyui_object_info.call_count == 2
+
+    @patch('handler.logging')
+    def test_loads_definitions_again_before_rejecting_models(self, mock_logging, no_comfyui_object_info):
+        import handler
+
+        object_info = json.loads(json.dumps(self.object_info))
+        stale = handler.NodeSchemas(self.object_info, handler.get_custom_nodes_signature())
+        object_info['CheckpointLoaderSimple']['input']['required']['ckpt_name'][0].append('new.safetensors')
+        no_comfyui_object_info.side_effect = lambda signature, deadline: handler.NodeSchemas(object_info, signature)
+        workflow = json.loads(json.dumps(self.workflow))
+        workflow['1']['inputs']['ckpt_name'] = 'new.safetensors'
+
+        with patch('handler.node_schemas', stale):
+            assert asyncio.run(handler.preflight_workflow(workflow, None, 'job-1')) == []
+
+            workflow['1']['inputs']['ckpt_name'] = 'missing.safetensors'
+            errors = asyncio.run(handler.preflight_workflow(workflow, None, 'job-1'))
+
+        assert [error['type'] for error in errors] == ['value_not_in_choices']
+        assert no_comfyui_object_info.call_count == 2
+
+    @patch('handler.logging')
+    def test_loading_definitions_uses_the_job_deadline(self, mock_logging, no_comfyui_object_info):
+        import handler
+
+        deadline = handler.Deadline(10)
+        no_comfyui_object_info.side_effect = handler.DeadlineExceeded('Job exceeded its timeout')
+
+        with pytest.raises(handler.DeadlineExceeded):
+            asyncio.run(handler.preflight_workflow(self.workflow, deadline, 'job-1'))
+
+        no_comfyui_object_info.assert_called_once_with(handler.get_custom_nodes_signature(), deadline)
+
+    @patch('handler.logging')
+    def test_skips_preflight_without_definitions(self, mock_logging):
+        import handler
+
+        assert asyncio.run(handler.preflight_workflow({'1': {'class_type': 'MissingNode'}}, None, 'job-1')) == []
+        mock_logging.warning.assert_called_once()
+
+    @patch('handler.logging')
+    @patch('handler.get_container_memory_info')
+    @patch('handler.get_container_cpu_info')
+    @patch('handler.get_container_disk_info')
+    @patch('handler.send_post_request')
+    def test_handler_rejects_unknown_model_without_refreshing_worker(
+        self, mock_post, mock_disk, mock_cpu, mock_memory, mock_logging
+    ):
+        import handler
+
+        mock_memory.return_value = {'available': 10.0}
+        mock_cpu.return_value = {}
+        mock_disk.return_value = {'free_bytes': 10 * 1024 * 1024 * 1024}
+        workflow = json.loads(json.dumps(self.workflow))
+        workflow['1']['inputs']['ckpt_name'] = 'sdxl.safetensors'
+        event = {'id': 'test-123', 'input': {'workflow': 'custom', 'payload': workflow}}
+
+        with patch('handler.node_schemas', handler.NodeSchemas(self.object_info, handler.get_custom_nodes_signature())):
+            result = asyncio.run(handler.handler(event))
+
+        assert result['error'] == (
+            'Invalid workflow: Input ckpt_name of node 1 is not one of the available choices: sdxl.safetensors'
+        )
+        assert 'refresh_worker' not in result
+        mock_post.assert_not_called()
+
+
+class TestInputImages:
+    """Tests for uploading input images to ComfyUI."""
+
+    payload = {
+        '10': {'class_type': 'LoadImage', 'inputs': {'image': 'source.png'}},
+        '11': {'class_type': 'LoadImage', 'inputs': {'image': 'inpaint.png'}},
+        '12': {'class_type': 'CLIPTextEncode', 'inputs': {'text': 'source.png'}},
+        '13': {'class_type': 'SaveImage', 'inputs': {'images': ['10', 0], 'filename_prefix': 'test'}}
+    }
+
+    def upload_response(self, endpoint, form, deadline=None):
+        return MagicMock(status_code=200, json=lambda: {'name': form['image'][0], 'subfolder': form['subfolder']})
+
+    @patch('handler.logging')
+    @patch('handler.send_form_request')
+    def test_uploads_images_and_rewrites_references(self, mock_form, mock_logging, tmp_path):
+        import handler
+
+        mock_form.side_effect = self.upload_response
+        payload = json.loads(json.dumps(self.payload))
+        input_images = [
+            {'name': 'source.png', 'image': base64.b64encode(b'source').decode('utf-8')},
+            {'name': 'inpaint.png', 'image': 'data:image/png;base64,' + base64.b64encode(b'mask').decode('utf-8'),
+             'type': 'mask', 'original': 'source.png'}
+        ]
+        source_name = hashlib.sha256(b'source').hexdigest() + '.png'
+        mask_name = hashlib.sha256(source_name.encode('utf-8') + b'mask').hexdigest() + '.png'
+
+        with patch('handler.INPUT_PATH', str(tmp_path)), patch.object(handler, 'input_store_jobs', set()):
+            images = asyncio.run(handler.load_input_images(input_images, None, 'job-1'))
+            uploaded, hits = asyncio.run(handler.upload_input_images(images, payload, None, 'job-1'))
+            assert handler.input_store_jobs == {'job-1'}
+
+        assert uploaded == {'source.png': f'store/{source_name}', 'inpaint.png': f'store/{mask_name}'}
+        assert hits == 0
+        assert payload['10']['inputs']['image'] == f'store/{source_name}'
+        assert payload['11']['inputs']['image'] == f'store/{mask_name}'
+        assert payload['12']['inputs']['text'] == f'store/{source_name}'
+
+        (image_endpoint, image_form), (mask_endpoint, mask_form) = [c[0][:2] for c in mock_form.call_args_list]
+        assert image_endpoint == 'upload/image'
+        assert image_form['image'] == (source_name, b'source', 'image/png')
+        assert image_form['subfolder'] == 'store'
+        assert mask_endpoint == 'upload/mask'
+        assert mask_form['image'][1] == b'mask'
+        assert json.loads(mask_form['original_ref']) == {
+            'filename': source_name, 'subfolder': 'store', 'type': 'input'
+        }
+
+    @patch('handler.logging')
+    @patch('handler.send_form_request')
+    def test_skips_upload_of_stored_images(self, mock_form, mock_logging, tmp_path):
+        import handler
+
+        mock_form.side_effect = self.upload_response
+        source_name = hashlib.sha256(b'source').hexdigest() + '.png'
+        (tmp_path / 'store').mkdir()
+        (tmp_path / 'store' / source_name).write_bytes(b'source')
+        os.utime(tmp_path / 'store' / source_name, (0, 0))
+        input_images = [
+            {'name': 'source.png', 'image': base64.b64encode(b'source').decode('utf-8')},
+            {'name': 'other.jpg', 'image': base64.b64encode(b'other').decode('utf-8')}
+        ]
+
+        with patch('handler.INPUT_PATH', str(tmp_path)), patch.object(handler, 'input_store_jobs', set()):
+            images = asyncio.run(handler.load_input_images(input_images, None, 'job-1'))
+            uploaded, hits = asyncio.run(handler.upload_input_images(images, {}, None, 'job-1'))
+
+        assert hits == 1
+        assert handler.get_input_metrics(images, hits) == {
+            'input_images': 2, 'input_store_hits': 1, 'input_store_hit_ratio': 0.5
+        }
+        assert [c[0][1]['image'][0] for c in mock_form.call_args_list] == [
+            hashlib.sha256(b'other').hexdigest() + '.jpg'
+        ]
+        # Using a stored image marks it as recently used
+        assert os.path.getmtime(tmp_path / 'store' / source_name) > 0
+
+    def test_rejects_invalid_input_images(self):
+        from handler import decode_input_image
+
+        with pytest.raises(ValueError, match='name'):
+            decode_input_image({'image': 'aGVsbG8='})
+
+        with pytest.raises(ValueError, match='base64'):
+            decode_input_image({'name': 'source.png', 'image': 'not base64!'})
+
+    @patch('handler.logging')
+    @patch('handler.send_form_request')
+    def test_mask_requires_uploaded_original(self, mock_form, mock_logging):
+        import handler
+
+        mock_form.side_effect = self.upload_response
+        input_images = [{'name': 'mask.png', 'image': 'aGVsbG8=', 'type': 'mask', 'original': 'missing.png'}]
+
+        images = asyncio.run(handler.load_input_images(input_images, None, 'job-1'))
+
+        with pytest.raises(ValueError, match='mask.png'):
+            asyncio.run(handler.upload_input_images(images, {}, None, 'job-1'))
+
+    @patch('handler.logging')
+    def test_cleans_least_recently_used_images(self, mock_logging, tmp_path):
+        import handler
+
+        store = tmp_path / 'store'
+        store.mkdir()
+
+        for name, used_at in (('oldest.png', 100), ('older.png', 200), ('recent.png', None)):
+            (store / name).write_bytes(b'x' * 10)
+
+            if used_at is not None:
+                os.utime(store / name, (used_at, used_at))
+
+        with patch('handler.INPUT_PATH', str(tmp_path)), patch('handler.INPUT_STORE_SIZE', 15):
+            assert handler.clean_input_store('job-1') == 2
+
+        # Recently used images are kept even when the store is over its budget
+        assert [path.name for path in store.iterdir()] == ['recent.png']
+
+        with patch('handler.INPUT_PATH', str(tmp_path / 'missing')):
+            assert handler.clean_input_store('job-1') == 0
+
+    @patch('handler.logging')
+    @patch('handler.get_container_memory_info')
+    @patch('handler.get_container_cpu_info')
+    @patch('handler.get_container_disk_info')
+    @patch('handler.send_form_request')
+    @patch('handler.send_post_request')
+    @patch('handler.send_get_request')
+    def test_handler_uploads_before_queueing_prompt(
+        self, mock_get, mock_post, mock_form, mock_disk, mock_cpu, mock_memory, mock_logging, tmp_path
+    ):
+        import handler
+
+        mock_memory.return_value = {'available': 10.0}
+        mock_cpu.return_value = {}
+        mock_disk.return_value = {'free_bytes': 10 * 1024 * 1024 * 1024}
+        calls = []
+        mock_form.side_effect = lambda endpoint, form, deadline=None: calls.append(endpoint) or self.upload_response(
+            endpoint, form
+        )
+        mock_post.side_effect = lambda endpoint, payload, deadline=None, timeout=None: calls.append(endpoint) or MagicMock(
+            status_code=400, json=lambda: {'error': {'message': 'invalid prompt'}}, content=b'invalid prompt'
+        )
+        mock_get.return_value = MagicMock(status_code=200, json=lambda: {'queue_running': [], 'queue_pending': []})
+
+        event = {
+            'id': 'test-123',
+            'input': {
+                'workflow': 'custom',
+                'images': [{'name': 'source.png', 'image': 'aGVsbG8='}],
+                'payload': json.loads(json.dumps(self.payload))
+            }
+        }
+
+        with patch('handler.INPUT_PATH', str(tmp_path)):
+            asyncio.run(handler.handler(event))
+
+        assert calls == ['upload/image', 'prompt']
+        assert handler.input_store_jobs == set()
+
+
+class TestInputCache:
+    """Tests for fetching input images by URL into the input cache."""
+
+    async def serve(self, routes, test):
+        from aiohttp import web
+
+        app = web.Application()
+        app.add_routes(routes)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = runner.addresses[0][1]
+
+        try:
+            return await test(f'http://127.0.0.1:{port}')
+        finally:
+            await runner.cleanup()
+
+            import handler
+            if handler.http_session is not None:
+                await handler.http_session.close()
+
+    def test_evicts_least_recently_used_files(self, tmp_path):
+        from handler import InputCache
+
+        cache = InputCache(str(tmp_path), 10)
+        first = cache.put('http://example.com/first.png', b'aaaa')
+        cache.put('http://example.com/second.png', b'bbbb')
+        assert cache.get('http://example.com/first.png') == b'aaaa'
+
+        cache.put('http://example.com/third.png', b'cccc')
+
+        assert cache.get('http://example.com/second.png') is None
+        assert cache.get('http://example.com/first.png') == b'aaaa'
+        assert cache.get('http://example.com/third.png') == b'cccc'
+        assert cache.size == 8
+        assert sorted(os.listdir(tmp_path)) == sorted(cache.files)
+        assert first in cache.files
+
+    def test_stores_identical_content_once(self, tmp_path):
+        from handler import InputCache
+
+        cache = InputCache(str(tmp_path), 100)
+        cache.put('http://example.com/a.png', b'same')
+        cache.put('http://example.com/b.png', b'same')
+
+        assert cache.size == 4
+        assert len(os.listdir(tmp_path)) == 1
+        assert cache.get('http://example.com/b.png') == b'same'
+
+    @patch('handler.logging')
+    def test_fetches_each_url_once_and_caches_it(self, mock_logging, tmp_path):
+        import handler
+        from aiohttp import web
+
+        requests_served = []
+
+        async def image(request):
+            requests_served.append(request.path)
+            return web.Response(body=b'reference image')
+
+        async def test(base_url):
+            input_images = [
+                {'name': 'first.png', 'url': f'{base_url}/reference.png'},
+                {'name': 'second.png', 'url': f'{base_url}/reference.png'},
+                {'name': 'inline.png', 'image': base64.b64encode(b'inline').decode('utf-8')}
+            ]
+            first = await handler.load_input_images(input_images, None, 'job-1')
+            second = await handler.load_input_images(input_images, None, 'job-2')
+            return first, second
+
+        with patch('handler.input_cache', handler.InputCache(str(tmp_path), 1024)):
+            first, second = asyncio.run(self.serve([web.get('/reference.png', image)], test))
+
+        assert [data for input_image, data in first] == [b'reference image', b'reference image', b'inline']
+        assert first == second
+        assert requests_served == ['/reference.png']
+
+    @patch('handler.logging')
+    def test_rejects_images_larger_than_limit(self, mock_logging, tmp_path):
+        import handler
+        from aiohttp import web
+
+        async def image(request):
+            return web.Response(body=b'x' * 64)
+
+        async def test(base_url):
+            return await handler.fetch_input_image(f'{base_url}/large.png', None, 'job-1')
+
+        with patch('handler.input_cache', handler.InputCache(str(tmp_path), 1024)), \
+                patch('handler.INPUT_MAX_SIZE', 16):
+            with pytest.raises(ValueError, match='larger than 16 bytes'):
+                asyncio.run(self.serve([web.get('/large.png', image)], test))
+
+        assert os.listdir(tmp_path) == []
+
+    @patch('handler.logging')
+    def test_rejects_failed_and_non_http_fetches(self, mock_logging, tmp_path):
+        import handler
+        from aiohttp import web
+
+        async def test(base_url):
+            return await handler.fetch_input_image(f'{base_url}/missing.png', None, 'job-1')
+
+        with patch('handler.input_cache', handler.InputCache(str(tmp_path), 1024)):
+            with pytest.raises(RuntimeError, match='404'):
+                asyncio.run(self.serve([], test))
+
+            with pytest.raises(ValueError, match='http or https'):
+                asyncio.run(handler.fetch_input_image('file:///etc/passwd', None, 'job-1'))
+
+
+class TestOutputStorage:
+    """Tests for uploading outputs to an S3-compatible bucket."""
+
+    bucket_config = {
+        'BUCKET_NAME': 'outputs-bucket',
+        'BUCKET_ACCESS_KEY_ID': 'access-key',
+        'BUCKET_SECRET_ACCESS_KEY': 'secret-key'
+    }
+
+    def mock_s3_client(self, existing_keys=()):
+        import botocore.exceptions
+
+        client = MagicMock()
+
+        def head_object(Bucket, Key):
+            if Key not in existing_keys:
+                raise botocore.exceptions.ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+
+            return {}
+
+        client.head_object.side_effect = head_object
+        client.generate_presigned_url.side_effect = lambda operation, Params, ExpiresIn: (
+            f"https://bucket.example.com/{Params['Key']}?expires={ExpiresIn}"
+        )
+        return client
+
+    @patch('handler.logging')
+    def test_uploads_file_with_content_addressed_key(self, mock_logging, tmp_path):
+        import hashlib
+        import handler
+
+        image_path = tmp_path / 'image.png'
+        image_path.write_bytes(b'fake image data')
+        client = self.mock_s3_client()
+        expected_key = f"outputs/{hashlib.sha256(b'fake image data').hexdigest()}.png"
+
+        with patch('handler.s3_client', client), patch('handler.BUCKET_NAME', 'outputs-bucket'):
+            result = handler.upload_output_file(str(image_path), 'job-1')
+
+        assert result == {
+            'image': f'https://bucket.example.com/{expected_key}?expires=3600',
+            'key': expected_key
+        }
+        args, kwargs = client.upload_fileobj.call_args
+        assert args[1:] == ('outputs-bucket', expected_key)
+        assert kwargs['ExtraArgs'] == {'ContentType': 'image/png'}
+        assert kwargs['Config'].multipart_threshold == handler.BUCKET_MULTIPART_THRESHOLD
+
+    @patch('handler.logging')
+    def test_skips_upload_of_identical_file(self, mock_logging, tmp_path):
+        import hashlib
+        import handler
+
+        image_path = tmp_path / 'image.png'
+        image_path.write_bytes(b'fake image data')
+        key = f"outputs/{hashlib.sha256(b'fake image data').hexdigest()}.png"
+        client = self.mock_s3_client(existing_keys={key})
+
+        with patch('handler.s3_client', client):
+            result = handler.upload_output_file(str(image_path), 'job-1')
+
+        assert result['key'] == key
+        client.upload_fileobj.assert_not_called()
+
+    @patch('handler.logging')
+    def test_encode_output_images_uploads_in_order(self, mock_logging, tmp_path):
+        import handler
+
+        for i in range(3):
+            (tmp_path / f'image_{i}.png').write_bytes(f'image {i}'.encode())
+
+        output_images = [
+            {'filename': f'image_{i}.png', 'type': 'output', 'node_id': '9', 'batch_index': i} for i in range(3)
+        ]
+        client = self.mock_s3_client()
+
+        with patch('handler.s3_client', client), patch('handler.OUTPUT_PATH', str(tmp_path)):
+            images = asyncio.run(handler.encode_output_images(output_images, 'job-1', storage='s3'))
+
+        assert [image['batch_index'] for image in images] == [0, 1, 2]
+        assert all(image['image'].startswith('https://bucket.example.com/outputs/') for image in images)
+        assert client.upload_fileobj.call_count == 3
+        assert list(tmp_path.iterdir()) == []
+
+    @patch('handler.logging')
+    @patch('handler.send_post_request')
+    def test_handler_rejects_s3_storage_without_bucket(self, mock_post, mock_logging):
+        import handler
+
+        event = {
+            'id': 'test-123',
+            'input': {'workflow': 'custom', 'output_storage': 's3', 'payload': {'9': {'class_type': 'SaveImage', 'inputs': {'filename_prefix': 'test'}}}}
+        }
+
+        with patch('handler.BUCKET_NAME', None), patch('handler.check_container_resources'):
+            result = asyncio.run(handler.handler(event))
+
+        assert 'BUCKET_NAME' in result['error']
+        mock_post.assert_not_called()
+
+    def test_output_storage_defaults_to_environment(self):
+        import handler
+
+        with patch('handler.OUTPUT_STORAGE', 's3'), \
+                patch.multiple('handler', **self.bucket_config):
+            assert handler.get_output_storage({'output_storage': None}) == 's3'
+            assert handler.get_output_storage({'output_storage': 'base64'}) == 'base64'
+
+
+class TestCancellation:
+    """Tests for propagating job cancellation to ComfyUI."""
+
+    @patch('handler.logging')
+    @patch('handler.send_post_request')
+    @patch('handler.send_get_request')
+    def test_cancel_interrupts_running_prompt(self, mock_get, mock_post, mock_logging):
+        import handler
+
+        mock_get.return_value = MagicMock(json=lambda: {
+            'queue_running': [[0, 'test-prompt-123', {}, {}, []]],
+            'queue_pending': []
+        })
+
+        asyncio.run(handler.cancel_prompt('test-prompt-123'))
+
+        mock_post.assert_called_once_with('interrupt', {'prompt_id': 'test-prompt-123'}, timeout=handler.CANCEL_TIMEOUT)
+
+    @patch('handler.logging')
+    @patch('handler.send_post_request')
+    @patch('handler.send_get_request')
+    def test_cancel_deletes_pending_prompt(self, mock_get, mock_post, mock_logging):
+        import handler
+
+        mock_get.return_value = MagicMock(json=lambda: {
+            'queue_running': [[0, 'other-prompt', {}, {}, []]],
+            'queue_pending': [[1, 'test-prompt-123', {}, {}, []]]
+        })
+
+        asyncio.run(handler.cancel_prompt('test-prompt-123'))
+
+        mock_post.assert_called_once_with('queue', {'delete': ['test-prompt-123']}, timeout=handler.CANCEL_TIMEOUT)
+
+    @patch('handler.logging')
+    @patch('handler.send_post_request')
+    @patch('handler.send_get_request')
+    def test_cancel_deletes_partial_outputs(self, mock_get, mock_post, mock_logging, tmp_path):
+        import handler
+
+        mock_get.return_value = MagicMock(json=lambda: {'queue_running': [], 'queue_pending': []})
+        (tmp_path / 'abc_00001_.png').write_bytes(b'partial')
+        (tmp_path / 'other_00001_.png').write_bytes(b'other job')
+
+        with patch('handler.OUTPUT_PATH', str(tmp_path)), \
+                patch.dict(handler.active_prompts, {'test-prompt-123': {'job_id': 'job', 'filename_prefixes': ['abc']}}):
+            asyncio.run(handler.cancel_prompt('test-prompt-123'))
+            assert 'test-prompt-123' not in handler.active_prompts
+
+        mock_post.assert_not_called()
+        assert sorted(os.listdir(tmp_path)) == ['other_00001_.png']
+
+    @patch('handler.cancel_prompt')
+    def test_cancel_active_prompts_at_exit(self, mock_cancel):
+        import handler
+
+        prompts = {'test-prompt-123': {'job_id': 'test-123', 'filename_prefixes': []}}
 
+        with patch.dict(handler.active_prompts, prompts, clear=True):
+            handler.cancel_active_prompts()
 
-class TestGetTxt2ImgPayload:
-    """Tests for get_txt2img_payload function."""
+        mock_cancel.assert_called_once_with('test-prompt-123', 'test-123')
 
-    def test_sets_all_expected_fields(self):
-        from handler import get_txt2img_payload
+    @patch('handler.logging')
+    @patch('handler.get_container_memory_info')
+    @patch('handler.get_container_cpu_info')
+    @patch('handler.get_container_disk_info')
+    @patch('handler.send_post_request')
+    @patch('handler.send_get_request')
+    @patch('handler.cancel_prompt')
+    @patch('handler.asyncio.sleep')
+    def test_handler_cancels_prompt_when_time_budget_is_exceeded(
+        self, mock_sleep, mock_cancel, mock_get, mock_post,
+        mock_disk, mock_cpu, mock_memory, mock_logging
+    ):
+        import handler
 
-        workflow = {
-            '3': {'inputs': {}},
-            '4': {'inputs': {}},
-            '5': {'inputs': {}},
-            '6': {'inputs': {}},
-            '7': {'inputs': {}}
-        }
-        payload = {
-            'seed': 12345,
-            'steps': 20,
-            'cfg_scale': 7.5,
-            'sampler_name': 'euler',
-            'ckpt_name': 'model.safetensors',
-            'batch_size': 1,
-            'width': 512,
-            'height': 512,
-            'prompt': 'test prompt',
-            'negative_prompt': 'ugly'
+        mock_memory.return_value = {'available': 10.0}
+        mock_cpu.return_value = {}
+        mock_disk.return_value = {'free_bytes': 10 * 1024 * 1024 * 1024}
+        mock_post.return_value = MagicMock(
+            status_code=200,
+            json=lambda: {'prompt_id': 'test-prompt-123'}
+        )
+        mock_get.return_value = MagicMock(status_code=200, json=lambda: {})
+
+        event = {
+            'id': 'test-123',
+            'input': {'workflow': 'custom', 'payload': {'9': {'class_type': 'SaveImage', 'inputs': {'filename_prefix': 'test'}}}, 'timeout': 0.01}
         }
 
-        result = get_txt2img_payload(workflow, payload)
+        result = asyncio.run(handler.handler(event))
 
-        assert result['3']['inputs']['seed'] == 12345
-        assert result['3']['inputs']['steps'] == 20
-        assert result['3']['inputs']['cfg'] == 7.5
-        assert result['3']['inputs']['sampler_name'] == 'euler'
-        assert result['4']['inputs']['ckpt_name'] == 'model.safetensors'
-        assert result['5']['inputs']['batch_size'] == 1
-        assert result['5']['inputs']['width'] == 512
-        assert result['5']['inputs']['height'] == 512
-        assert result['6']['inputs']['text'] == 'test prompt'
-        assert result['7']['inputs']['text'] == 'ugly'
+        assert 'time budget' in result['error']
+        mock_cancel.assert_called_once_with('test-prompt-123', 'test-123')
+        assert handler.active_prompts == {}
 
+    @pytest.mark.parametrize('error', [
+        asyncio.TimeoutError('ComfyUI did not respond to history/test-prompt-123 within 600s'),
+        aiohttp.ClientConnectionError('Connection refused')
+    ])
+    @patch('handler.logging')
+    @patch('handler.get_container_memory_info')
+    @patch('handler.get_container_cpu_info')
+    @patch('handler.get_container_disk_info')
+    @patch('handler.send_post_request')
+    @patch('handler.send_get_request')
+    @patch('handler.cancel_prompt')
+    def test_handler_cancels_prompt_when_comfyui_request_fails(
+        self, mock_cancel, mock_get, mock_post, mock_disk, mock_cpu, mock_memory, mock_logging, error
+    ):
+        import handler
 
-class TestGetImg2ImgPayload:
-    """Tests for get_img2img_payload function."""
+        mock_memory.return_value = {'available': 10.0}
+        mock_cpu.return_value = {}
+        mock_disk.return_value = {'free_bytes': 10 * 1024 * 1024 * 1024}
+        mock_post.return_value = MagicMock(status_code=200, json=lambda: {'prompt_id': 'test-prompt-123'})
 
-    def test_sets_all_expected_fields(self):
-        from handler import get_img2img_payload
+        async def get(endpoint, deadline=None, timeout=None):
+            if endpoint.startswith('history'):
+                raise error
 
-        workflow = {
-            '1': {'inputs': {}},
-            '2': {'inputs': {}},
-            '4': {'inputs': {}},
-            '6': {'inputs': {}},
-            '7': {'inputs': {}},
-            '13': {'inputs': {}}
-        }
-        payload = {
-            'seed': 12345,
-            'steps': 20,
-            'cfg_scale': 7.5,
-            'sampler_name': 'euler',
-            'scheduler': 'normal',
-            'denoise': 0.75,
-            'ckpt_name': 'model.safetensors',
-            'width': 512,
-            'height': 512,
-            'prompt': 'test prompt',
-            'negative_prompt': 'ugly'
+            return MagicMock(status_code=200, json=lambda: {'queue_running': [], 'queue_pending': []})
+
+        mock_get.side_effect = get
+        event = {
+            'id': 'test-123',
+            'input': {'workflow': 'custom', 'payload': {'9': {'class_type': 'SaveImage', 'inputs': {'filename_prefix': 'test'}}}}
         }
 
-        result = get_img2img_payload(workflow, payload)
+        result = asyncio.run(handler.handler(event))
 
-        assert result['13']['inputs']['seed'] == 12345
-        assert result['13']['inputs']['steps'] == 20
-        assert result['13']['inputs']['cfg'] == 7.5
-        assert result['13']['inputs']['sampler_name'] == 'euler'
-        assert result['13']['inputs']['scheduler'] == 'normal'
-        assert result['13']['inputs']['denoise'] == 0.75
-        assert result['1']['inputs']['ckpt_name'] == 'model.safetensors'
-        assert result['2']['inputs']['width'] == 512
-        assert result['2']['inputs']['height'] == 512
-        assert result['6']['inputs']['text'] == 'test prompt'
-        assert result['7']['inputs']['text'] == 'ugly'
+        assert result['error'] == str(error)
+        mock_cancel.assert_called_once_with('test-prompt-123', 'test-123')
 
 
-class TestGetWorkflowPayload:
-    """Tests for get_workflow_payload function."""
+class TestQueueAdmission:
+    """Tests for the queue check before submitting a prompt."""
 
-    def test_loads_txt2img_workflow(self):
-        from handler import get_workflow_payload
+    queue = {
+        'queue_running': [[0, 'orphan-running', {}, {'client_id': 'crashed-client'}, []]],
+        'queue_pending': [
+            [1, 'own-prompt', {}, {'client_id': 'other'}, []],
+            [2, 'own-client', {}, {'client_id': 'client-123'}, []],
+            [3, 'orphan-pending', {}, {'client_id': 'crashed-client'}, []]
+        ]
+    }
 
-        mock_workflow = {
-            '3': {'inputs': {}},
-            '4': {'inputs': {}},
-            '5': {'inputs': {}},
-            '6': {'inputs': {}},
-            '7': {'inputs': {}}
-        }
-        payload = {
-            'seed': 12345,
-            'steps': 20,
-            'cfg_scale': 7.5,
-            'sampler_name': 'euler',
-            'ckpt_name': 'model.safetensors',
-            'batch_size': 1,
-            'width': 512,
-            'height': 512,
-            'prompt': 'test',
-            'negative_prompt': 'ugly'
-        }
+    def test_prompts_are_owned_by_prompt_id_or_client_id(self):
+        import handler
 
-        with patch('builtins.open', mock_open(read_data=json.dumps(mock_workflow))):
-            result = get_workflow_payload('txt2img', payload)
+        with patch.dict(handler.active_prompts, {'own-prompt': {'job_id': 'j', 'filename_prefixes': []}}), \
+                patch('handler.active_client_ids', {'client-123'}):
+            owned = [item[1] for item in self.queue['queue_pending'] if handler.is_owned_prompt(item)]
+            assert owned == ['own-prompt', 'own-client']
+            assert not handler.is_owned_prompt(self.queue['queue_running'][0])
 
-        assert result['3']['inputs']['seed'] == 12345
-        assert result['6']['inputs']['text'] == 'test'
+    @patch('handler.logging')
+    @patch('handler.send_post_request')
+    @patch('handler.send_get_request')
+    def test_report_mode_leaves_stale_prompts(self, mock_get, mock_post, mock_logging):
+        import handler
 
-    def test_loads_custom_workflow_without_modification(self):
-        from handler import get_workflow_payload
+        mock_get.return_value = MagicMock(json=lambda: self.queue)
 
-        mock_workflow = {'custom': 'workflow'}
+        with patch('handler.QUEUE_ADMISSION', 'report'), \
+                patch.dict(handler.active_prompts, {'own-prompt': {'job_id': 'j', 'filename_prefixes': []}}), \
+                patch('handler.active_client_ids', {'client-123'}):
+            queue_depth = asyncio.run(handler.check_queue_admission(None, 'test-123'))
 
-        with patch('builtins.open', mock_open(read_data=json.dumps(mock_workflow))):
-            result = get_workflow_payload('other', {})
+        assert queue_depth == 4
+        mock_post.assert_not_called()
+        mock_logging.warning.assert_called()
 
-        assert result == mock_workflow
+    @patch('handler.logging')
+    @patch('handler.send_post_request')
+    @patch('handler.send_get_request')
+    def test_purge_mode_removes_stale_prompts(self, mock_get, mock_post, mock_logging):
+        import handler
 
+        mock_get.return_value = MagicMock(json=lambda: self.queue)
 
-class TestInputValidation:
-    """Tests for input schema validation."""
+        with patch('handler.QUEUE_ADMISSION', 'purge'), \
+                patch.dict(handler.active_prompts, {'own-prompt': {'job_id': 'j', 'filename_prefixes': []}}), \
+                patch('handler.active_client_ids', {'client-123'}):
+            queue_depth = asyncio.run(handler.check_queue_admission(None, 'test-123'))
 
-    def test_valid_custom_workflow_input(self, sample_event):
-        from runpod.serverless.utils.rp_validator import validate
-        from schemas.input import INPUT_SCHEMA
+        assert queue_depth == 2
+        calls = [c[0][:2] for c in mock_post.call_args_list]
+        assert calls == [
+            ('queue', {'delete': ['orphan-pending']}),
+            ('interrupt', {'prompt_id': 'orphan-running'})
+        ]
 
-        result = validate(sample_event['input'], INPUT_SCHEMA)
-        assert 'errors' not in result
-        assert result['validated_input']['workflow'] == 'custom'
+    @patch('handler.logging')
+    @patch('handler.send_get_request')
+    def test_queue_check_failure_is_not_fatal(self, mock_get, mock_logging):
+        import handler
 
-    def test_valid_txt2img_workflow_input(self):
-        from runpod.serverless.utils.rp_validator import validate
-        from schemas.input import INPUT_SCHEMA
+        mock_get.side_effect = ConnectionError('refused')
 
-        input_data = {
-            'workflow': 'txt2img',
-            'payload': {'prompt': 'test'}
-        }
-        result = validate(input_data, INPUT_SCHEMA)
-        assert 'errors' not in result
+        assert asyncio.run(handler.check_queue_admission(None, 'test-123')) is None
 
-    def test_missing_payload(self):
-        from runpod.serverless.utils.rp_validator import validate
-        from schemas.input import INPUT_SCHEMA
+    @patch('handler.logging')
+    @patch('handler.send_get_request')
+    def test_deadline_exceeded_propagates(self, mock_get, mock_logging):
+        import handler
 
-        input_data = {
-            'workflow': 'custom'
-        }
-        result = validate(input_data, INPUT_SCHEMA)
-        assert 'errors' in result
+        mock_get.side_effect = handler.DeadlineExceeded('out of time')
 
-    def test_default_workflow_is_txt2img(self):
-        from runpod.serverless.utils.rp_validator import validate
-        from schemas.input import INPUT_SCHEMA
+        with pytest.raises(handler.DeadlineExceeded):
+            asyncio.run(handler.check_queue_admission(None, 'test-123'))
 
-        input_data = {
-            'payload': {'prompt': 'test'}
+    def test_prompt_timings_split_queue_wait_and_execution(self):
+        from handler import get_prompt_timings
+
+        history = {
+            'status': {
+                'messages': [
+                    ['execution_start', {'prompt_id': 'p', 'timestamp': 1002500}],
+                    ['execution_cached', {'nodes': [], 'prompt_id': 'p', 'timestamp': 1002600}],
+                    ['execution_success', {'prompt_id': 'p', 'timestamp': 1010000}]
+                ]
+            }
         }
-        result = validate(input_data, INPUT_SCHEMA)
-        assert 'errors' not in result
-        assert result['validated_input']['workflow'] == 'txt2img'
 
+        assert get_prompt_timings(history, 1000.0) == {'queue_wait': 2.5, 'execution_time': 7.5}
 
-class TestSendRequests:
-    """Tests for HTTP request functions."""
+    def test_prompt_timings_without_messages(self):
+        from handler import get_prompt_timings
 
-    def test_send_get_request_uses_correct_url(self):
-        import handler
-        from handler import BASE_URI, TIMEOUT
+        assert get_prompt_timings({'status': {'messages': []}}, 1000.0) == {}
 
-        mock_session = MagicMock()
-        mock_session.get.return_value = MagicMock(status_code=200)
-        handler.session = mock_session
 
-        handler.send_get_request('test/endpoint')
+class TestConcurrency:
+    """Tests for the concurrency modifier and per-job state."""
 
-        mock_session.get.assert_called_once_with(
-            url=f'{BASE_URI}/test/endpoint',
-            timeout=TIMEOUT
-        )
+    def test_concurrency_disabled_by_default(self):
+        from handler import concurrency_modifier
 
-    def test_send_post_request_uses_correct_url_and_payload(self):
+        with patch('handler.MAX_CONCURRENCY', 1):
+            assert concurrency_modifier(1) == 1
+            assert concurrency_modifier(3) == 1
+
+    def test_concurrency_uses_maximum_with_headroom(self):
         import handler
-        from handler import BASE_URI, TIMEOUT
 
-        mock_session = MagicMock()
-        mock_session.post.return_value = MagicMock(status_code=200)
-        handler.session = mock_session
-        test_payload = {'key': 'value'}
+        stats = {'vram_total': 24.0, 'vram_free': 20.0, 'queue_foreign': 0}
 
-        handler.send_post_request('test/endpoint', test_payload)
+        with patch('handler.MAX_CONCURRENCY', 3), patch.dict(handler.comfyui_stats, stats, clear=True):
+            assert handler.concurrency_modifier(1) == 3
+            assert handler.concurrency_modifier(3) == 3
 
-        mock_session.post.assert_called_once_with(
-            url=f'{BASE_URI}/test/endpoint',
-            json=test_payload,
-            timeout=TIMEOUT
-        )
+    def test_concurrency_is_stable_for_the_same_stats(self):
+        import handler
 
+        for stats in (
+            {'vram_total': 24.0, 'vram_free': 20.0, 'queue_foreign': 0},
+            {'vram_total': 24.0, 'vram_free': 2.0, 'queue_foreign': 0}
+        ):
+            with patch('handler.MAX_CONCURRENCY', 3), patch.dict(handler.comfyui_stats, stats, clear=True):
+                concurrency = handler.concurrency_modifier(1)
 
-class TestWaitForService:
-    """Tests for wait_for_service function."""
+                for _ in range(10):
+                    concurrency_next = handler.concurrency_modifier(concurrency)
+                    assert concurrency_next == concurrency
 
-    @patch('handler.time.sleep')
-    @patch('handler.requests.get')
-    def test_returns_immediately_on_success(self, mock_get, mock_sleep):
-        from handler import wait_for_service
+    def test_concurrency_drops_to_one_when_vram_is_low(self):
+        import handler
 
-        mock_get.return_value = MagicMock(status_code=200)
+        stats = {'vram_total': 24.0, 'vram_free': 2.0, 'queue_foreign': 0}
 
-        wait_for_service('http://localhost:3000')
+        with patch('handler.MAX_CONCURRENCY', 3), patch.dict(handler.comfyui_stats, stats, clear=True):
+            assert handler.concurrency_modifier(3) == 1
+            assert handler.concurrency_modifier(1) == 1
 
-        mock_get.assert_called_once_with('http://localhost:3000')
-        mock_sleep.assert_not_called()
+    def test_concurrency_drops_to_one_with_foreign_backlog(self):
+        import handler
 
-    @patch('handler.logging')
-    @patch('handler.time.sleep')
-    @patch('handler.requests.get')
-    def test_retries_on_request_exception(self, mock_get, mock_sleep, mock_logging):
-        from handler import wait_for_service
+        stats = {'vram_total': 24.0, 'vram_free': 20.0, 'queue_foreign': 1}
 
-        mock_get.side_effect = [
-            requests.exceptions.ConnectionError(),
-            MagicMock(status_code=200)
-        ]
+        with patch('handler.MAX_CONCURRENCY', 3), patch.dict(handler.comfyui_stats, stats, clear=True):
+            assert handler.concurrency_modifier(3) == 1
 
-        wait_for_service('http://localhost:3000')
+    @patch('handler.send_get_request')
+    def test_refresh_comfyui_stats(self, mock_get):
+        import handler
 
-        assert mock_get.call_count == 2
-        assert mock_sleep.call_count == 1
+        mock_get.side_effect = [
+            MagicMock(json=lambda: {'devices': [{'vram_total': 24, 'vram_free': 12}]}),
+            MagicMock(json=lambda: {
+                'queue_running': [[0, 'prompt-1', {}, {'client_id': 'client-1'}, []]],
+                'queue_pending': [
+                    [1, 'prompt-2', {}, {'client_id': 'other'}, []],
+                    [2, 'prompt-3', {}, {'client_id': 'other'}, []]
+                ]
+            })
+        ]
 
-    @patch('handler.logging')
-    @patch('handler.time.sleep')
-    @patch('handler.requests.get')
-    def test_logs_every_15_retries(self, mock_get, mock_sleep, mock_logging):
-        from handler import wait_for_service
+        with patch.dict(handler.comfyui_stats, clear=True), patch.object(handler, 'active_client_ids', {'client-1'}):
+            asyncio.run(handler.refresh_comfyui_stats())
 
-        # Fail 15 times then succeed
-        side_effects = [requests.exceptions.ConnectionError()] * 15 + [MagicMock(status_code=200)]
-        mock_get.side_effect = side_effects
+            assert handler.comfyui_stats == {
+                'vram_total': 24,
+                'vram_free': 12,
+                'queue_running': 1,
+                'queue_pending': 2,
+                'queue_foreign': 2
+            }
 
-        wait_for_service('http://localhost:3000')
+    def test_log_handler_uses_job_id_of_current_task(self, mock_runpod_logger):
+        from handler import SnapLogHandler, current_job_id
 
-        assert mock_get.call_count == 16
-        mock_logging.info.assert_called()
+        handler = SnapLogHandler('test-app')
+        handler.setFormatter(logging.Formatter('%(message)s'))
 
-    @patch('handler.logging')
-    @patch('handler.time.sleep')
-    @patch('handler.requests.get')
-    def test_logs_on_general_exception(self, mock_get, mock_sleep, mock_logging):
-        from handler import wait_for_service
+        def emit(job_id):
+            current_job_id.set(job_id)
+            record = logging.LogRecord('test', logging.INFO, '', 0, 'Test message', (), None)
+            handler.emit(record)
 
-        mock_get.side_effect = [
-            Exception('Some error'),
-            MagicMock(status_code=200)
-        ]
+        async def run():
+            await asyncio.gather(
+                asyncio.create_task(asyncio.to_thread(emit, 'job-1')),
+                asyncio.create_task(asyncio.to_thread(emit, 'job-2'))
+            )
 
-        wait_for_service('http://localhost:3000')
+        with patch.dict(os.environ, {'RUNPOD_JOB_ID': ''}):
+            asyncio.run(run())
 
-        mock_logging.error.assert_called()
+        job_ids = sorted(c[0][1] for c in mock_runpod_logger.info.call_args_list)
+        assert job_ids == ['job-1', 'job-2']
 
 
 class TestContainerMemoryInfo:
@@ -929,7 +2907,7 @@ class TestHandlerErrorHandling:
         mock_validate.return_value = {'errors': ['Invalid input']}
 
         event = {'id': 'test-123', 'input': {}}
-        result = handler(event)
+        result = asyncio.run(handler(event))
 
         assert 'error' in result
         assert 'Invalid input' in result['error']
@@ -947,8 +2925,8 @@ class TestHandlerErrorHandling:
         mock_cpu.return_value = {}
         mock_disk.return_value = {'free_bytes': 10 * 1024 * 1024 * 1024}
 
-        event = {'id': 'test-123', 'input': {'workflow': 'custom', 'payload': {}}}
-        result = handler(event)
+        event = {'id': 'test-123', 'input': {'workflow': 'custom', 'payload': {'9': {'class_type': 'SaveImage', 'inputs': {'filename_prefix': 'test'}}}}}
+        result = asyncio.run(handler(event))
 
         assert 'error' in result
         assert 'memory' in result['error'].lower()
@@ -960,21 +2938,107 @@ class TestHandlerErrorHandling:
     def test_handler_returns_error_on_low_disk_space(
         self, mock_disk, mock_cpu, mock_memory, mock_logging
     ):
-        from handler import handler
+        from handler import handler
+
+        mock_memory.return_value = {'available': 10.0}
+        mock_cpu.return_value = {}
+        mock_disk.return_value = {'free_bytes': 100 * 1024}
+
+        event = {'id': 'test-123', 'input': {'workflow': 'custom', 'payload': {'9': {'class_type': 'SaveImage', 'inputs': {'filename_prefix': 'test'}}}}}
+        result = asyncio.run(handler(event))
+
+        assert 'error' in result
+        assert 'disk' in result['error'].lower()
+
+    @pytest.mark.parametrize('job_input, error', [
+        ({'workflow': 'txt2img', 'payload': {}}, 'Payload is missing the required input: prompt'),
+        ({'workflow': 'txt2img', 'payload': {'prompt': 'cat', 'seed': '1'}}, 'Payload input seed should be int, not str'),
+        ({'workflow': 'missing', 'payload': {}}, 'Unknown workflow: missing')
+    ])
+    @pytest.mark.parametrize('stream', [False, True])
+    @patch('handler.logging')
+    @patch('handler.get_container_memory_info')
+    @patch('handler.get_container_cpu_info')
+    @patch('handler.get_container_disk_info')
+    @patch('handler.create_listener')
+    def test_handler_returns_payload_error_without_refreshing_worker(
+        self, mock_listener, mock_disk, mock_cpu, mock_memory, mock_logging, stream, job_input, error
+    ):
+        import handler
+
+        mock_memory.return_value = {'available': 10.0}
+        mock_cpu.return_value = {}
+        mock_disk.return_value = {'free_bytes': 10 * 1024 * 1024 * 1024}
+        event = {'id': 'test-123', 'input': job_input}
+
+        async def collect():
+            return [output async for output in handler.stream_handler(event)]
+
+        if stream:
+            result, = asyncio.run(collect())
+        else:
+            result = asyncio.run(handler.handler(event))
+
+        assert result == {'error': error}
+        mock_listener.assert_not_called()
+
+
+class TestHandlerSuccessPath:
+    """Tests for handler success path."""
+
+    @patch('handler.logging')
+    @patch('handler.get_container_memory_info')
+    @patch('handler.get_container_cpu_info')
+    @patch('handler.get_container_disk_info')
+    @patch('handler.send_post_request')
+    @patch('handler.send_get_request')
+    @patch('handler.os.path.exists')
+    @patch('handler.os.remove')
+    @patch('handler.os.path.getsize', return_value=len(b'fake image data'))
+    @patch('builtins.open', new_callable=mock_open, read_data=b'fake image data')
+    def test_handler_success_with_output_image(
+        self, mock_file, mock_getsize, mock_remove, mock_exists, mock_get, mock_post,
+        mock_disk, mock_cpu, mock_memory, mock_logging
+    ):
+        import handler
 
         mock_memory.return_value = {'available': 10.0}
         mock_cpu.return_value = {}
-        mock_disk.return_value = {'free_bytes': 100 * 1024}
+        mock_disk.return_value = {'free_bytes': 10 * 1024 * 1024 * 1024}
 
-        event = {'id': 'test-123', 'input': {'workflow': 'custom', 'payload': {}}}
-        result = handler(event)
+        mock_post.return_value = MagicMock(
+            status_code=200,
+            json=lambda: {'prompt_id': 'test-prompt-123'}
+        )
 
-        assert 'error' in result
-        assert 'disk' in result['error'].lower()
+        mock_get.return_value = MagicMock(
+            status_code=200,
+            json=lambda: {
+                'test-prompt-123': {
+                    'status': {'status_str': 'success', 'completed': True, 'messages': []},
+                    'outputs': {
+                        '9': {'images': [{'filename': 'test.png', 'type': 'output'}]}
+                    }
+                }
+            }
+        )
 
+        mock_exists.return_value = True
 
-class TestHandlerSuccessPath:
-    """Tests for handler success path."""
+        event = {
+            'id': 'test-123',
+            'input': {
+                'workflow': 'custom',
+                'payload': {
+                    '9': {'class_type': 'SaveImage', 'inputs': {'filename_prefix': 'test'}}
+                }
+            }
+        }
+
+        result = asyncio.run(handler.handler(event))
+
+        assert 'images' in result
+        assert len(result['images']) == 1
 
     @patch('handler.logging')
     @patch('handler.get_container_memory_info')
@@ -984,9 +3048,10 @@ class TestHandlerSuccessPath:
     @patch('handler.send_get_request')
     @patch('handler.os.path.exists')
     @patch('handler.os.remove')
+    @patch('handler.os.path.getsize', return_value=len(b'fake image data'))
     @patch('builtins.open', new_callable=mock_open, read_data=b'fake image data')
-    def test_handler_success_with_output_image(
-        self, mock_file, mock_remove, mock_exists, mock_get, mock_post,
+    def test_handler_keeps_models_loaded_while_other_jobs_run(
+        self, mock_file, mock_getsize, mock_remove, mock_exists, mock_get, mock_post,
         mock_disk, mock_cpu, mock_memory, mock_logging
     ):
         import handler
@@ -1024,10 +3089,13 @@ class TestHandlerSuccessPath:
             }
         }
 
-        result = handler.handler(event)
+        with patch('handler.active_jobs', {'other-job'}) as active_jobs:
+            result = asyncio.run(handler.handler(event))
+            assert active_jobs == {'other-job'}
 
-        assert 'images' in result
         assert len(result['images']) == 1
+        endpoints = [c[0][0] for c in mock_post.call_args_list]
+        assert endpoints == ['prompt']
 
     @patch('handler.logging')
     @patch('handler.get_container_memory_info')
@@ -1076,7 +3144,7 @@ class TestHandlerSuccessPath:
             }
         }
 
-        result = handler.handler(event)
+        result = asyncio.run(handler.handler(event))
 
         assert 'images' in result
         mock_remove.assert_called()
@@ -1129,7 +3197,7 @@ class TestHandlerSuccessPath:
             }
         }
 
-        result = handler.handler(event)
+        result = asyncio.run(handler.handler(event))
 
         assert 'images' in result
         mock_remove.assert_called()
@@ -1182,7 +3250,7 @@ class TestHandlerSuccessPath:
             }
         }
 
-        result = handler.handler(event)
+        result = asyncio.run(handler.handler(event))
 
         assert 'images' in result
         mock_logging.error.assert_called()
@@ -1235,7 +3303,7 @@ class TestHandlerSuccessPath:
             }
         }
 
-        result = handler.handler(event)
+        result = asyncio.run(handler.handler(event))
 
         assert 'images' in result
 
@@ -1289,7 +3357,7 @@ class TestHandlerSuccessPath:
             }
         }
 
-        result = handler.handler(event)
+        result = asyncio.run(handler.handler(event))
 
         assert result.get('refresh_worker') is True
 
@@ -1299,8 +3367,233 @@ class TestHandlerSuccessPath:
     @patch('handler.get_container_disk_info')
     @patch('handler.send_post_request')
     @patch('handler.send_get_request')
-    def test_handler_no_outputs(
-        self, mock_get, mock_post,
+    def test_handler_no_outputs(
+        self, mock_get, mock_post,
+        mock_disk, mock_cpu, mock_memory, mock_logging
+    ):
+        import handler
+
+        mock_memory.return_value = {'available': 10.0}
+        mock_cpu.return_value = {}
+        mock_disk.return_value = {'free_bytes': 10 * 1024 * 1024 * 1024}
+
+        mock_post.return_value = MagicMock(
+            status_code=200,
+            json=lambda: {'prompt_id': 'test-prompt-123'}
+        )
+
+        mock_get.return_value = MagicMock(
+            status_code=200,
+            json=lambda: {
+                'test-prompt-123': {
+                    'status': {'status_str': 'success', 'completed': True, 'messages': []},
+                    'outputs': {}
+                }
+            }
+        )
+
+        event = {
+            'id': 'test-123',
+            'input': {
+                'workflow': 'custom',
+                'payload': {'9': {'class_type': 'SaveImage', 'inputs': {'filename_prefix': 'test'}}}
+            }
+        }
+
+        result = asyncio.run(handler.handler(event))
+
+        assert 'error' in result
+        assert 'No output found' in result['error']
+
+    @patch('handler.logging')
+    @patch('handler.get_container_memory_info')
+    @patch('handler.get_container_cpu_info')
+    @patch('handler.get_container_disk_info')
+    @patch('handler.send_post_request')
+    @patch('handler.send_get_request')
+    def test_handler_execution_error(
+        self, mock_get, mock_post,
+        mock_disk, mock_cpu, mock_memory, mock_logging
+    ):
+        import handler
+
+        mock_memory.return_value = {'available': 10.0}
+        mock_cpu.return_value = {}
+        mock_disk.return_value = {'free_bytes': 10 * 1024 * 1024 * 1024}
+
+        mock_post.return_value = MagicMock(
+            status_code=200,
+            json=lambda: {'prompt_id': 'test-prompt-123'}
+        )
+
+        mock_get.return_value = MagicMock(
+            status_code=200,
+            json=lambda: {
+                'test-prompt-123': {
+                    'status': {
+                        'status_str': 'error',
+                        'completed': False,
+                        'messages': [
+                            ['execution_error', {
+                                'node_type': 'TestNode',
+                                'exception_message': 'Test error'
+                            }]
+                        ]
+                    },
+                    'outputs': {}
+                }
+            }
+        )
+
+        event = {
+            'id': 'test-123',
+            'input': {
+                'workflow': 'custom',
+                'payload': {'9': {'class_type': 'SaveImage', 'inputs': {'filename_prefix': 'test'}}}
+            }
+        }
+
+        result = asyncio.run(handler.handler(event))
+
+        assert 'error' in result
+        assert 'TestNode' in result['error']
+
+    @patch('handler.logging')
+    @patch('handler.get_container_memory_info')
+    @patch('handler.get_container_cpu_info')
+    @patch('handler.get_container_disk_info')
+    @patch('handler.send_post_request')
+    @patch('handler.send_get_request')
+    def test_handler_execution_error_without_details(
+        self, mock_get, mock_post,
+        mock_disk, mock_cpu, mock_memory, mock_logging
+    ):
+        import handler
+
+        mock_memory.return_value = {'available': 10.0}
+        mock_cpu.return_value = {}
+        mock_disk.return_value = {'free_bytes': 10 * 1024 * 1024 * 1024}
+
+        mock_post.return_value = MagicMock(
+            status_code=200,
+            json=lambda: {'prompt_id': 'test-prompt-123'}
+        )
+
+        mock_get.return_value = MagicMock(
+            status_code=200,
+            json=lambda: {
+                'test-prompt-123': {
+                    'status': {
+                        'status_str': 'error',
+                        'completed': False,
+                        'messages': [
+                            ['execution_error', {'other_field': 'value'}]
+                        ]
+                    },
+                    'outputs': {}
+                }
+            }
+        )
+
+        event = {
+            'id': 'test-123',
+            'input': {
+                'workflow': 'custom',
+                'payload': {'9': {'class_type': 'SaveImage', 'inputs': {'filename_prefix': 'test'}}}
+            }
+        }
+
+        result = asyncio.run(handler.handler(event))
+
+        assert 'error' in result
+
+    @patch('handler.logging')
+    @patch('handler.get_container_memory_info')
+    @patch('handler.get_container_cpu_info')
+    @patch('handler.get_container_disk_info')
+    @patch('handler.send_post_request')
+    @patch('handler.send_get_request')
+    def test_handler_queue_error_with_json(
+        self, mock_get, mock_post,
+        mock_disk, mock_cpu, mock_memory, mock_logging
+    ):
+        import handler
+
+        mock_get.return_value = MagicMock(
+            status_code=200,
+            json=lambda: {'queue_running': [], 'queue_pending': []}
+        )
+
+        mock_memory.return_value = {'available': 10.0}
+        mock_cpu.return_value = {}
+        mock_disk.return_value = {'free_bytes': 10 * 1024 * 1024 * 1024}
+
+        mock_post.return_value = MagicMock(
+            status_code=500,
+            json=lambda: {'error': 'Server error'},
+            content=b'Server error'
+        )
+
+        event = {
+            'id': 'test-123',
+            'input': {
+                'workflow': 'custom',
+                'payload': {'9': {'class_type': 'SaveImage', 'inputs': {'filename_prefix': 'test'}}}
+            }
+        }
+
+        result = asyncio.run(handler.handler(event))
+
+        assert 'error' in result
+        assert '500' in result['error']
+
+    @patch('handler.logging')
+    @patch('handler.get_container_memory_info')
+    @patch('handler.get_container_cpu_info')
+    @patch('handler.get_container_disk_info')
+    @patch('handler.send_post_request')
+    @patch('handler.send_get_request')
+    def test_handler_queue_error_without_json(
+        self, mock_get, mock_post,
+        mock_disk, mock_cpu, mock_memory, mock_logging
+    ):
+        import handler
+
+        mock_get.return_value = MagicMock(
+            status_code=200,
+            json=lambda: {'queue_running': [], 'queue_pending': []}
+        )
+
+        mock_memory.return_value = {'available': 10.0}
+        mock_cpu.return_value = {}
+        mock_disk.return_value = {'free_bytes': 10 * 1024 * 1024 * 1024}
+
+        mock_response = MagicMock(status_code=500, content=b'Server error')
+        mock_response.json.side_effect = Exception('Not JSON')
+        mock_post.return_value = mock_response
+
+        event = {
+            'id': 'test-123',
+            'input': {
+                'workflow': 'custom',
+                'payload': {'9': {'class_type': 'SaveImage', 'inputs': {'filename_prefix': 'test'}}}
+            }
+        }
+
+        result = asyncio.run(handler.handler(event))
+
+        assert 'error' in result
+        assert '500' in result['error']
+
+    @patch('handler.logging')
+    @patch('handler.get_container_memory_info')
+    @patch('handler.get_container_cpu_info')
+    @patch('handler.get_container_disk_info')
+    @patch('handler.send_post_request')
+    @patch('handler.send_get_request')
+    @patch('handler.asyncio.sleep')
+    def test_handler_retries_history(
+        self, mock_sleep, mock_get, mock_post,
         mock_disk, mock_cpu, mock_memory, mock_logging
     ):
         import handler
@@ -1314,37 +3607,47 @@ class TestHandlerSuccessPath:
             json=lambda: {'prompt_id': 'test-prompt-123'}
         )
 
-        mock_get.return_value = MagicMock(
-            status_code=200,
-            json=lambda: {
+        # First history call returns empty, second returns result
+        call_count = [0]
+        def mock_history_json():
+            call_count[0] += 1
+            if call_count[0] == 1:
+                return {}
+            return {
                 'test-prompt-123': {
                     'status': {'status_str': 'success', 'completed': True, 'messages': []},
                     'outputs': {}
                 }
             }
-        )
+
+        def mock_get_request(endpoint, *args, **kwargs):
+            if endpoint == 'queue':
+                return MagicMock(status_code=200, json=lambda: {'queue_running': [], 'queue_pending': []})
+            return MagicMock(status_code=200, json=mock_history_json)
+
+        mock_get.side_effect = mock_get_request
 
         event = {
             'id': 'test-123',
             'input': {
                 'workflow': 'custom',
-                'payload': {}
+                'payload': {'9': {'class_type': 'SaveImage', 'inputs': {'filename_prefix': 'test'}}}
             }
         }
 
-        result = handler.handler(event)
+        result = asyncio.run(handler.handler(event))
 
-        assert 'error' in result
-        assert 'No output found' in result['error']
+        mock_sleep.assert_called()
 
     @patch('handler.logging')
     @patch('handler.get_container_memory_info')
     @patch('handler.get_container_cpu_info')
     @patch('handler.get_container_disk_info')
+    @patch('handler.get_workflow_payload')
     @patch('handler.send_post_request')
     @patch('handler.send_get_request')
-    def test_handler_execution_error(
-        self, mock_get, mock_post,
+    def test_handler_default_workflow(
+        self, mock_get, mock_post, mock_workflow,
         mock_disk, mock_cpu, mock_memory, mock_logging
     ):
         import handler
@@ -1352,6 +3655,7 @@ class TestHandlerSuccessPath:
         mock_memory.return_value = {'available': 10.0}
         mock_cpu.return_value = {}
         mock_disk.return_value = {'free_bytes': 10 * 1024 * 1024 * 1024}
+        mock_workflow.return_value = {}
 
         mock_post.return_value = MagicMock(
             status_code=200,
@@ -1362,16 +3666,7 @@ class TestHandlerSuccessPath:
             status_code=200,
             json=lambda: {
                 'test-prompt-123': {
-                    'status': {
-                        'status_str': 'error',
-                        'completed': False,
-                        'messages': [
-                            ['execution_error', {
-                                'node_type': 'TestNode',
-                                'exception_message': 'Test error'
-                            }]
-                        ]
-                    },
+                    'status': {'status_str': 'success', 'completed': True, 'messages': []},
                     'outputs': {}
                 }
             }
@@ -1380,15 +3675,14 @@ class TestHandlerSuccessPath:
         event = {
             'id': 'test-123',
             'input': {
-                'workflow': 'custom',
+                'workflow': 'default',
                 'payload': {}
             }
         }
 
-        result = handler.handler(event)
+        result = asyncio.run(handler.handler(event))
 
-        assert 'error' in result
-        assert 'TestNode' in result['error']
+        mock_workflow.assert_called_with('txt2img', {})
 
     @patch('handler.logging')
     @patch('handler.get_container_memory_info')
@@ -1396,8 +3690,9 @@ class TestHandlerSuccessPath:
     @patch('handler.get_container_disk_info')
     @patch('handler.send_post_request')
     @patch('handler.send_get_request')
-    def test_handler_execution_error_without_details(
-        self, mock_get, mock_post,
+    @patch('handler.ComfyUIEventListener')
+    def test_handler_queues_prompt_with_listener_client_id(
+        self, mock_listener_class, mock_get, mock_post,
         mock_disk, mock_cpu, mock_memory, mock_logging
     ):
         import handler
@@ -1405,6 +3700,11 @@ class TestHandlerSuccessPath:
         mock_memory.return_value = {'available': 10.0}
         mock_cpu.return_value = {}
         mock_disk.return_value = {'free_bytes': 10 * 1024 * 1024 * 1024}
+        mock_listener = mock_listener_class.return_value
+        mock_listener.client_id = 'client-123'
+        mock_listener.connect = AsyncMock(return_value=True)
+        mock_listener.wait = AsyncMock(return_value=True)
+        mock_listener.close = AsyncMock()
 
         mock_post.return_value = MagicMock(
             status_code=200,
@@ -1415,13 +3715,7 @@ class TestHandlerSuccessPath:
             status_code=200,
             json=lambda: {
                 'test-prompt-123': {
-                    'status': {
-                        'status_str': 'error',
-                        'completed': False,
-                        'messages': [
-                            ['execution_error', {'other_field': 'value'}]
-                        ]
-                    },
+                    'status': {'status_str': 'success', 'completed': True, 'messages': []},
                     'outputs': {}
                 }
             }
@@ -1431,21 +3725,28 @@ class TestHandlerSuccessPath:
             'id': 'test-123',
             'input': {
                 'workflow': 'custom',
-                'payload': {}
+                'payload': {'9': {'class_type': 'SaveImage', 'inputs': {'filename_prefix': 'test'}}}
             }
         }
 
-        result = handler.handler(event)
+        asyncio.run(handler.handler(event))
 
-        assert 'error' in result
+        assert len(mock_listener_class.call_args[0][0]) == 36
+        assert mock_post.call_args[0][1]['client_id'] == 'client-123'
+        assert mock_listener.wait.call_args[0][0] == 'test-prompt-123'
+        endpoints = [c[0][0] for c in mock_get.call_args_list]
+        assert endpoints == ['queue', 'history/test-prompt-123']
+        mock_listener.close.assert_called()
 
     @patch('handler.logging')
     @patch('handler.get_container_memory_info')
     @patch('handler.get_container_cpu_info')
     @patch('handler.get_container_disk_info')
     @patch('handler.send_post_request')
-    def test_handler_queue_error_with_json(
-        self, mock_post,
+    @patch('handler.send_get_request')
+    @patch('handler.asyncio.sleep')
+    def test_handler_fails_when_time_budget_is_exceeded(
+        self, mock_sleep, mock_get, mock_post,
         mock_disk, mock_cpu, mock_memory, mock_logging
     ):
         import handler
@@ -1455,31 +3756,32 @@ class TestHandlerSuccessPath:
         mock_disk.return_value = {'free_bytes': 10 * 1024 * 1024 * 1024}
 
         mock_post.return_value = MagicMock(
-            status_code=500,
-            json=lambda: {'error': 'Server error'},
-            content=b'Server error'
+            status_code=200,
+            json=lambda: {'prompt_id': 'test-prompt-123'}
         )
+        mock_get.return_value = MagicMock(status_code=200, json=lambda: {})
 
         event = {
             'id': 'test-123',
             'input': {
                 'workflow': 'custom',
-                'payload': {}
+                'payload': {'9': {'class_type': 'SaveImage', 'inputs': {'filename_prefix': 'test'}}},
+                'timeout': 0.01
             }
         }
 
-        result = handler.handler(event)
+        result = asyncio.run(handler.handler(event))
 
-        assert 'error' in result
-        assert '500' in result['error']
+        assert 'time budget' in result['error']
+        assert result['refresh_worker'] is True
 
     @patch('handler.logging')
     @patch('handler.get_container_memory_info')
     @patch('handler.get_container_cpu_info')
     @patch('handler.get_container_disk_info')
-    @patch('handler.send_post_request')
-    def test_handler_queue_error_without_json(
-        self, mock_post,
+    @patch('handler.get_workflow_payload')
+    def test_handler_workflow_load_error(
+        self, mock_workflow,
         mock_disk, mock_cpu, mock_memory, mock_logging
     ):
         import handler
@@ -1487,23 +3789,21 @@ class TestHandlerSuccessPath:
         mock_memory.return_value = {'available': 10.0}
         mock_cpu.return_value = {}
         mock_disk.return_value = {'free_bytes': 10 * 1024 * 1024 * 1024}
-
-        mock_response = MagicMock(status_code=500, content=b'Server error')
-        mock_response.json.side_effect = Exception('Not JSON')
-        mock_post.return_value = mock_response
+        mock_workflow.side_effect = Exception('File not found')
 
         event = {
             'id': 'test-123',
             'input': {
-                'workflow': 'custom',
+                'workflow': 'txt2img',
                 'payload': {}
             }
         }
 
-        result = handler.handler(event)
+        result = asyncio.run(handler.handler(event))
 
         assert 'error' in result
-        assert '500' in result['error']
+        assert 'refresh_worker' in result
+
 
     @patch('handler.logging')
     @patch('handler.get_container_memory_info')
@@ -1511,9 +3811,12 @@ class TestHandlerSuccessPath:
     @patch('handler.get_container_disk_info')
     @patch('handler.send_post_request')
     @patch('handler.send_get_request')
-    @patch('handler.time.sleep')
-    def test_handler_retries_history(
-        self, mock_sleep, mock_get, mock_post,
+    @patch('handler.os.path.exists')
+    @patch('handler.os.remove')
+    @patch('handler.os.path.getsize', return_value=len(b'fake image data'))
+    @patch('builtins.open', new_callable=mock_open, read_data=b'fake image data')
+    def test_handler_returns_batch_up_to_max_images(
+        self, mock_file, mock_getsize, mock_remove, mock_exists, mock_get, mock_post,
         mock_disk, mock_cpu, mock_memory, mock_logging
     ):
         import handler
@@ -1527,106 +3830,368 @@ class TestHandlerSuccessPath:
             json=lambda: {'prompt_id': 'test-prompt-123'}
         )
 
-        # First call returns empty, second returns result
-        call_count = [0]
-        def mock_json():
-            call_count[0] += 1
-            if call_count[0] == 1:
-                return {}
-            return {
+        mock_get.return_value = MagicMock(
+            status_code=200,
+            json=lambda: {
                 'test-prompt-123': {
                     'status': {'status_str': 'success', 'completed': True, 'messages': []},
-                    'outputs': {}
+                    'outputs': {
+                        '9': {'images': [
+                            {'filename': f'test_{i}.png', 'type': 'output'} for i in range(4)
+                        ]}
+                    }
                 }
             }
+        )
 
-        mock_get.return_value = MagicMock(status_code=200, json=mock_json)
+        mock_exists.return_value = True
 
         event = {
             'id': 'test-123',
             'input': {
                 'workflow': 'custom',
-                'payload': {}
+                'max_images': 3,
+                'payload': {
+                    '9': {'class_type': 'SaveImage', 'inputs': {'filename_prefix': 'test'}}
+                }
             }
         }
 
-        result = handler.handler(event)
+        result = asyncio.run(handler.handler(event))
 
-        mock_sleep.assert_called()
+        assert len(result['images']) == 3
+        assert result['metrics']['encoder_peak_bytes'] > 0
+        assert result['image_info'] == [
+            {'node_id': '9', 'batch_index': 0, 'kind': 'images'},
+            {'node_id': '9', 'batch_index': 1, 'kind': 'images'},
+            {'node_id': '9', 'batch_index': 2, 'kind': 'images'}
+        ]
+
+        # The image beyond the cap is deleted without being read
+        assert mock_file.call_count == 3
+        assert mock_remove.call_count == 4
+
+
+class TestWebsocketOutputs:
+    """Tests for receiving output images over the websocket."""
+
+    event = {
+        'id': 'test-123',
+        'input': {
+            'workflow': 'custom',
+            'websocket_outputs': True,
+            'payload': {
+                '8': {'class_type': 'LoadImage', 'inputs': {'image': 'source.png'}},
+                '9': {'class_type': 'SaveImage', 'inputs': {'filename_prefix': 'test', 'images': ['8', 0]}}
+            }
+        }
+    }
+
+    def image_frame(self, data, event_type=1, image_type=2):
+        import aiohttp
+        import struct
+
+        return MagicMock(type=aiohttp.WSMsgType.BINARY, data=struct.pack('>II', event_type, image_type) + data)
+
+    def executing_message(self, node):
+        import aiohttp
+
+        return MagicMock(type=aiohttp.WSMsgType.TEXT, data=json.dumps({
+            'type': 'executing',
+            'data': {'node': node, 'prompt_id': 'test-prompt-123'}
+        }))
+
+    def test_replaces_save_image_nodes(self):
+        from handler import use_websocket_outputs
+
+        payload = json.loads(json.dumps(self.event['input']['payload']))
+
+        assert use_websocket_outputs(payload) == {'9'}
+        assert payload['9'] == {'class_type': 'SaveImageWebsocket', 'inputs': {'images': ['8', 0]}}
+        assert payload['8']['class_type'] == 'LoadImage'
+
+    def test_collects_images_of_image_nodes_only(self):
+        from handler import ComfyUIEventListener
+        import struct
+
+        listener = ComfyUIEventListener('client-123')
+        listener.image_nodes = {'9'}
+
+        # Sampler previews are sent while the sampler is executing
+        listener.handle_message({'type': 'executing', 'data': {'node': '3', 'prompt_id': 'p'}})
+        listener.handle_binary_message(struct.pack('>II', 1, 1) + b'preview')
+        listener.handle_message({'type': 'executing', 'data': {'node': '9', 'prompt_id': 'p'}})
+        listener.handle_binary_message(struct.pack('>II', 1, 2) + b'first')
+        listener.handle_binary_message(struct.pack('>II', 1, 2) + b'second')
+
+        images = listener.pop_images()
+
+        assert [(image['node_id'], image['batch_index'], image['data']) for image in images] == [
+            ('9', 0, b'first'),
+            ('9', 1, b'second')
+        ]
+        assert images[1]['filename'] == '9_00001.png'
+        assert listener.pop_images() == []
 
     @patch('handler.logging')
     @patch('handler.get_container_memory_info')
     @patch('handler.get_container_cpu_info')
     @patch('handler.get_container_disk_info')
-    @patch('handler.get_workflow_payload')
     @patch('handler.send_post_request')
     @patch('handler.send_get_request')
-    def test_handler_default_workflow(
-        self, mock_get, mock_post, mock_workflow,
-        mock_disk, mock_cpu, mock_memory, mock_logging
+    @patch('handler.process_output_image')
+    def test_handler_returns_images_without_touching_disk(
+        self, mock_process_output_image, mock_get, mock_post,
+        mock_disk, mock_cpu, mock_memory, mock_logging, no_comfyui_websocket
     ):
         import handler
 
         mock_memory.return_value = {'available': 10.0}
         mock_cpu.return_value = {}
         mock_disk.return_value = {'free_bytes': 10 * 1024 * 1024 * 1024}
-        mock_workflow.return_value = {}
+        mock_post.return_value = MagicMock(status_code=200, json=lambda: {'prompt_id': 'test-prompt-123'})
+        mock_get.return_value = MagicMock(status_code=200, json=lambda: {
+            'test-prompt-123': {
+                'status': {'status_str': 'success', 'completed': True, 'messages': []},
+                'outputs': {}
+            }
+        })
+        no_comfyui_websocket.side_effect = None
+        no_comfyui_websocket.return_value = FakeWebSocket([
+            self.executing_message('9'),
+            self.image_frame(b'png image data'),
+            self.executing_message(None)
+        ], hold_open=True)
+
+        result = asyncio.run(handler.handler(json.loads(json.dumps(self.event))))
+
+        assert result['images'] == [base64.b64encode(b'png image data').decode('utf-8')]
+        assert result['image_info'][0]['node_id'] == '9'
+        mock_process_output_image.assert_not_called()
+
+        queued_payload = mock_post.call_args_list[0][0][1]['prompt']
+        assert queued_payload['9']['class_type'] == 'SaveImageWebsocket'
+
+    @patch('handler.logging')
+    def test_saves_to_disk_without_websocket(self, mock_logging):
+        import handler
+
+        listener = handler.ComfyUIEventListener('client-123')
+        payload = json.loads(json.dumps(self.event['input']['payload']))
+
+        handler.enable_websocket_outputs(listener, payload, 'job-1')
+
+        assert payload['9']['class_type'] == 'SaveImage'
+        assert listener.image_nodes == set()
+
+    def test_dropped_websocket_is_an_error(self):
+        import handler
+
+        listener = handler.ComfyUIEventListener('client-123')
+        listener.image_nodes = {'9'}
+        listener.dropped = True
+
+        with pytest.raises(RuntimeError, match='dropped'):
+            handler.get_websocket_images(listener, 'test-prompt-123')
 
+
+class TestStreamHandler:
+    """Tests for the streaming generator handler."""
+
+    event = {
+        'id': 'test-123',
+        'input': {
+            'workflow': 'custom',
+            'payload': {
+                '9': {'class_type': 'SaveImage', 'inputs': {'filename_prefix': 'base'}},
+                '12': {'class_type': 'SaveImage', 'inputs': {'filename_prefix': 'refined'}}
+            }
+        }
+    }
+
+    history = {
+        'test-prompt-123': {
+            'status': {'status_str': 'success', 'completed': True, 'messages': []},
+            'outputs': {
+                '9': {'images': [{'filename': 'base.png', 'type': 'output'}]},
+                '12': {'images': [{'filename': 'refined.png', 'type': 'output'}]}
+            }
+        }
+    }
+
+    def run_stream(self):
+        import handler
+
+        async def collect():
+            return [output async for output in handler.stream_handler(self.event)]
+
+        return asyncio.run(collect())
+
+    def mock_comfyui(self, mock_get, mock_post, mock_disk, mock_cpu, mock_memory):
+        mock_memory.return_value = {'available': 10.0}
+        mock_cpu.return_value = {}
+        mock_disk.return_value = {'free_bytes': 10 * 1024 * 1024 * 1024}
         mock_post.return_value = MagicMock(
             status_code=200,
             json=lambda: {'prompt_id': 'test-prompt-123'}
         )
+        mock_get.return_value = MagicMock(status_code=200, json=lambda: self.history)
+
+    @patch('handler.logging')
+    @patch('handler.get_container_memory_info')
+    @patch('handler.get_container_cpu_info')
+    @patch('handler.get_container_disk_info')
+    @patch('handler.send_post_request')
+    @patch('handler.send_get_request')
+    @patch('handler.os.path.exists', return_value=True)
+    @patch('handler.os.remove')
+    @patch('handler.os.path.getsize', return_value=len(b'fake image data'))
+    @patch('builtins.open', new_callable=mock_open, read_data=b'fake image data')
+    def test_streams_images_as_nodes_execute(
+        self, mock_file, mock_getsize, mock_remove, mock_exists, mock_get, mock_post,
+        mock_disk, mock_cpu, mock_memory, mock_logging, no_comfyui_websocket
+    ):
+        import aiohttp
+
+        self.mock_comfyui(mock_get, mock_post, mock_disk, mock_cpu, mock_memory)
+        no_comfyui_websocket.side_effect = None
+        no_comfyui_websocket.return_value = FakeWebSocket([
+            MagicMock(type=aiohttp.WSMsgType.TEXT, data=json.dumps({
+                'type': 'executed',
+                'data': {
+                    'node': '9',
+                    'prompt_id': 'test-prompt-123',
+                    'output': {'images': [{'filename': 'base.png', 'type': 'output'}]}
+                }
+            })),
+            MagicMock(type=aiohttp.WSMsgType.TEXT, data=json.dumps({
+                'type': 'execution_success',
+                'data': {'prompt_id': 'test-prompt-123'}
+            }))
+        ])
+
+        outputs = self.run_stream()
+        expected_image = base64.b64encode(b'fake image data').decode('utf-8')
+
+        # Node 9 is streamed from the websocket, node 12 is collected from the history
+        assert outputs == [
+            {'node_id': '9', 'batch_index': 0, 'kind': 'images', 'image': expected_image},
+            {'node_id': '12', 'batch_index': 0, 'kind': 'images', 'image': expected_image}
+        ]
+
+    @patch('handler.logging')
+    @patch('handler.get_container_memory_info')
+    @patch('handler.get_container_cpu_info')
+    @patch('handler.get_container_disk_info')
+    @patch('handler.send_post_request')
+    @patch('handler.send_get_request')
+    @patch('handler.os.path.exists', return_value=True)
+    @patch('handler.os.remove')
+    @patch('handler.os.path.getsize', return_value=len(b'fake image data'))
+    @patch('builtins.open', new_callable=mock_open, read_data=b'fake image data')
+    def test_falls_back_to_history_without_websocket(
+        self, mock_file, mock_getsize, mock_remove, mock_exists, mock_get, mock_post,
+        mock_disk, mock_cpu, mock_memory, mock_logging
+    ):
+        self.mock_comfyui(mock_get, mock_post, mock_disk, mock_cpu, mock_memory)
+
+        outputs = self.run_stream()
 
+        assert [output['node_id'] for output in outputs] == ['9', '12']
+
+    @patch('handler.logging')
+    @patch('handler.get_container_memory_info')
+    @patch('handler.get_container_cpu_info')
+    @patch('handler.get_container_disk_info')
+    @patch('handler.send_post_request')
+    @patch('handler.send_get_request')
+    def test_yields_error_on_execution_failure(
+        self, mock_get, mock_post, mock_disk, mock_cpu, mock_memory, mock_logging
+    ):
+        self.mock_comfyui(mock_get, mock_post, mock_disk, mock_cpu, mock_memory)
         mock_get.return_value = MagicMock(
             status_code=200,
             json=lambda: {
                 'test-prompt-123': {
-                    'status': {'status_str': 'success', 'completed': True, 'messages': []},
+                    'status': {
+                        'status_str': 'error',
+                        'completed': False,
+                        'messages': [['execution_error', {'node_type': 'KSampler', 'exception_message': 'OOM'}]]
+                    },
                     'outputs': {}
                 }
             }
         )
 
-        event = {
-            'id': 'test-123',
-            'input': {
-                'workflow': 'default',
-                'payload': {}
-            }
-        }
-
-        result = handler.handler(event)
+        outputs = self.run_stream()
 
-        mock_workflow.assert_called_with('txt2img', {})
+        assert len(outputs) == 1
+        assert outputs[0]['error'] == 'KSampler: OOM'
+        assert 'refresh_worker' not in outputs[0]
 
     @patch('handler.logging')
     @patch('handler.get_container_memory_info')
     @patch('handler.get_container_cpu_info')
     @patch('handler.get_container_disk_info')
-    @patch('handler.get_workflow_payload')
-    def test_handler_workflow_load_error(
-        self, mock_workflow,
+    @patch('handler.send_post_request')
+    @patch('handler.send_get_request')
+    @patch('handler.os.path.exists', return_value=True)
+    @patch('handler.os.remove')
+    @patch('handler.os.path.getsize', return_value=len(b'fake image data'))
+    @patch('builtins.open', new_callable=mock_open, read_data=b'fake image data')
+    def test_warns_instead_of_refreshing_worker_when_memory_is_low(
+        self, mock_file, mock_getsize, mock_remove, mock_exists, mock_get, mock_post,
         mock_disk, mock_cpu, mock_memory, mock_logging
     ):
+        self.mock_comfyui(mock_get, mock_post, mock_disk, mock_cpu, mock_memory)
+        mock_memory.return_value = {'available': 0.5}
+
+        outputs = self.run_stream()
+
+        # runpod ignores refresh_worker in the output of generator handlers
+        assert [output.get('node_id') for output in outputs] == ['9', '12']
+        assert all('refresh_worker' not in output for output in outputs)
+        assert 'cannot be refreshed' in mock_logging.warning.call_args[0][0]
+
+    @patch('handler.logging')
+    @patch('handler.get_container_memory_info')
+    @patch('handler.get_container_cpu_info')
+    @patch('handler.get_container_disk_info')
+    @patch('handler.send_post_request')
+    @patch('handler.send_get_request')
+    def test_cancels_completion_wait_when_streaming_fails(
+        self, mock_get, mock_post, mock_disk, mock_cpu, mock_memory, mock_logging, no_comfyui_websocket
+    ):
+        import aiohttp
         import handler
 
-        mock_memory.return_value = {'available': 10.0}
-        mock_cpu.return_value = {}
-        mock_disk.return_value = {'free_bytes': 10 * 1024 * 1024 * 1024}
-        mock_workflow.side_effect = Exception('File not found')
+        self.mock_comfyui(mock_get, mock_post, mock_disk, mock_cpu, mock_memory)
+        no_comfyui_websocket.side_effect = None
+        no_comfyui_websocket.return_value = FakeWebSocket([
+            MagicMock(type=aiohttp.WSMsgType.TEXT, data=json.dumps({
+                'type': 'executed',
+                'data': {'node': '9', 'prompt_id': 'test-prompt-123', 'output': {'images': []}}
+            }))
+        ])
+        waits = []
 
-        event = {
-            'id': 'test-123',
-            'input': {
-                'workflow': 'txt2img',
-                'payload': {}
-            }
-        }
+        async def wait(prompt_id, timeout=None):
+            waits.append(asyncio.current_task())
+            await asyncio.sleep(3600)
 
-        result = handler.handler(event)
+        with patch.object(handler.ComfyUIEventListener, 'wait', side_effect=wait), \
+                patch('handler.get_output_images', side_effect=RuntimeError('bad output')):
+            async def collect():
+                outputs = [output async for output in handler.stream_handler(self.event)]
+                await asyncio.sleep(0)
 
-        assert 'error' in result
-        assert 'refresh_worker' in result
+                # The wait is cancelled by the handler itself, not by asyncio.run() on shutdown
+                return outputs, waits[0].cancelled()
+
+            outputs, cancelled = asyncio.run(collect())
+
+        assert outputs[0]['error'] == 'bad output'
+        assert cancelled
 
 
 class TestSnapLogHandler:
@@ -1795,6 +4360,35 @@ class TestSnapLogHandler:
 
             mock_post.assert_called_once()
 
+    @patch('handler.requests.post')
+    def test_log_handler_ships_in_background_inside_event_loop(self, mock_post, mock_runpod_logger):
+        from handler import SnapLogHandler
+
+        with patch.dict(os.environ, {'LOG_API_ENDPOINT': 'http://test.com/log', 'LOG_API_TOKEN': 'token'}):
+            handler = SnapLogHandler('test-app')
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            handler.send_log_async = AsyncMock()
+
+            record = logging.LogRecord(
+                name='test',
+                level=logging.INFO,
+                pathname='',
+                lineno=0,
+                msg='Test message',
+                args=(),
+                exc_info=None
+            )
+
+            async def run():
+                handler.emit(record)
+                await asyncio.gather(*handler.pending_logs)
+
+            asyncio.run(run())
+
+            mock_post.assert_not_called()
+            handler.send_log_async.assert_called_once()
+            assert handler.send_log_async.call_args[0][0]['log_message'] == 'Test message'
+
     @patch('handler.requests.post')
     def test_log_handler_handles_api_error(self, mock_post, mock_runpod_logger):
         from handler import SnapLogHandler